@@ -20,13 +20,64 @@ class AFAServer(AIForAnki):
             log_level="info"
         )
         
+    def _run_inference_main(self):
+        from src.app.core.assistant import serve_inference
+        serve_inference()
+
+    def _start_inference_server(self):
+        import multiprocessing as mp
+        import os
+        import time
+        from src.app.core.assistant import inference_address
+        from src.engine.inference_server import AUTHKEY_ENV
+
+        # shared by the inference process and the uvicorn workers, which inherit the environment
+        os.environ.setdefault(AUTHKEY_ENV, os.urandom(16).hex())
+        address = inference_address()
+        if os.path.exists(address):
+            os.unlink(address)
+        inference_process = mp.Process(target=self._run_inference_main)
+        inference_process.start()
+        # the socket appears once the models are loaded
+        while not os.path.exists(address):
+            if not inference_process.is_alive():
+                raise SystemExit("The inference server failed to start")
+            time.sleep(0.1)
+        return inference_process
+
     def run(self):
         import multiprocessing as mp
-        
+        from src.settings import settings
+
+        inference_process = self._start_inference_server() if settings.INFERENCE_SERVER else None
         main_process = mp.Process(target=self._run_app_main)
         main_process.start()
         main_process.join()
+        if inference_process is not None:
+            inference_process.terminate()
+            inference_process.join()
         
+class AFAGateway(AIForAnki):
+    """Load-balancing gateway in front of several AFAServer instances (`--backends` or GATEWAY_BACKENDS)."""
+    def __init__(self, args):
+        self.args = args
+
+    def run(self):
+        import uvicorn
+        from src.app.gateway import get_gateway_application
+        from src.settings import settings
+
+        backends = self.args.backends or settings.GATEWAY_BACKENDS
+        if not backends:
+            raise SystemExit("gateway mode needs --backends or GATEWAY_BACKENDS")
+        # one async process is plenty to proxy, and keeps one view of the backends' load
+        uvicorn.run(
+            get_gateway_application(backends),
+            host=settings.GATEWAY_HOST,
+            port=self.args.port or settings.GATEWAY_PORT,
+            log_level="info"
+        )
+
 class AFAAnki(AIForAnki):
     def _test_anki_enumeration_tool(self):
         from tests.kt.test_anki_enumeration_tool import osce_dialog
@@ -38,10 +89,72 @@ class AFAAnki(AIForAnki):
     
     def run(self):
         self._run_anki_assistant_tool()
-    
+
+class AFABulk(AIForAnki):
+    """Headless deck generation: answers a prompt template for every row of a CSV/JSONL file."""
+    def __init__(self, args):
+        self.args = args
+
+    def _build_assistant(self):
+        from src.app.core.assistant import resolve_system_prompt
+        from src.engine.chatbot import AnkiAssistant
+        from src.settings import settings
+
+        return AnkiAssistant(
+            cache_dir=settings.CACHE_DIR,
+            device_ids=[str(did) for did in settings.GPU_DEVICES_ID],
+            chat_model_name=settings.CHAT_MODEL_NAME,
+            chat_max_token=settings.MAX_NEW_TOKEN_CHAT_MODEL,
+            distributed=settings.DISTRIBUTED,
+            chat_system_prompt=resolve_system_prompt(),
+            chat_prefix_cache=settings.CHAT_PREFIX_CACHE,
+            offline=settings.MODELS_OFFLINE,
+            backend=settings.INFERENCE_BACKEND,
+            cpu_precision=settings.CPU_BACKEND_PRECISION,
+            cpu_threads=settings.CPU_BACKEND_THREADS
+        )
+
+    def run(self):
+        from src.engine.deck_builder import ANKI, JSONL, DeckBuilder
+        from src.settings import settings
+
+        args = self.args
+        if not args.input or not args.output or not args.template:
+            raise SystemExit("bulk mode needs --input, --output and --template")
+        template = args.template
+        if template.startswith("@"):
+            with open(template[1:], "r", encoding="utf-8") as f:
+                template = f.read()
+        output_format = args.format or (JSONL if args.output.endswith(".jsonl") else ANKI)
+
+        assistant = self._build_assistant()
+        builder = DeckBuilder(
+            answer_batch=assistant.answer_batch,
+            template=template,
+            output_format=output_format,
+            batch_size=args.batch_size or settings.CHAT_BATCH_MAX_SIZE,
+            checkpoint_every=args.checkpoint_every,
+            front_field=args.front_field,
+            report_seconds=args.report_seconds
+        )
+        builder.run(args.input, args.output, restart=args.restart)
+
 def parse_args():
     parser = argparse.ArgumentParser("AI For Anki")
-    parser.add_argument('-m', "--mode", type=str, default="app", choices=["app", "anki"])
+    parser.add_argument('-m', "--mode", type=str, default="app", choices=["app", "anki", "bulk", "gateway"])
+    bulk = parser.add_argument_group("bulk mode")
+    bulk.add_argument("--input", type=str, help="CSV (with a header line), TSV or JSONL file of terms")
+    bulk.add_argument("--output", type=str, help=".jsonl for JSON lines, anything else for an Anki text file")
+    bulk.add_argument("--template", type=str, help="Prompt with {column} placeholders, or @file to read it from")
+    bulk.add_argument("--format", type=str, default=None, choices=["jsonl", "anki"])
+    bulk.add_argument("--front-field", type=str, default="term", help="Column used as the front of Anki notes")
+    bulk.add_argument("--batch-size", type=int, default=None)
+    bulk.add_argument("--checkpoint-every", type=int, default=8, help="Batches between checkpoints")
+    bulk.add_argument("--report-seconds", type=float, default=30.0)
+    bulk.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start over")
+    gateway = parser.add_argument_group("gateway mode")
+    gateway.add_argument("--backends", nargs="+", default=None, help="Base URLs of the AFAServer instances (e.g. http://10.0.0.2:8505)")
+    gateway.add_argument("--port", type=int, default=None, help="Port of the gateway (default: GATEWAY_PORT)")
     return parser.parse_args()
         
 if __name__ == "__main__":
@@ -52,4 +165,12 @@ if __name__ == "__main__":
         
     elif args.mode == "anki":
         anki = AFAAnki()
-        anki.run()
\ No newline at end of file
+        anki.run()
+
+    elif args.mode == "bulk":
+        bulk = AFABulk(args)
+        bulk.run()
+
+    elif args.mode == "gateway":
+        gateway = AFAGateway(args)
+        gateway.run()
\ No newline at end of file
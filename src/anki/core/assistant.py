@@ -1,8 +1,9 @@
-from typing import List, Annotated, Tuple, Optional, Callable, Any
+from typing import List, Annotated, Tuple, Optional, Callable, Any, Iterator
 from PIL import Image
 from functools import wraps
 import httpx
 import io
+import json
 
 from src.engine.chatbot import AnkiAssistant
 from src.settings import settings
@@ -65,6 +66,7 @@ class Engine(object):
 class AsyncAPIEngine(object):
     def __init__(self):
         self.ENDPOINT_ANSWER = f"{settings.API_DOMAIN}/answer"
+        self.ENDPOINT_ANSWER_STREAM = f"{settings.API_DOMAIN}/answer-stream"
         self.ENDPOINT_DESCRIBE_IMAGE = f"{settings.API_DOMAIN}/describe-image"
         self.ENDPOINT_ANALYSE_IMAGES = f"{settings.API_DOMAIN}/analyse-images"
         self.ENDPOINT_DESCRIBE_VIDEO = f"{settings.API_DOMAIN}/describe-video"
@@ -79,6 +81,25 @@ class AsyncAPIEngine(object):
         response.raise_for_status()
         response.raise_for_status()
         return response.json()["data"]["answer"]
+
+    def answer_stream(self, prompt: str) -> Iterator[str]:
+        payload = {
+            "prompt": prompt
+        }
+
+        # server-sent events: "event: token|error|done" followed by "data: {...}"
+        with httpx.stream("POST", self.ENDPOINT_ANSWER_STREAM, json=payload, timeout=None) as response:
+            response.raise_for_status()
+            event = None
+            for line in response.iter_lines():
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    data = json.loads(line[len("data: "):])
+                    if event == "token":
+                        yield data["token"]
+                    elif event == "error":
+                        raise RuntimeError(data["msg"])
         
     async def describe_image(self, image: Image.Image) -> str:
         image_bytes = io.BytesIO()
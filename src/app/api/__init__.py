@@ -1,10 +1,11 @@
 from fastapi import APIRouter
 
-from src.app.api import api_chatbot
+from src.app.api import api_chatbot, api_jobs
 
 __all__ = [
     "router"
 ]
 
 router = APIRouter()
-router.include_router(api_chatbot.router, prefix="/llm", tags=["llm"])
\ No newline at end of file
+router.include_router(api_chatbot.router, prefix="/llm", tags=["llm"])
+router.include_router(api_jobs.router, prefix="/jobs", tags=["jobs"])
@@ -1,27 +1,117 @@
-import io
-import os
+import json
 
-from typing import Annotated, List
-from fastapi import APIRouter, Body, UploadFile, File
-from PIL import Image
+from typing import Annotated, AsyncIterator, List, Optional
+from fastapi import APIRouter, Body, Form, UploadFile, File
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR
 
 from src.app.api.api_router import TimerRoute
-from src.app.models.model_chatbot import ChatResponse, ChatRequest
-from src.app.models.model_http_response import ResponseData
+from src.app.models.model_chatbot import (ChatResponse, ChatRequest, ChatStreamChunk, ChatMessage, SessionResponse,
+                                         VisionBatchItem, VisionBatchResult)
+from src.app.models.model_http_response import ResponseData, ResponseMessage
 from src.app.core.assistant import DepsAnkiAssistant
+from src.app.core.request_context import DepsBulkRequestContext, DepsRequestContext
+from src.app.core.uploads import FORM_OVERHEAD, MB, body_limit, read_upload
 from src.app.exceptions.exception import ChatbotException
 from src.helpers.logging.logger import logger
 from src.settings import settings
 
 router = APIRouter(route_class=TimerRoute)
 
+def sse_event(event: str, payload: BaseModel) -> str:
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(payload))}\n\n"
+
+@router.get("/stats", response_model=ResponseData)
+async def get_stats(
+    anki_assistant: DepsAnkiAssistant
+) -> ResponseData:
+    return ResponseData().success_message(
+        data=anki_assistant.stats()
+    )
+
+@router.get("/health", response_model=ResponseData)
+async def get_health(
+    anki_assistant: DepsAnkiAssistant
+) -> ResponseData:
+    return ResponseData().success_message(
+        data=anki_assistant.health()
+    )
+
 @router.post("/answer", response_model=ResponseData)
 async def answer(
     anki_assistant: DepsAnkiAssistant,
+    context: DepsRequestContext,
     chat_request: ChatRequest = Body(...)
 ) -> ResponseData:
     # run assistant
-    answer, error = await anki_assistant.answer(chat_request.prompt)
+    answer, error = await anki_assistant.answer(chat_request.prompt, use_cache=not chat_request.no_cache, context=context)
+    
+    if error:
+        raise ChatbotException.unprocessable_exception(message=str(error))
+    
+    return ResponseData().success_message(
+        data=ChatResponse(answer=answer)
+    )
+
+@router.post("/answer-stream")
+async def answer_stream(
+    anki_assistant: DepsAnkiAssistant,
+    context: DepsRequestContext,
+    chat_request: ChatRequest = Body(...)
+) -> StreamingResponse:
+    # start generation (overload is raised here, before the stream opens)
+    pieces = await anki_assistant.answer_stream(chat_request.prompt, use_cache=not chat_request.no_cache, context=context)
+    
+    async def events() -> AsyncIterator[str]:
+        answer = []
+        try:
+            async for piece in pieces:
+                answer.append(piece)
+                yield sse_event("token", ChatStreamChunk(token=piece))
+        except Exception as e:
+            logger.error(f"Streaming answer failed: {e}")
+            yield sse_event("error", ResponseMessage().message(code=HTTP_500_INTERNAL_SERVER_ERROR, msg=str(e)))
+            return
+        finally:
+            # also runs when the client disconnects mid-stream, which cancels the generation
+            await pieces.aclose()
+        
+        yield sse_event("done", ResponseData().success_message(data=ChatResponse(answer="".join(answer))))
+    
+    return StreamingResponse(context.hold_for(events()), media_type="text/event-stream")
+
+@router.post("/sessions", response_model=ResponseData)
+async def create_session(
+    anki_assistant: DepsAnkiAssistant
+) -> ResponseData:
+    session = anki_assistant.create_session()
+    return ResponseData().success_message(
+        data=SessionResponse(session_id=session.session_id)
+    )
+
+@router.get("/sessions/{session_id}", response_model=ResponseData)
+async def get_session(
+    anki_assistant: DepsAnkiAssistant,
+    session_id: str
+) -> ResponseData:
+    session = anki_assistant.get_session(session_id)
+    return ResponseData().success_message(
+        data=SessionResponse(
+            session_id=session.session_id,
+            messages=[ChatMessage(**message) for message in session.messages]
+        )
+    )
+
+@router.post("/sessions/{session_id}/turns", response_model=ResponseData)
+async def answer_session(
+    anki_assistant: DepsAnkiAssistant,
+    context: DepsRequestContext,
+    session_id: str,
+    chat_request: ChatRequest = Body(...)
+) -> ResponseData:
+    answer, error = await anki_assistant.answer_session(session_id, chat_request.prompt, context=context)
     
     if error:
         raise ChatbotException.unprocessable_exception(message=str(error))
@@ -30,17 +120,28 @@ async def answer(
         data=ChatResponse(answer=answer)
     )
 
+@router.delete("/sessions/{session_id}", response_model=ResponseData)
+async def close_session(
+    anki_assistant: DepsAnkiAssistant,
+    session_id: str
+) -> ResponseData:
+    session = anki_assistant.close_session(session_id)
+    return ResponseData().success_message(
+        data=SessionResponse(session_id=session.session_id)
+    )
+
 @router.post("/describe-image", response_model=ResponseData)
+@body_limit(settings.MAX_IMAGE_UPLOAD_MB * MB + FORM_OVERHEAD)
 async def answer(
     anki_assistant: DepsAnkiAssistant,
+    context: DepsRequestContext,
     file: UploadFile = File(...)
 ) -> ResponseData:
-    # read image
-    image_bytes = await file.read()
-    image = Image.open(io.BytesIO(image_bytes))
+    # read image (size-limited), it is decoded off the event loop unless already known to the model
+    image = anki_assistant.image_source(await read_upload(file, settings.MAX_IMAGE_UPLOAD_MB * MB))
     
     # run assistant
-    desc, error = await anki_assistant.describe_image(image)
+    desc, error = await anki_assistant.describe_image(image, context=context)
     if error:
         raise ChatbotException.unprocessable_exception(message=str(error))
     
@@ -49,20 +150,18 @@ async def answer(
     )
     
 @router.post("/analyse-images", response_model=ResponseData)
+@body_limit(settings.MAX_IMAGE_UPLOAD_FILES * settings.MAX_IMAGE_UPLOAD_MB * MB + FORM_OVERHEAD)
 async def answer(
     anki_assistant: DepsAnkiAssistant,
+    context: DepsRequestContext,
     chat_request: ChatRequest = Body(...),
     files: List[UploadFile] = File(...)
 ) -> ResponseData:    
-    # read and convert all files into PIL Images
-    images = []
-    for file in files:
-        image_bytes = await file.read()
-        image = Image.open(io.BytesIO(image_bytes))
-        images.append(image)
+    # read all files (size-limited), they are decoded off the event loop unless already known to the model
+    images = [anki_assistant.image_source(await read_upload(file, settings.MAX_IMAGE_UPLOAD_MB * MB)) for file in files]
 
     # analyse images using the assistant
-    anal, error = await anki_assistant.analyse_images_with_prompt(images, chat_request.prompt)
+    anal, error = await anki_assistant.analyse_images_with_prompt(images, chat_request.prompt, context=context)
     if error:
         raise ChatbotException.unprocessable_exception(message=str(error))
     
@@ -71,19 +170,59 @@ async def answer(
     )
 
     
+@router.post("/analyse-images-batch")
+@body_limit(settings.MAX_IMAGE_UPLOAD_FILES * settings.MAX_IMAGE_UPLOAD_MB * MB + FORM_OVERHEAD)
+async def analyse_images_batch(
+    anki_assistant: DepsAnkiAssistant,
+    context: DepsBulkRequestContext,
+    files: List[UploadFile] = File(...),
+    items: Optional[str] = Form(default=None, description="JSON list of {images: [file indices], prompt}; default: each file on its own"),
+    prompt: str = Form(default="Describe this image.", description="Prompt of the default items")
+) -> StreamingResponse:
+    try:
+        batch = TypeAdapter(List[VisionBatchItem]).validate_json(items) if items else [
+            VisionBatchItem(images=[index], prompt=prompt) for index in range(len(files))
+        ]
+    except ValidationError as e:
+        raise ChatbotException.bad_request_exception(message=f"Invalid items: {e}")
+    if any(index < 0 or index >= len(files) for item in batch for index in item.images):
+        raise ChatbotException.bad_request_exception(message=f"Image indices must be within [0, {len(files)}).")
+
+    images = [anki_assistant.image_source(await read_upload(file, settings.MAX_IMAGE_UPLOAD_MB * MB)) for file in files]
+    results = anki_assistant.analyse_batch(
+        [([images[index] for index in item.images], item.prompt) for item in batch],
+        context=context
+    )
+
+    async def lines() -> AsyncIterator[str]:
+        # one json object per line, in completion order
+        try:
+            async for index, answer, error in results:
+                result = VisionBatchResult(index=index, answer=answer)
+                if error is not None:
+                    result = VisionBatchResult(index=index, code=error.http_code, error=error.message)
+                yield result.model_dump_json() + "\n"
+        finally:
+            # also runs when the client disconnects, which drops the remaining batches
+            await results.aclose()
+
+    return StreamingResponse(context.hold_for(lines()), media_type="application/x-ndjson")
+
 @router.post("/describe-video", response_model=ResponseData)
+@body_limit(settings.MAX_VIDEO_UPLOAD_MB * MB + FORM_OVERHEAD)
 async def answer(
     anki_assistant: DepsAnkiAssistant,
+    context: DepsBulkRequestContext,
     file: UploadFile = File(...)
 ) -> ResponseData:
-    # Save uploaded file to a temporary location
-    uploaded_dir = f"{settings.CACHE_DIR}/uploaded_videos/"; os.makedirs(uploaded_dir, exist_ok=True)
-    temp_video_path = f"{uploaded_dir}/{file.filename}"
-    with open(temp_video_path, "wb") as f:
-        f.write(await file.read())
-
-    # Call the describe_video method
-    desc, error = await anki_assistant.describe_video(temp_video_path)
+    # Store the upload by content: a video seen before is neither written again nor described again
+    video = await anki_assistant.video_uploads.save(file, settings.MAX_VIDEO_UPLOAD_MB * MB)
+
+    # Call the describe_video method, the stored upload is held (kept from eviction) until it returns
+    try:
+        desc, error = await anki_assistant.describe_video(video, context=context)
+    finally:
+        anki_assistant.video_uploads.release(video)
 
     # Handle errors
     if error:
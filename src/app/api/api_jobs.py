@@ -0,0 +1,73 @@
+from typing import AsyncIterator
+
+from fastapi import APIRouter, Body
+from fastapi.responses import StreamingResponse
+
+from src.app.api.api_router import TimerRoute
+from src.app.core.assistant import DepsAnkiAssistant
+from src.app.models.model_http_response import ResponseData
+from src.app.models.model_jobs import JobItem, JobRequest, JobResults, JobStatus
+
+router = APIRouter(route_class=TimerRoute)
+
+def job_status(row: dict) -> JobStatus:
+    return JobStatus(job_id=row["id"], **{key: value for key, value in row.items() if key in JobStatus.model_fields})
+
+def job_item(row: dict) -> JobItem:
+    return JobItem(index=row["idx"], status=row["status"], answer=row["answer"], error=row["error"], seq=row["seq"])
+
+@router.post("", response_model=ResponseData)
+async def submit_job(
+    anki_assistant: DepsAnkiAssistant,
+    job_request: JobRequest = Body(...)
+) -> ResponseData:
+    job_id = await anki_assistant.jobs.submit(job_request.prompts, use_cache=not job_request.no_cache)
+    return ResponseData().success_message(
+        data=job_status(await anki_assistant.jobs.status(job_id))
+    )
+
+@router.get("/{job_id}", response_model=ResponseData)
+async def get_job(
+    anki_assistant: DepsAnkiAssistant,
+    job_id: str
+) -> ResponseData:
+    return ResponseData().success_message(
+        data=job_status(await anki_assistant.jobs.status(job_id))
+    )
+
+@router.get("/{job_id}/results", response_model=ResponseData)
+async def get_job_results(
+    anki_assistant: DepsAnkiAssistant,
+    job_id: str,
+    after: int = 0,
+    limit: int = 1000
+) -> ResponseData:
+    rows = await anki_assistant.jobs.results(job_id, after_seq=after, limit=min(limit, 10000))
+    return ResponseData().success_message(
+        data=JobResults(job_id=job_id, items=[job_item(row) for row in rows])
+    )
+
+@router.get("/{job_id}/stream")
+async def stream_job_results(
+    anki_assistant: DepsAnkiAssistant,
+    job_id: str,
+    after: int = 0
+) -> StreamingResponse:
+    # unknown jobs are reported before the stream opens
+    await anki_assistant.jobs.status(job_id)
+    
+    async def lines() -> AsyncIterator[str]:
+        # one json object per finished item, until the job is over
+        async for row in anki_assistant.jobs.stream(job_id, after_seq=after):
+            yield job_item(row).model_dump_json() + "\n"
+    
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@router.delete("/{job_id}", response_model=ResponseData)
+async def cancel_job(
+    anki_assistant: DepsAnkiAssistant,
+    job_id: str
+) -> ResponseData:
+    return ResponseData().success_message(
+        data=job_status(await anki_assistant.jobs.cancel(job_id))
+    )
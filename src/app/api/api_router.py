@@ -1,21 +1,50 @@
 import time
+from typing import AsyncIterator
 
 from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.routing import APIRoute
 
+from src.app.core.uploads import BodyTooLarge, body_too_large, limit_body
 from src.helpers.logging.logger import logger
+from src.helpers.metrics.stats import stats
+
+async def timed_body_iterator(request: Request, body_iterator: AsyncIterator, timing: float) -> AsyncIterator:
+    first_chunk = True
+    async for chunk in body_iterator:
+        if first_chunk:
+            ttft = time.time() - timing
+            logger.debug(f"Route {ttft = }")
+            stats.summary("route_stream_ttft_seconds").observe(ttft)
+            first_chunk = False
+        yield chunk
+    
+    duration = time.time() - timing
+    logger.debug(f"Route stream {duration = }")
+    stats.summary("route_stream_total_seconds").observe(duration)
 
 class TimerRoute(APIRoute):
     def get_route_handler(self):
         route_handler = super().get_route_handler()
+        # set by `body_limit` on upload endpoints
+        max_body = getattr(self.endpoint, "max_body_bytes", None)
         async def app(request: Request) -> Response:
             timing = time.time()
-            response: Response = await route_handler(request)
+            if max_body is not None:
+                request = limit_body(request, max_body)
+            try:
+                response: Response = await route_handler(request)
+            except BodyTooLarge as e:
+                raise body_too_large(e.max_bytes)
             duration = time.time() - timing
             if request.method in ["POST", "DELETE", "PUT"]:
                 logger.info(f"Received request: {request.method} - {request.url}")
                 logger.debug(f"Route {duration = }")
                 response.headers["X-Response-Time"] = str(duration)
             
+            # streamed bodies are produced after the handler returns, time them separately
+            if isinstance(response, StreamingResponse):
+                response.body_iterator = timed_body_iterator(request, response.body_iterator, timing)
+            
             return response
         return app
@@ -13,11 +13,11 @@ class AppLifecycle:
 
     async def start(self):
         """Start the application lifecycle."""
-        pass
+        await self.app.anki_assistant.start()
 
     async def stop(self):
         """Clean up resources when the application stops."""
-        pass
+        await self.app.anki_assistant.close()
 
     async def __aenter__(self):
         await self.init()
@@ -1,70 +1,620 @@
-from typing import List, Annotated, Tuple, Optional, Callable, Any
-from PIL import Image
-from functools import wraps
+import asyncio
+import multiprocessing as mp
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Annotated, Tuple, Optional, Callable, Any, Dict, AsyncIterator, Sequence, Set
+from functools import partial, wraps
 
+import numpy as np
 from fastapi import Request, Depends
+from PIL import UnidentifiedImageError
 
+from src.app.core.batching import BatchScheduler
+from src.app.core.cache import ResponseCache, normalize_prompt
+from src.app.core.coalescing import SingleFlight, hash_bytes
+from src.app.core.executor import InferenceExecutor
+from src.app.core.jobs import BulkJobManager, JobStore
+from src.app.core.request_context import RequestContext
+from src.app.core.scheduling import ClientLimiter
+from src.app.core.semantic_cache import SemanticCache
+from src.app.core.sessions import ChatSession, ChatSessionManager
+from src.app.core.upload_store import StoredUpload, UploadStore
+from src.app.core.uploads import decode_image
+from src.app.exceptions.exception import ChatbotException
 from src.engine.chatbot import AnkiAssistant
+from src.engine.inference_server import InferenceServer, RemoteAssistant, authkey_from_env
+from src.engine.models.cancellation import GenerationCancelled
+from src.engine.models.model_chat import GwenModel
+from src.engine.models.model_embedding import SentenceEmbeddingModel
+from src.engine.models.model_vision import GwenVisionModel
+from src.engine.models.video_sampling import VideoFrameCache, probe_video, sample_frames_to_file
+from src.engine.models.visual_budget import VisualBudgetExceeded, VisualTokenBudget, image_tokens
+from src.engine.models.vision_cache import ImageSource
+from src.helpers.metrics.stats import stats
 from src.settings import settings
 
 Error_t = Optional[str]
 
-def lazy_load_assistant(func):
-    def wrapper(self, *args, **kwargs):
-        if not hasattr(self, "assistant"):
-            self.assistant = self._build_assistant()
-        return func(self, *args, **kwargs)
-    return wrapper
+def resolve_system_prompt() -> str:
+    if settings.CHAT_SYSTEM_PROMPT_FILE:
+        with open(settings.CHAT_SYSTEM_PROMPT_FILE, "r", encoding="utf-8") as f:
+            return f.read().strip()
+    return settings.CHAT_SYSTEM_PROMPT or GwenModel.SYSTEM_PROMPT
 
 def handle_exception(func: Callable) -> Callable:
     @wraps(func)
     async def wrapper(self, *args, **kwargs) -> Tuple[Any, Error_t]:
         try:
             return (await func(self, *args, **kwargs), None)
+        except ChatbotException:
+            # already carries its own http status (e.g. overload), let the handler render it
+            raise
+        except GenerationCancelled as e:
+            raise ChatbotException.client_closed_request_exception(message=str(e))
         except Exception as e:
             return (None, str(e))
     return wrapper
 
+def build_assistant(system_prompt: str, preload: bool = True) -> AnkiAssistant:
+    return AnkiAssistant(
+        cache_dir=settings.CACHE_DIR,
+        device_ids=[str(did) for did in settings.GPU_DEVICES_ID],
+        chat_model_name=settings.CHAT_MODEL_NAME,
+        chat_max_token=settings.MAX_NEW_TOKEN_CHAT_MODEL,
+        vision_model_name=settings.VISION_MODEL_NAME,
+        vision_max_token=settings.MAX_NEW_TOKEN_VISION_MODEL,
+        enable_vision_model=settings.ENABLE_VISION_MODEL,
+        distributed=settings.DISTRIBUTED,
+        chat_system_prompt=system_prompt,
+        chat_prefix_cache=settings.CHAT_PREFIX_CACHE,
+        chat_session_budget_mb=settings.CHAT_SESSION_KV_BUDGET_MB,
+        vision_encoder_cache_mb=settings.VISION_ENCODER_CACHE_MB,
+        vision_encoder_cache_spill=settings.VISION_ENCODER_CACHE_SPILL,
+        vision_encoder_cache_spill_mb=settings.VISION_ENCODER_CACHE_SPILL_MB,
+        offline=settings.MODELS_OFFLINE,
+        preload=preload,
+        idle_unload_seconds=settings.MODEL_IDLE_UNLOAD_SECONDS,
+        memory_unload_threshold=settings.MODEL_MEMORY_UNLOAD_THRESHOLD,
+        chat_replicas=settings.CHAT_REPLICAS,
+        vision_replicas=settings.VISION_REPLICAS,
+        replica_routing=settings.REPLICA_ROUTING,
+        backend=settings.INFERENCE_BACKEND,
+        cpu_precision=settings.CPU_BACKEND_PRECISION,
+        cpu_threads=settings.CPU_BACKEND_THREADS,
+        chat_draft_model_name=settings.CHAT_DRAFT_MODEL_NAME,
+        speculative_min_acceptance=settings.SPECULATIVE_MIN_ACCEPTANCE
+    )
+
+def _replicas(count: int) -> int:
+    return 1 if settings.DISTRIBUTED else max(1, count)
+
+def chat_concurrency() -> int:
+    # CHAT_MAX_CONCURRENCY generations on each replica
+    return settings.CHAT_MAX_CONCURRENCY * _replicas(settings.CHAT_REPLICAS)
+
+def vision_concurrency() -> int:
+    return settings.VISION_MAX_CONCURRENCY * _replicas(settings.VISION_REPLICAS)
+
+def inference_address() -> str:
+    return settings.INFERENCE_SOCKET or os.path.join(settings.CACHE_DIR, "inference.sock")
+
+def serve_inference():
+    """Entry point of the inference server process: loads the models once and serves them to the HTTP workers."""
+    residency_rules = settings.MODEL_IDLE_UNLOAD_SECONDS > 0 or settings.MODEL_MEMORY_UNLOAD_THRESHOLD > 0
+    server = InferenceServer(
+        assistant=build_assistant(resolve_system_prompt(), preload=not settings.LAZY_LOADING),
+        address=inference_address(),
+        authkey=authkey_from_env(),
+        concurrency={"chat": chat_concurrency(), "vision": vision_concurrency()},
+        sweep_seconds=settings.MODEL_RESIDENCY_CHECK_SECONDS if residency_rules else 0
+    )
+    server.serve_forever()
+
 class Engine(object):
     def __init__(
         self,
         lazy_loading: bool = False
     ):        
-        if not lazy_loading:
-            self.assistant = self._build_assistant()
-
-    def _build_assistant(self) -> AnkiAssistant:
-        return AnkiAssistant(
-            cache_dir=settings.CACHE_DIR,
-            device_ids=[str(did) for did in settings.GPU_DEVICES_ID],
-            chat_model_name=settings.CHAT_MODEL_NAME,
-            chat_max_token=settings.MAX_NEW_TOKEN_CHAT_MODEL,
-            vision_model_name=settings.VISION_MODEL_NAME,
-            vision_max_token=settings.MAX_NEW_TOKEN_VISION_MODEL,
-            enable_vision_model=settings.ENABLE_VISION_MODEL,
-            distributed=settings.DISTRIBUTED
-        )
-    
-    @lazy_load_assistant
+        self.system_prompt = resolve_system_prompt()
+        self.chat_executor = InferenceExecutor(
+            name="chat",
+            max_concurrency=chat_concurrency(),
+            max_queue_size=settings.INFERENCE_QUEUE_SIZE
+        )
+        self.vision_executor = InferenceExecutor(
+            name="vision",
+            max_concurrency=vision_concurrency(),
+            max_queue_size=settings.INFERENCE_QUEUE_SIZE
+        )
+        self.decode_executor = InferenceExecutor(
+            name="image_decode",
+            max_concurrency=settings.IMAGE_DECODE_WORKERS,
+            max_queue_size=settings.INFERENCE_QUEUE_SIZE
+        )
+        # frames are sampled in separate processes (no GIL contention with the web workers), each call
+        # occupying one thread of video_decode_executor, which brings queueing, priorities and deadlines
+        self.video_decode_executor = InferenceExecutor(
+            name="video_decode",
+            max_concurrency=settings.VIDEO_DECODE_WORKERS,
+            max_queue_size=settings.INFERENCE_QUEUE_SIZE
+        )
+        self._video_processes = ProcessPoolExecutor(
+            max_workers=max(1, settings.VIDEO_DECODE_WORKERS),
+            mp_context=mp.get_context("spawn")
+        )
+        self.video_frames = VideoFrameCache(
+            cache_dir=os.path.join(settings.CACHE_DIR, "video_frames"),
+            max_bytes=settings.VIDEO_FRAME_CACHE_MB * 1024 * 1024
+        )
+        self.visual_budget = VisualTokenBudget(
+            max_tokens=settings.VISUAL_TOKEN_BUDGET,
+            min_tokens=settings.VISUAL_TOKEN_BUDGET_MIN,
+            halving_queue_depth=settings.VISUAL_TOKEN_BUDGET_HALVING_DEPTH
+        )
+        self.video_uploads = UploadStore(
+            name="video_upload",
+            root=os.path.join(settings.CACHE_DIR, "uploaded_videos"),
+            max_bytes=settings.VIDEO_UPLOAD_STORE_MB * 1024 * 1024
+        )
+        self.chat_batcher = BatchScheduler(
+            name="chat",
+            batch_fn=self._answer_batch,
+            max_batch_size=settings.CHAT_BATCH_MAX_SIZE,
+            batch_window_ms=settings.CHAT_BATCH_WINDOW_MS,
+            max_concurrent_batches=chat_concurrency(),
+            max_queue_size=settings.INFERENCE_QUEUE_SIZE * settings.CHAT_BATCH_MAX_SIZE
+        )
+        self.response_cache = ResponseCache(
+            name="answer",
+            max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES,
+            ttl_seconds=settings.RESPONSE_CACHE_TTL_SECONDS,
+            disk_dir=os.path.join(settings.CACHE_DIR, "response_cache") if settings.RESPONSE_CACHE_DISK else None
+        ) if settings.RESPONSE_CACHE_ENABLED else None
+        self.semantic_cache = SemanticCache(
+            embedder_factory=lambda: SentenceEmbeddingModel(
+                model_name=settings.SEMANTIC_CACHE_MODEL_NAME,
+                cache_dir=settings.CACHE_DIR,
+                offline=settings.MODELS_OFFLINE
+            ),
+            namespace=ResponseCache.make_key(**self._generation_signature()),
+            threshold=settings.SEMANTIC_CACHE_THRESHOLD,
+            max_entries=settings.SEMANTIC_CACHE_MAX_ENTRIES,
+            nprobe=settings.SEMANTIC_CACHE_NPROBE,
+            path=os.path.join(settings.CACHE_DIR, "semantic_cache", "index")
+        ) if settings.SEMANTIC_CACHE_ENABLED else None
+        self.embedding_executor = InferenceExecutor(
+            name="embedding",
+            max_concurrency=1,
+            max_queue_size=settings.INFERENCE_QUEUE_SIZE
+        )
+        self.semantic_batcher = BatchScheduler(
+            name="semantic_cache",
+            batch_fn=self._semantic_lookup_batch,
+            max_batch_size=64,
+            batch_window_ms=settings.CHAT_BATCH_WINDOW_MS,
+            max_queue_size=settings.INFERENCE_QUEUE_SIZE * 64
+        )
+        self.answer_flights = SingleFlight("answer") if settings.COALESCE_REQUESTS else None
+        self.vision_flights = SingleFlight("vision") if settings.COALESCE_REQUESTS else None
+        self.client_limiter = ClientLimiter(settings.MAX_CONCURRENT_REQUESTS_PER_CLIENT)
+        self.jobs = BulkJobManager(
+            store=JobStore(os.path.join(settings.CACHE_DIR, "jobs.sqlite3")),
+            answer_fn=self.answer,
+            concurrency=settings.BULK_JOB_CONCURRENCY,
+            max_items=settings.BULK_JOB_MAX_ITEMS,
+            lock_path=os.path.join(settings.CACHE_DIR, "jobs.lock")
+        )
+        self.sessions = ChatSessionManager(
+            ttl_seconds=settings.CHAT_SESSION_TTL_SECONDS,
+            on_close=self._release_session
+        )
+        if settings.INFERENCE_SERVER:
+            # the models live in the inference server process, shared by every HTTP worker
+            self.assistant = RemoteAssistant(inference_address(), authkey_from_env())
+        else:
+            # models load on first use when lazy, and are unloaded again when idle or short of memory
+            self.assistant = build_assistant(self.system_prompt, preload=not lazy_loading)
+        self._sweeper: Optional[asyncio.Task] = None
+        self._semantic_trainer: Optional[asyncio.Task] = None
+
+    async def start(self):
+        # resume bulk jobs interrupted by the last shutdown
+        await self.jobs.start()
+        residency_rules = settings.MODEL_IDLE_UNLOAD_SECONDS > 0 or settings.MODEL_MEMORY_UNLOAD_THRESHOLD > 0
+        if isinstance(self.assistant, AnkiAssistant) and residency_rules:
+            self._sweeper = asyncio.create_task(self._sweep_models())
+        if self.semantic_cache is not None:
+            self._semantic_trainer = asyncio.create_task(self._train_semantic_cache())
+
+    async def _sweep_models(self):
+        while True:
+            await asyncio.sleep(settings.MODEL_RESIDENCY_CHECK_SECONDS)
+            await asyncio.to_thread(self.assistant.residency.sweep)
+
+    async def _train_semantic_cache(self):
+        # clustering a large index takes seconds: never on a request's path
+        while True:
+            await asyncio.sleep(settings.SEMANTIC_CACHE_TRAIN_CHECK_SECONDS)
+            await asyncio.to_thread(self.semantic_cache.train)
+
+    async def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+        if self._semantic_trainer is not None:
+            self._semantic_trainer.cancel()
+        await self.jobs.stop()
+        await self.chat_batcher.stop()
+        await self.semantic_batcher.stop()
+        self.chat_executor.shutdown()
+        self.vision_executor.shutdown()
+        self.decode_executor.shutdown()
+        self.video_decode_executor.shutdown()
+        self._video_processes.shutdown(wait=False, cancel_futures=True)
+        self.embedding_executor.shutdown()
+        if self.semantic_cache is not None:
+            self.semantic_cache.save()
+        if isinstance(self.assistant, RemoteAssistant):
+            self.assistant.close()
+
+    def health(self) -> Dict[str, Any]:
+        """Cheap load report for load balancers: requests waiting and running, and how many can run at once."""
+        return {
+            "status": "ok",
+            "queue_depth": self.chat_batcher.queue_depth + self.chat_executor.queue_depth + self.vision_executor.queue_depth,
+            "running": self.chat_executor.running + self.vision_executor.running,
+            "capacity": chat_concurrency() + vision_concurrency()
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        snapshot = stats.snapshot()
+        if isinstance(self.assistant, RemoteAssistant):
+            snapshot["inference_server"] = self.assistant.stats()
+        return snapshot
+
+    def _generation_signature(self) -> Dict[str, Any]:
+        return dict(
+            model=settings.CHAT_MODEL_NAME,
+            system_prompt=self.system_prompt,
+            max_new_tokens=settings.MAX_NEW_TOKEN_CHAT_MODEL
+        )
+
+    def _answer_cache_key(self, prompt: str) -> str:
+        return ResponseCache.make_key(prompt=normalize_prompt(prompt), **self._generation_signature())
+
+    async def _semantic_lookup_batch(self, prompts: List[str]) -> List[Tuple[Optional[str], Any]]:
+        return await self.embedding_executor.run(self.semantic_cache.lookup, prompts)
+
+    async def _answer_batch(self, items: List[Tuple[str, RequestContext]]) -> List[str]:
+        prompts, contexts = zip(*items)
+        return await self.chat_executor.run(
+            self.assistant.answer_batch,
+            list(prompts),
+            cancel_tokens=[context.cancel_token for context in contexts]
+        )
+
+    @handle_exception
+    async def answer(self, prompt: str, use_cache: bool = True, context: Optional[RequestContext] = None) -> str:
+        context = context if context is not None else RequestContext()
+        cache_key = self._answer_cache_key(prompt)
+        if use_cache and self.response_cache is not None:
+            if (cached := await self.response_cache.get(cache_key)) is not None:
+                return cached
+
+        # near-duplicates of an answered prompt (casing, whitespace, word order...)
+        vector = None
+        if use_cache and self.semantic_cache is not None:
+            cached, vector = await self.semantic_batcher.submit(prompt)
+            if cached is not None:
+                return cached
+
+        # identical prompts already being generated are shared unless the caller asked for a fresh answer
+        if use_cache and self.answer_flights is not None:
+            answer = await self.answer_flights.do(cache_key, lambda flight: self.chat_batcher.submit((prompt, flight), flight), context)
+        else:
+            answer = await self.chat_batcher.submit((prompt, context), context)
+        
+        # a cancelled generation stopped early, its (partial) answer must not be cached
+        context.raise_if_cancelled()
+        if use_cache and self.response_cache is not None:
+            self.response_cache.set(cache_key, answer)
+        if vector is not None:
+            self.semantic_cache.add(vector, answer)
+        return answer
+
+    async def _run_vision(self, fn: Callable, *args, context: RequestContext, images: Sequence[ImageSource] = (), **kwargs) -> str:
+        await self._decode_uncached(images, context, kwargs.get("resized_height"))
+        return await self.vision_executor.run(fn, *args, cancel_token=context.cancel_token, context=context, **kwargs)
+
+    async def _coalesce_vision(self, key: str, context: RequestContext, images: Sequence[ImageSource], fn: Callable, *args, **kwargs) -> str:
+        if self.vision_flights is None:
+            answer = await self._run_vision(fn, *args, context=context, images=images, **kwargs)
+        else:
+            answer = await self.vision_flights.do(key, lambda flight: self._run_vision(fn, *args, context=flight, images=images, **kwargs), context)
+        context.raise_if_cancelled()
+        return answer
+
+    async def answer_stream(self, prompt: str, use_cache: bool = True, context: Optional[RequestContext] = None) -> AsyncIterator[str]:
+        """Starts a generation and returns an iterator over decoded text pieces as the model produces them.
+        Overload is reported here, before any piece is sent. Closing the iterator early cancels the generation."""
+        context = context if context is not None else RequestContext()
+        cache_key = self._answer_cache_key(prompt) if use_cache and self.response_cache is not None else None
+        if cache_key is not None and (cached := await self.response_cache.get(cache_key)) is not None:
+            return self._replay_stream(cached)
+
+        self.chat_executor.ensure_capacity(context)
+        
+        loop = asyncio.get_running_loop()
+        pieces: asyncio.Queue = asyncio.Queue()
+        on_text = lambda text: loop.call_soon_threadsafe(pieces.put_nowait, text)
+
+        timing = time.monotonic()
+        generation = asyncio.ensure_future(self.chat_executor.run(
+            self.assistant.answer_stream,
+            prompt,
+            on_text,
+            cancel_token=context.cancel_token,
+            context=context
+        ))
+        # text callbacks are scheduled before the executor future resolves, so the sentinel always comes last
+        generation.add_done_callback(lambda _: pieces.put_nowait(None))
+        return self._drain_stream(pieces, generation, timing, cache_key, context)
+
+    async def _replay_stream(self, answer: str) -> AsyncIterator[str]:
+        yield answer
+
+    async def _drain_stream(
+        self,
+        pieces: asyncio.Queue,
+        generation: asyncio.Future,
+        timing: float,
+        cache_key: Optional[str],
+        context: RequestContext
+    ) -> AsyncIterator[str]:
+        try:
+            first_piece = True
+            while (piece := await pieces.get()) is not None:
+                if first_piece:
+                    stats.summary("chat_stream_ttft_seconds").observe(time.monotonic() - timing)
+                    first_piece = False
+                yield piece
+            
+            answer = await generation
+        finally:
+            # the consumer went away (client disconnected): stop generating for nobody
+            if not generation.done():
+                context.cancel_token.cancel()
+                generation.add_done_callback(lambda done: done.cancelled() or done.exception())
+        
+        stats.summary("chat_stream_total_seconds").observe(time.monotonic() - timing)
+        if cache_key is not None and not context.cancelled:
+            self.response_cache.set(cache_key, answer)
+
+    def _plan_images(self, images: Sequence[ImageSource]) -> int:
+        """Height to resize `images` to so that they fit the visual-token budget at the current load."""
+        try:
+            sizes = [image.size for image in images]
+        except (UnidentifiedImageError, OSError) as e:
+            raise ChatbotException.unprocessable_exception(message=f"Cannot decode image: {e}")
+        try:
+            return self.visual_budget.plan_images(sizes, GwenVisionModel.FIXED_RESIZED_HEIGHT, self.vision_executor.queue_depth)
+        except VisualBudgetExceeded as e:
+            raise ChatbotException.request_entity_too_large(message=str(e))
+
+    async def _plan_video(self, video: StoredUpload, fps: float, max_pixels: int, context: RequestContext) -> Tuple[float, int]:
+        """Sampling rate and frame size, at most the requested ones, fitting the visual-token budget at the current load."""
+        try:
+            total_frames, rate, height, width = await self.video_decode_executor.run(probe_video, video.path, context=context)
+            fps, max_pixels = self.visual_budget.plan_video(
+                total_frames, rate, height, width, fps, max_pixels, self.vision_executor.queue_depth
+            )
+        except VisualBudgetExceeded as e:
+            raise ChatbotException.request_entity_too_large(message=str(e))
+        except ValueError as e:
+            raise ChatbotException.unprocessable_exception(message=str(e))
+        # rounded so that cache keys of reduced plans repeat
+        return round(fps, 3), max_pixels
+
+    def image_source(self, data: bytes) -> ImageSource:
+        """Wraps uploaded image bytes; decoding, reduced to about the size the vision model works at, happens later."""
+        return ImageSource(hash_bytes(data), data, partial(decode_image, target_height=GwenVisionModel.FIXED_RESIZED_HEIGHT))
+
+    async def _decode_uncached(self, images: Sequence[ImageSource], context: Optional[RequestContext] = None, resized_height: Optional[int] = None):
+        """Decodes, on the decode pool, the images the vision model has no preprocessed form of."""
+        images = [image for image in images if image.image is None and not self.assistant.is_image_cached(image, resized_height)]
+        decoded = await asyncio.gather(*[
+            self.decode_executor.run(image.load, context=context)
+            for image in images
+        ])
+        stats.counter("image_decoded").inc(len(decoded))
+
+    def _release_session(self, session_id: str):
+        self.assistant.close_session(session_id)
+
+    def create_session(self) -> ChatSession:
+        return self.sessions.create()
+
+    def get_session(self, session_id: str) -> ChatSession:
+        return self.sessions.get(session_id)
+
+    def close_session(self, session_id: str) -> ChatSession:
+        return self.sessions.close(session_id)
+
     @handle_exception
-    async def answer(self, prompt: str) -> str:
-        return self.assistant.answer(prompt)
+    async def answer_session(self, session_id: str, prompt: str, context: Optional[RequestContext] = None) -> str:
+        context = context if context is not None else RequestContext()
+        session = self.sessions.get(session_id)
+        # turns of one session are answered in order, each one extends the previous cache
+        async with session.lock:
+            messages = [*session.messages, {"role": "user", "content": prompt}]
+            answer = await self.chat_executor.run(
+                self.assistant.answer_session,
+                session_id,
+                messages,
+                cancel_token=context.cancel_token,
+                context=context
+            )
+            # a cancelled turn is not part of the conversation
+            context.raise_if_cancelled()
+            session.messages = [*messages, {"role": "assistant", "content": answer}]
+        return answer
 
-    @lazy_load_assistant
     @handle_exception
-    async def describe_image(self, image: Image.Image) -> str:
-        return self.assistant.describe_image(image)
+    async def describe_image(self, image: ImageSource, context: Optional[RequestContext] = None) -> str:
+        key = f"describe-image:{image.key}"
+        resized_height = self._plan_images([image])
+        return await self._coalesce_vision(key, context or RequestContext(), [image], self.assistant.describe_image, image, resized_height=resized_height)
 
-    @lazy_load_assistant
     @handle_exception
-    async def analyse_images_with_prompt(self, images: List[Image.Image], prompt: str) -> str:
-        return self.assistant.analyse_images_with_prompt(images, prompt)
+    async def analyse_images_with_prompt(
+        self,
+        images: List[ImageSource],
+        prompt: str,
+        context: Optional[RequestContext] = None
+    ) -> str:
+        key = ResponseCache.make_key(images=[image.key for image in images], prompt=normalize_prompt(prompt))
+        resized_height = self._plan_images(images)
+        return await self._coalesce_vision(
+            key,
+            context or RequestContext(),
+            images,
+            self.assistant.analyse_images_with_prompt,
+            images,
+            prompt,
+            resized_height=resized_height
+        )
+
+    async def _sample_video(self, video: StoredUpload, fps: float, max_pixels: int, context: Optional[RequestContext] = None) -> np.ndarray:
+        """Frames of `video` sampled at `fps` and `max_pixels`, from the frame cache or a decode process."""
+        key = VideoFrameCache.make_key(video.digest, fps, max_pixels)
+        frames = self.video_frames.get(key)
+        if frames is None:
+            timing = time.monotonic()
+            await self.video_decode_executor.run(self._sample_in_process, video.path, self.video_frames.path(key), fps, max_pixels, context=context)
+            stats.summary("video_sampling_seconds").observe(time.monotonic() - timing)
+            frames = self.video_frames.added(key)
+        return frames
+
+    async def _describe_video(self, video: StoredUpload, fps: float, max_pixels: int, context: RequestContext) -> str:
+        frames = await self._sample_video(video, fps, max_pixels, context)
+        return await self._run_vision(self.assistant.describe_video, frames, context=context)
+
+    def _sample_in_process(self, video: str, out_path: str, fps: float, max_pixels: int):
+        return self._video_processes.submit(sample_frames_to_file, video, out_path, fps, max_pixels).result()
+
+    def analyse_batch(
+        self,
+        items: List[Tuple[List[ImageSource], str]],
+        context: Optional[RequestContext] = None
+    ) -> AsyncIterator[Tuple[int, Optional[str], Optional[ChatbotException]]]:
+        """Answers many (images, prompt) items in padded batches, yielding (index, answer, error) per item as
+        its batch completes. Items of similar length are batched together; a batch holds at most
+        VISION_BATCH_MAX_SIZE items and as many tokens as the model has memory for."""
+        return self._analyse_batch(items, context if context is not None else RequestContext())
+
+    def _plan_vision_batches(self, items: List[Tuple[int, List[ImageSource], str, int]]) -> List[List[Tuple[int, List[ImageSource], str, int]]]:
+        capacity = self.assistant.vision_batch_capacity(settings.VISION_BATCH_MAX_TOKENS)
+        # rough prompt length: chat template plus about 3 characters per token
+        estimate = lambda item: image_tokens(item[3], [image.size for image in item[1]]) + len(item[2]) // 3 + 32
+        batches, batch, longest = [], [], 0
+        for item in sorted(items, key=estimate):
+            length = estimate(item) + settings.MAX_NEW_TOKEN_VISION_MODEL
+            # rows are padded to the longest one
+            if batch and ((len(batch) + 1) * max(longest, length) > capacity or len(batch) >= settings.VISION_BATCH_MAX_SIZE):
+                batches.append(batch)
+                batch, longest = [], 0
+            batch.append(item)
+            longest = max(longest, length)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def _run_vision_batch(self, batch: List[Tuple[int, List[ImageSource], str, int]], context: RequestContext) -> List[Tuple[int, Optional[str], Optional[ChatbotException]]]:
+        indices = [index for index, _, _, _ in batch]
+        try:
+            for _, images, _, height in batch:
+                await self._decode_uncached(images, context, height)
+            answers = await self.vision_executor.run(
+                self.assistant.analyse_batch,
+                [(images, prompt, height) for _, images, prompt, height in batch],
+                cancel_tokens=[context.cancel_token] * len(batch),
+                context=context
+            )
+        except ChatbotException as e:
+            return [(index, None, e) for index in indices]
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            return [(index, None, ChatbotException.unprocessable_exception(message=str(e))) for index in indices]
+        stats.counter("vision_batch_items").inc(len(batch))
+        return [(index, answer, None) for index, answer in zip(indices, answers)]
+
+    async def _analyse_batch(
+        self,
+        items: List[Tuple[List[ImageSource], str]],
+        context: RequestContext
+    ) -> AsyncIterator[Tuple[int, Optional[str], Optional[ChatbotException]]]:
+        planned = []
+        for index, (images, prompt) in enumerate(items):
+            try:
+                planned.append((index, images, prompt, self._plan_images(images)))
+            except ChatbotException as e:
+                yield index, None, e
+
+        # a batch waiting behind each running one keeps the model busy without flooding its queue
+        window = vision_concurrency() + 1
+        batches = self._plan_vision_batches(planned)
+        running: Set[asyncio.Task] = set()
+        try:
+            while batches or running:
+                while batches and len(running) < window:
+                    running.add(asyncio.ensure_future(self._run_vision_batch(batches.pop(0), context)))
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    for result in task.result():
+                        yield result
+        finally:
+            # the consumer went away (client disconnected): drop the remaining batches
+            if running:
+                context.cancel_token.cancel()
+                for task in running:
+                    task.add_done_callback(lambda done: done.cancelled() or done.exception())
 
-    @lazy_load_assistant
     @handle_exception
-    async def describe_video(self, video: str, **kwargs) -> str:
-        return self.assistant.describe_video(video, **kwargs)      
-    
+    async def describe_video(self, video: StoredUpload, context: Optional[RequestContext] = None, **kwargs) -> str:
+        """Describes a stored upload, held by the caller (as `UploadStore.save` returns it); the description is
+        kept with it, so the same content is only described once."""
+        context = context if context is not None else RequestContext()
+        fps, max_pixels = await self._plan_video(
+            video,
+            fps=kwargs.get("fps", settings.VIDEO_SAMPLE_FPS),
+            max_pixels=kwargs.get("resolution", settings.VIDEO_MAX_PIXELS),
+            context=context
+        )
+        result_key = ResponseCache.make_key(
+            task="describe-video",
+            model=settings.VISION_MODEL_NAME,
+            max_new_tokens=settings.MAX_NEW_TOKEN_VISION_MODEL,
+            fps=fps,
+            max_pixels=max_pixels
+        )
+        if (answer := self.video_uploads.get_result(video, result_key)) is not None:
+            stats.counter("video_description_reused").inc()
+            return answer
+
+        # identical uploads in flight share sampling and inference
+        if self.vision_flights is None:
+            answer = await self._describe_video(video, fps, max_pixels, context)
+        else:
+            answer = await self.vision_flights.do(
+                f"describe-video:{video.digest}:{result_key}",
+                lambda flight: self._describe_video(video, fps, max_pixels, flight),
+                context
+            )
+        context.raise_if_cancelled()
+        self.video_uploads.set_result(video, result_key, answer)
+        return answer
+
 async def get_assistant(request: Request) -> Engine:
     return request.app.anki_assistant
 
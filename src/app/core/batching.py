@@ -0,0 +1,194 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Any, Awaitable, Callable, List, Optional, Set, Tuple
+
+from src.app.core.request_context import RequestContext
+from src.app.core.scheduling import ServiceTimeEstimator, check_deadline, estimate_wait
+from src.app.exceptions.exception import ChatbotException
+from src.engine.models.cancellation import GenerationCancelled
+from src.helpers.logging.logger import logger
+from src.helpers.metrics.stats import stats
+
+BatchFn_t = Callable[[List[Any]], Awaitable[List[Any]]]
+Entry_t = Tuple[Tuple[int, float], int, Any, Optional[RequestContext], asyncio.Future, float]
+
+class BatchScheduler(object):
+    """Collects requests arriving within `batch_window_ms` (up to `max_batch_size`)
+    and runs them through `batch_fn` as a single batch.
+
+    At most `max_concurrent_batches` batches are in flight, so requests arriving while
+    the model is busy pile up and form the next (bigger) batch. At most `max_queue_size`
+    requests may wait; anything beyond that is rejected immediately.
+
+    Waiting requests are batched by priority class, then earliest deadline, then arrival.
+    Requests that cannot meet their deadline are rejected on submit (from the measured
+    average batch duration); cancelled or expired ones are dropped when their batch is formed.
+    """
+    def __init__(
+        self,
+        name: str,
+        batch_fn: BatchFn_t,
+        max_batch_size: int = 8,
+        batch_window_ms: float = 10.0,
+        max_concurrent_batches: int = 1,
+        max_queue_size: int = 256
+    ):
+        self._name = name
+        self._batch_fn = batch_fn
+        self._max_batch_size = max(1, max_batch_size)
+        self._batch_window = max(0.0, batch_window_ms) / 1000
+        self._max_queue_size = max(1, max_queue_size)
+        self._max_concurrent_batches = max(1, max_concurrent_batches)
+        self._slots = asyncio.Semaphore(self._max_concurrent_batches)
+        self._heap: List[Entry_t] = []
+        self._sequence = itertools.count()
+        self._arrived: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._inflight: Set[asyncio.Task] = set()
+        self._service_time = ServiceTimeEstimator()
+
+        self._batch_size = stats.summary(f"{name}_batch_size")
+        self._queue_wait = stats.summary(f"{name}_batch_queue_wait_seconds")
+        self._batches = stats.counter(f"{name}_batches")
+        self._rejected = stats.counter(f"{name}_batch_rejected")
+        self._cancelled = stats.counter(f"{name}_batch_cancelled")
+        stats.gauge(f"{name}_batch_queue_depth", lambda: self.queue_depth)
+        stats.gauge(f"{name}_batch_service_seconds", lambda: self._service_time.value)
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._heap)
+
+    def estimate_completion(self, context: Optional[RequestContext] = None) -> Optional[float]:
+        """Estimated seconds until a request submitted now with `context` would be answered."""
+        key = context.sort_key if context is not None else (0, float("inf"))
+        ahead = sum(1 for entry in self._heap if entry[0] <= key)
+        batches = ahead // self._max_batch_size + len(self._inflight)
+        return estimate_wait(batches, self._max_concurrent_batches, self._service_time.value)
+
+    async def submit(self, item: Any, context: Optional[RequestContext] = None) -> Any:
+        self._ensure_worker()
+        if len(self._heap) >= self._max_queue_size:
+            self._rejected.inc()
+            raise ChatbotException.service_unavailable_exception(
+                message=f"The {self._name} queue is full, please retry later."
+            )
+        check_deadline(self._name, context, self.estimate_completion(context))
+
+        future = asyncio.get_running_loop().create_future()
+        key = context.sort_key if context is not None else (0, float("inf"))
+        heapq.heappush(self._heap, (key, next(self._sequence), item, context, future, time.monotonic()))
+        if context is not None:
+            context.add_sort_key_listener(self._resort)
+        self._arrived.set()
+        return await future
+
+    def _resort(self):
+        # the priority or deadline of a queued context changed (a shared call joined by another caller)
+        self._heap = [(entry[3].sort_key if entry[3] is not None else entry[0], *entry[1:]) for entry in self._heap]
+        heapq.heapify(self._heap)
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        for task in list(self._inflight):
+            task.cancel()
+
+    def _ensure_worker(self):
+        if self._arrived is None:
+            self._arrived = asyncio.Event()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def _wait_arrival(self, timeout: Optional[float] = None) -> bool:
+        self._arrived.clear()
+        try:
+            await asyncio.wait_for(self._arrived.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _collect(self) -> List[Entry_t]:
+        while not self._heap:
+            await self._wait_arrival()
+        batch = [heapq.heappop(self._heap)]
+        deadline = time.monotonic() + self._batch_window
+        while len(batch) < self._max_batch_size:
+            # take the most urgent of whatever is already queued, then wait for the rest of the window
+            if self._heap:
+                batch.append(heapq.heappop(self._heap))
+                continue
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or not await self._wait_arrival(timeout):
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            # wait for a free slot first so that requests keep accumulating while busy
+            await self._slots.acquire()
+            try:
+                batch = await self._collect()
+            except BaseException:
+                self._slots.release()
+                raise
+            task = asyncio.create_task(self._dispatch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._on_dispatched)
+
+    def _on_dispatched(self, task: asyncio.Task):
+        self._inflight.discard(task)
+        self._slots.release()
+
+    def _admit(self, context: Optional[RequestContext], future: asyncio.Future) -> bool:
+        if context is None:
+            return True
+        if context.cancelled:
+            self._cancelled.inc()
+            future.set_exception(GenerationCancelled("The request was cancelled before it started."))
+            return False
+        try:
+            check_deadline(self._name, context, None)
+        except ChatbotException as e:
+            future.set_exception(e)
+            return False
+        return True
+
+    async def _dispatch(self, batch: List[Entry_t]):
+        now = time.monotonic()
+        items, futures = [], []
+        for _, _, item, context, future, enqueued_at in batch:
+            # caller went away while queued
+            if future.done() or not self._admit(context, future):
+                continue
+            self._queue_wait.observe(now - enqueued_at)
+            items.append(item)
+            futures.append(future)
+
+        if not items:
+            return
+
+        self._batches.inc()
+        self._batch_size.observe(len(items))
+        logger.debug(f"[{self._name}] dispatching batch of {len(items)}, max queue wait {now - min(entry[5] for entry in batch):.4f}s")
+
+        try:
+            started_at = time.monotonic()
+            results = await self._batch_fn(items)
+            self._service_time.observe(time.monotonic() - started_at)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, result in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
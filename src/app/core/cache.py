@@ -0,0 +1,137 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional, Tuple
+
+from src.helpers.logging.logger import logger
+from src.helpers.metrics.stats import stats
+
+def normalize_prompt(prompt: str) -> str:
+    return " ".join(prompt.split())
+
+class ResponseCache(object):
+    """Exact-match cache: an in-memory LRU with TTL, optionally backed by one json file
+    per key under `disk_dir` so entries survive restarts.
+
+    Only the memory tier is used inline: disk reads run in a thread, and disk writes are queued
+    to a single writer thread, which also prunes the directory.
+    """
+    DISK_PRUNE_EVERY = 64
+
+    def __init__(
+        self,
+        name: str,
+        max_entries: int = 1024,
+        ttl_seconds: float = 86400,
+        disk_dir: Optional[str] = None,
+        disk_max_entries: int = 100000
+    ):
+        self._name = name
+        self._max_entries = max(1, max_entries)
+        self._ttl = ttl_seconds
+        self._disk_dir = disk_dir
+        self._disk_max_entries = disk_max_entries
+        self._disk_writes = 0
+        # key -> (value, expires_at); wall-clock expiry so the disk tier stays valid across restarts
+        self._entries: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._writer: Optional[ThreadPoolExecutor] = None
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._writer = ThreadPoolExecutor(1, thread_name_prefix=f"{name}-cache-writer")
+
+        self._hits = stats.counter(f"{name}_cache_hits")
+        self._disk_hits = stats.counter(f"{name}_cache_disk_hits")
+        self._misses = stats.counter(f"{name}_cache_misses")
+        self._evictions = stats.counter(f"{name}_cache_evictions")
+        stats.gauge(f"{name}_cache_entries", lambda: len(self._entries))
+
+    @staticmethod
+    def make_key(**parts) -> str:
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self._hits.inc()
+                    return entry[0]
+                del self._entries[key]
+
+        entry = await asyncio.to_thread(self._read_disk, key, now) if self._disk_dir else None
+        if entry is not None:
+            self._disk_hits.inc()
+            self._hits.inc()
+            self._put_memory(key, entry)
+            return entry[0]
+
+        self._misses.inc()
+        return None
+
+    def set(self, key: str, value: Any):
+        entry = (value, time.time() + self._ttl)
+        self._put_memory(key, entry)
+        if self._writer is not None:
+            self._writer.submit(self._write_disk, key, entry)
+
+    def _put_memory(self, key: str, entry: Tuple[Any, float]):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self._evictions.inc()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self._disk_dir, f"{key}.json")
+
+    def _read_disk(self, key: str, now: float) -> Optional[Tuple[Any, float]]:
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if record["expires_at"] <= now:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return (record["value"], record["expires_at"])
+
+    def _write_disk(self, key: str, entry: Tuple[Any, float]):
+        path = self._disk_path(key)
+        try:
+            # write then rename so readers never see a half-written file
+            with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                json.dump({"value": entry[0], "expires_at": entry[1]}, f, ensure_ascii=False)
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logger.warning(f"[{self._name}] failed to persist cache entry: {e}")
+            return
+
+        self._disk_writes += 1
+        if self._disk_writes % self.DISK_PRUNE_EVERY == 0:
+            self._prune_disk()
+
+    def _prune_disk(self):
+        entries = [entry for entry in os.scandir(self._disk_dir) if entry.name.endswith(".json")]
+        if len(entries) <= self._disk_max_entries:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - self._disk_max_entries]:
+            try:
+                os.remove(entry.path)
+                self._evictions.inc()
+            except OSError:
+                pass
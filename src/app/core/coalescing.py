@@ -0,0 +1,49 @@
+import asyncio
+import hashlib
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from src.app.core.request_context import RequestContext
+from src.helpers.metrics.stats import stats
+
+def hash_bytes(*blobs: bytes) -> str:
+    digest = hashlib.sha256()
+    for blob in blobs:
+        digest.update(hashlib.sha256(blob).digest())
+    return digest.hexdigest()
+
+class SingleFlight(object):
+    """Runs at most one call per key at a time: callers asking for a key that is already
+    in flight attach to that call and all of them receive its result.
+
+    The call gets its own context, cancelled only once every attached caller has been cancelled,
+    with the highest priority and the latest deadline among them (raised as callers attach).
+    """
+    def __init__(self, name: str):
+        self._flights: Dict[str, Tuple[asyncio.Future, RequestContext]] = {}
+        self._flights_started = stats.counter(f"{name}_flights")
+        self._coalesced = stats.counter(f"{name}_coalesced")
+        stats.gauge(f"{name}_flights_in_progress", lambda: len(self._flights))
+
+    async def do(self, key: str, fn: Callable[[RequestContext], Awaitable[Any]], context: Optional[RequestContext] = None) -> Any:
+        context = context if context is not None else RequestContext()
+        if key in self._flights:
+            self._coalesced.inc()
+            flight, flight_context = self._flights[key]
+            flight_context.join(context)
+        else:
+            self._flights_started.inc()
+            flight_context = context.shared()
+            flight = asyncio.ensure_future(fn(flight_context))
+            self._flights[key] = (flight, flight_context)
+            flight.add_done_callback(lambda done: self._on_done(key, done))
+        flight_context.cancel_token.attach(context.cancel_token)
+        
+        # a caller going away must not cancel the call the others are waiting for
+        return await asyncio.shield(flight)
+
+    def _on_done(self, key: str, flight: asyncio.Future):
+        if key in self._flights and self._flights[key][0] is flight:
+            del self._flights[key]
+        # mark the exception as retrieved in case every caller went away
+        if not flight.cancelled():
+            flight.exception()
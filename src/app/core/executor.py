@@ -0,0 +1,141 @@
+import asyncio
+import heapq
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, List, Optional, Tuple
+
+from src.app.core.request_context import RequestContext
+from src.app.core.scheduling import ServiceTimeEstimator, check_deadline, estimate_wait
+from src.app.exceptions.exception import ChatbotException
+from src.engine.models.cancellation import GenerationCancelled
+from src.helpers.metrics.stats import stats
+
+class InferenceExecutor(object):
+    """Runs blocking model calls on a dedicated thread pool, off the event loop.
+
+    At most `max_concurrency` calls run at once and at most `max_queue_size` calls
+    wait for a slot; anything beyond that is rejected immediately so latency stays bounded.
+    Waiting calls are started by priority class, then earliest deadline, then arrival.
+    A call that cannot meet its deadline is rejected up front (from the measured average
+    call duration), and one whose `context` got cancelled while waiting is dropped.
+    """
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int = 1,
+        max_queue_size: int = 32
+    ):
+        self._name = name
+        self._max_concurrency = max(1, max_concurrency)
+        self._max_queue_size = max(0, max_queue_size)
+        self._pool = ThreadPoolExecutor(max_workers=self._max_concurrency, thread_name_prefix=f"inference-{name}")
+        self._waiters: List[Tuple[Tuple[int, float], int, asyncio.Future, Optional[RequestContext]]] = []
+        self._sequence = itertools.count()
+        self._waiting = 0
+        self._running = 0
+        self._service_time = ServiceTimeEstimator()
+
+        self._queue_wait = stats.summary(f"{name}_executor_queue_wait_seconds")
+        self._rejected = stats.counter(f"{name}_executor_rejected")
+        self._cancelled = stats.counter(f"{name}_executor_cancelled")
+        stats.gauge(f"{name}_executor_queue_depth", lambda: self._waiting)
+        stats.gauge(f"{name}_executor_running", lambda: self._running)
+        stats.gauge(f"{name}_executor_service_seconds", lambda: self._service_time.value)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._waiting
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def ensure_capacity(self, context: Optional[RequestContext] = None):
+        if self._running >= self._max_concurrency and self._waiting >= self._max_queue_size:
+            self._rejected.inc()
+            raise ChatbotException.service_unavailable_exception(
+                message=f"The {self._name} model is overloaded, please retry later."
+            )
+        check_deadline(self._name, context, self.estimate_completion(context))
+
+    def estimate_completion(self, context: Optional[RequestContext] = None) -> Optional[float]:
+        """Estimated seconds until a call submitted now with `context` would be done."""
+        if self._running < self._max_concurrency:
+            return self._service_time.value
+        key = context.sort_key if context is not None else (0, float("inf"))
+        ahead = sum(1 for waiter_key, _, future, _ in self._waiters if not future.done() and waiter_key <= key)
+        # every running call still has to finish too
+        return estimate_wait(ahead + self._running, self._max_concurrency, self._service_time.value)
+
+    async def run(self, fn: Callable[..., Any], *args, context: Optional[RequestContext] = None, **kwargs) -> Any:
+        self.ensure_capacity(context)
+
+        enqueued_at = time.monotonic()
+        self._waiting += 1
+        try:
+            await self._acquire(context)
+        finally:
+            self._waiting -= 1
+
+        self._queue_wait.observe(time.monotonic() - enqueued_at)
+        try:
+            if context is not None and context.cancelled:
+                self._cancelled.inc()
+                context.raise_if_cancelled()
+            # the deadline may have passed while waiting, no point in starting then
+            check_deadline(self._name, context, None)
+            started_at = time.monotonic()
+            loop = asyncio.get_running_loop()
+            execution = self._pool.submit(partial(fn, *args, **kwargs))
+        except BaseException:
+            self._release()
+            raise
+        # the slot is freed once the thread is done, not when the caller stops waiting (a cancelled task)
+        execution.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+        result = await asyncio.wrap_future(execution)
+        self._service_time.observe(time.monotonic() - started_at)
+        return result
+
+    async def _acquire(self, context: Optional[RequestContext]):
+        # with a free slot nobody can be waiting: released slots are handed to waiters directly
+        if self._running < self._max_concurrency:
+            self._running += 1
+            return
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = context.sort_key if context is not None else (0, float("inf"))
+        heapq.heappush(self._waiters, (key, next(self._sequence), future, context))
+        if context is not None:
+            context.cancel_token.add_callback(lambda: loop.call_soon_threadsafe(self._drop_waiter, future))
+            context.add_sort_key_listener(self._resort)
+        try:
+            await future
+        except BaseException:
+            # a slot handed over just before the caller went away is passed on
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self._release()
+            raise
+
+    def _drop_waiter(self, future: asyncio.Future):
+        if not future.done():
+            self._cancelled.inc()
+            future.set_exception(GenerationCancelled("The request was cancelled before it started."))
+
+    def _resort(self):
+        # the priority or deadline of a waiting context changed (a shared call joined by another caller)
+        self._waiters = [(context.sort_key if context is not None else key, sequence, future, context) for key, sequence, future, context in self._waiters]
+        heapq.heapify(self._waiters)
+
+    def _release(self):
+        while self._waiters:
+            _, _, future, _ = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._running -= 1
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,268 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+
+from src.app.core.cache import normalize_prompt
+from src.app.exceptions.exception import ChatbotException
+from src.helpers.logging.logger import logger
+from src.helpers.metrics.stats import stats
+
+# routes whose answers are cached by prompt: the same prompt always goes to the same backend
+HASHED_ROUTES = {"llm/answer", "llm/answer-stream"}
+# routes creating state that lives in one backend, and the field of the response naming it
+PINNING_ROUTES = {"llm/sessions": ("sessions", "session_id"), "jobs": ("jobs", "job_id")}
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer",
+    "transfer-encoding", "upgrade", "host", "content-length"
+}
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:8], "big")
+
+class HashRing(object):
+    """Consistent hashing: each backend owns `virtual_nodes` points of a ring and a key belongs to the first
+    point after its hash, so removing a backend only moves the keys it owned."""
+    def __init__(self, backends: List[str], virtual_nodes: int = 64):
+        points = sorted((_hash(f"{backend}#{index}"), backend) for backend in backends for index in range(virtual_nodes))
+        self._hashes = [point for point, _ in points]
+        self._backends = [backend for _, backend in points]
+
+    def walk(self, key: str) -> Iterator[str]:
+        """Distinct backends in ring order from `key`: its owner first, then where its keys would move."""
+        if not self._hashes:
+            return
+        start, seen = bisect.bisect(self._hashes, _hash(key)), set()
+        for offset in range(len(self._hashes)):
+            backend = self._backends[(start + offset) % len(self._hashes)]
+            if backend not in seen:
+                seen.add(backend)
+                yield backend
+
+class Backend(object):
+    """One AFAServer instance, as last seen by the health check and the requests sent to it."""
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.healthy = False
+        self.queue_depth = 0
+        self.running = 0
+        self.capacity = 1
+        self.in_flight = 0
+        self.checked_at: Optional[float] = None
+
+        name = f"gateway_backend_{self.url.split('://', 1)[-1]}"
+        self.requests = stats.counter(f"{name}_requests")
+        self.failures = stats.counter(f"{name}_failures")
+        stats.gauge(f"{name}_healthy", lambda: int(self.healthy))
+        stats.gauge(f"{name}_queue_depth", lambda: self.queue_depth)
+        stats.gauge(f"{name}_in_flight", lambda: self.in_flight)
+
+    @property
+    def load(self) -> float:
+        # reported at the last health check, plus what was sent since through this gateway
+        return (self.queue_depth + self.running + self.in_flight) / max(1, self.capacity)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "queue_depth": self.queue_depth,
+            "running": self.running,
+            "capacity": self.capacity,
+            "in_flight": self.in_flight,
+            "checked_seconds_ago": None if self.checked_at is None else time.monotonic() - self.checked_at
+        }
+
+class Gateway(object):
+    """Spreads the API over several AFAServer backends.
+
+    Backends are health-checked every `health_check_seconds` (their `/llm/health` reports queue depth).
+    `/llm/answer` requests go to the backend owning their normalized prompt on a consistent-hash ring,
+    where its caches are warm, unless that backend is down or has `max_queue_depth` requests queued, in
+    which case they move along the ring. Other requests go to the least loaded backend, and requests
+    about a session or a job to the backend that created it. A request that cannot be delivered, or that
+    the backend turns down as overloaded (503), is retried on the next candidate.
+    """
+    DISCONNECT_POLL_SECONDS = 0.25
+
+    def __init__(
+        self,
+        backends: List[str],
+        api_prefix: str = "",
+        health_check_seconds: float = 2.0,
+        max_queue_depth: int = 8,
+        timeout_seconds: float = 600,
+        virtual_nodes: int = 64,
+        max_pins: int = 100000
+    ):
+        if not backends:
+            raise ValueError("The gateway needs at least one backend.")
+        self.backends: Dict[str, Backend] = {backend.url: backend for backend in map(Backend, backends)}
+        self._ring = HashRing(list(self.backends), virtual_nodes)
+        self._api_prefix = api_prefix.strip("/")
+        self._health_check_seconds = health_check_seconds
+        self._max_queue_depth = max_queue_depth
+        self._client = httpx.AsyncClient(timeout=httpx.Timeout(timeout_seconds, connect=5.0))
+        # session/job id -> backend holding it, the least recently used forgotten beyond max_pins
+        self._pins: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+        self._max_pins = max_pins
+        self._checker: Optional[asyncio.Task] = None
+
+        self._failovers = stats.counter("gateway_failovers")
+        self._hashed = stats.counter("gateway_hashed_requests")
+        self._spilled = stats.counter("gateway_hashed_spilled")
+
+    async def start(self):
+        await self._check_all()
+        self._checker = asyncio.create_task(self._check_forever())
+
+    async def close(self):
+        if self._checker is not None:
+            self._checker.cancel()
+        await self._client.aclose()
+
+    def status(self) -> Dict[str, Any]:
+        return {"backends": [backend.status() for backend in self.backends.values()], "pins": len(self._pins)}
+
+    async def _check(self, backend: Backend):
+        try:
+            response = await self._client.get(f"{backend.url}/{self._api_prefix}/llm/health", timeout=max(1.0, self._health_check_seconds))
+            response.raise_for_status()
+            health = response.json()["data"]
+            backend.queue_depth, backend.running, backend.capacity = health["queue_depth"], health["running"], health["capacity"]
+            if not backend.healthy:
+                logger.info(f"Backend {backend.url} is up")
+            backend.healthy = True
+        except Exception as e:
+            if backend.healthy:
+                logger.warning(f"Backend {backend.url} is down: {e}")
+            backend.healthy = False
+        backend.checked_at = time.monotonic()
+
+    async def _check_all(self):
+        await asyncio.gather(*(self._check(backend) for backend in self.backends.values()))
+
+    async def _check_forever(self):
+        while True:
+            await asyncio.sleep(self._health_check_seconds)
+            await self._check_all()
+
+    def _pin_key(self, path: str) -> Optional[Tuple[str, str]]:
+        for route, (kind, _) in PINNING_ROUTES.items():
+            if path.startswith(f"{route}/"):
+                return kind, path[len(route) + 1:].split("/", 1)[0]
+        return None
+
+    def _pin(self, kind: str, key: str, backend: Backend):
+        self._pins[(kind, key)] = backend.url
+        self._pins.move_to_end((kind, key))
+        while len(self._pins) > self._max_pins:
+            self._pins.popitem(last=False)
+
+    def _candidates(self, method: str, path: str, body: bytes) -> List[Backend]:
+        """Backends to try for a request, in order."""
+        if (pin_key := self._pin_key(path)) is not None and pin_key in self._pins:
+            self._pins.move_to_end(pin_key)
+            return [self.backends[self._pins[pin_key]]]
+
+        # a backend marked down may be back already: tried last rather than never
+        by_load = sorted(self.backends.values(), key=lambda backend: (not backend.healthy, backend.load))
+        if method != "POST" or path not in HASHED_ROUTES:
+            return by_load
+        try:
+            prompt = json.loads(body)["prompt"]
+        except Exception:
+            return by_load
+
+        self._hashed.inc()
+        ring = [self.backends[url] for url in self._ring.walk(normalize_prompt(prompt))]
+        available = [backend for backend in ring if backend.healthy and backend.queue_depth < self._max_queue_depth]
+        if available and available[0] is not ring[0]:
+            self._spilled.inc()
+        return available + [backend for backend in by_load if backend not in available]
+
+    async def _send(self, backend: Backend, request: Request, path: str, body: bytes) -> httpx.Response:
+        headers = {name: value for name, value in request.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+        # backends limit requests per client: the client is whoever called the gateway
+        headers.setdefault("x-client-id", request.client.host if request.client else "gateway")
+        outgoing = self._client.build_request(
+            request.method,
+            f"{backend.url}/{self._api_prefix}/{path}",
+            params=request.query_params,
+            headers=headers,
+            content=body
+        )
+        return await self._client.send(outgoing, stream=True)
+
+    async def forward(self, request: Request, path: str) -> Response:
+        """Proxies `request` to a backend; a client that goes away before the response starts cancels it there too."""
+        # read before polling for a disconnect: `is_disconnected` consumes (and drops) a pending body chunk
+        body = await request.body()
+        forwarding = asyncio.ensure_future(self._forward(request, path.strip("/"), body))
+        while True:
+            done, _ = await asyncio.wait({forwarding}, timeout=self.DISCONNECT_POLL_SECONDS)
+            if done:
+                return forwarding.result()
+            if await request.is_disconnected():
+                forwarding.cancel()
+                raise ChatbotException.client_closed_request_exception(message="The request was cancelled by the client.")
+
+    async def _forward(self, request: Request, path: str, body: bytes) -> Response:
+        candidates = self._candidates(request.method, path, body)
+        for attempt, backend in enumerate(candidates):
+            backend.in_flight += 1
+            backend.requests.inc()
+            relayed = False
+            try:
+                response = await self._send(backend, request, path, body)
+                if response.status_code == 503 and attempt + 1 < len(candidates):
+                    # overloaded: the request never started, another backend may have room
+                    await response.aclose()
+                    backend.queue_depth = max(backend.queue_depth, self._max_queue_depth)
+                    self._failovers.inc()
+                    continue
+                relayed = True
+                return await self._relay(backend, request, path, response)
+            except httpx.TransportError as e:
+                if relayed:
+                    raise
+                backend.failures.inc()
+                backend.healthy = False
+                logger.warning(f"Backend {backend.url} failed ({type(e).__name__}: {e}), failing over")
+                self._failovers.inc()
+            finally:
+                if not relayed:
+                    backend.in_flight -= 1
+        raise ChatbotException.service_unavailable_exception(message="No backend could take the request, please retry later.")
+
+    async def _relay(self, backend: Backend, request: Request, path: str, response: httpx.Response) -> Response:
+        """The backend's response, read whole, or streamed for event streams; releases `backend` once read."""
+        headers = {name: value for name, value in response.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+        route = path if request.method == "POST" else None
+        if route in PINNING_ROUTES or not response.headers.get("content-type", "").startswith(("text/event-stream", "application/x-ndjson")):
+            try:
+                content = b"".join([chunk async for chunk in response.aiter_raw()])
+            finally:
+                await response.aclose()
+                backend.in_flight -= 1
+            if route in PINNING_ROUTES and response.status_code == 200:
+                kind, field = PINNING_ROUTES[route]
+                self._pin(kind, json.loads(content)["data"][field], backend)
+            return Response(content=content, status_code=response.status_code, headers=headers)
+
+        async def relay() -> AsyncIterator[bytes]:
+            # ends (and closes the backend connection, cancelling its generation) when the client goes away
+            try:
+                async for chunk in response.aiter_raw():
+                    yield chunk
+            finally:
+                await response.aclose()
+                backend.in_flight -= 1
+        return StreamingResponse(relay(), status_code=response.status_code, headers=headers)
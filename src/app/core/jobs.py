@@ -0,0 +1,358 @@
+import asyncio
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from starlette.status import HTTP_429_TOO_MANY_REQUESTS, HTTP_503_SERVICE_UNAVAILABLE
+
+from src.app.core.request_context import Priority, RequestContext
+from src.app.exceptions.exception import ChatbotException
+from src.helpers.logging.logger import logger
+from src.helpers.metrics.stats import stats
+
+AnswerFn_t = Callable[..., Awaitable[Tuple[Optional[str], Optional[str]]]]
+ItemResult_t = Tuple[int, Optional[str], Optional[str]]
+
+QUEUED, RUNNING, COMPLETED, CANCELLED = "queued", "running", "completed", "cancelled"
+PENDING, DONE, FAILED = "pending", "done", "failed"
+
+class JobStore(object):
+    """Jobs and their items in one SQLite file, so that a restarted server picks up where it stopped.
+    Blocking: meant to be called off the event loop."""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            use_cache INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            done INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            active_seconds REAL NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            finished_at REAL
+        );
+        CREATE TABLE IF NOT EXISTS items (
+            job_id TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            prompt TEXT NOT NULL,
+            status TEXT NOT NULL,
+            answer TEXT,
+            error TEXT,
+            seq INTEGER,
+            PRIMARY KEY (job_id, idx)
+        );
+        CREATE INDEX IF NOT EXISTS items_by_seq ON items (job_id, seq);
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self.SCHEMA)
+
+    def create(self, job_id: str, prompts: List[str], use_cache: bool):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO jobs (id, status, use_cache, total, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, QUEUED, int(use_cache), len(prompts), time.time())
+            )
+            self._db.executemany(
+                "INSERT INTO items (job_id, idx, prompt, status) VALUES (?, ?, ?, ?)",
+                [(job_id, index, prompt, PENDING) for index, prompt in enumerate(prompts)]
+            )
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def unfinished(self) -> List[str]:
+        with self._lock:
+            rows = self._db.execute("SELECT id FROM jobs WHERE status IN (?, ?) ORDER BY created_at", (QUEUED, RUNNING)).fetchall()
+        return [row["id"] for row in rows]
+
+    def set_status(self, job_id: str, status: str, current: Sequence[str] = (QUEUED, RUNNING)) -> bool:
+        """Moves the job to `status` if it is in one of the `current` ones (a job cancelled meanwhile stays
+        cancelled); whether it was."""
+        finished_at = time.time() if status in (COMPLETED, CANCELLED) else None
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                f"UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status IN ({', '.join('?' * len(current))})",
+                (status, finished_at, job_id, *current)
+            )
+        return cursor.rowcount > 0
+
+    def pending_items(self, job_id: str, after: int, limit: int) -> List[Tuple[int, str]]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT idx, prompt FROM items WHERE job_id = ? AND status = ? AND idx > ? ORDER BY idx LIMIT ?",
+                (job_id, PENDING, after, limit)
+            ).fetchall()
+        return [(row["idx"], row["prompt"]) for row in rows]
+
+    def finish_items(self, job_id: str, results: List[ItemResult_t], elapsed: float):
+        """Records answers (or errors) of items, numbering them in completion order, and `elapsed`
+        seconds of work on the job since the previous call."""
+        with self._lock, self._db:
+            row = self._db.execute("SELECT done, failed FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            seq, done, failed = row["done"] + row["failed"], 0, 0
+            for index, answer, error in results:
+                seq += 1
+                self._db.execute(
+                    "UPDATE items SET status = ?, answer = ?, error = ?, seq = ? WHERE job_id = ? AND idx = ?",
+                    (FAILED if error is not None else DONE, answer, error, seq, job_id, index)
+                )
+                done, failed = done + (error is None), failed + (error is not None)
+            self._db.execute(
+                "UPDATE jobs SET done = done + ?, failed = failed + ?, active_seconds = active_seconds + ? WHERE id = ?",
+                (done, failed, elapsed, job_id)
+            )
+
+    def results(self, job_id: str, after_seq: int = 0, limit: int = 1000) -> List[Dict[str, Any]]:
+        """Finished items in completion order, starting after the `after_seq`-th."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT idx, status, answer, error, seq FROM items WHERE job_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (job_id, after_seq, limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class BulkJob(object):
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.context = RequestContext(priority=Priority.BULK, client_id=f"job:{job_id}")
+        self.task: Optional[asyncio.Task] = None
+        self.run_started_at = time.monotonic()
+        self.finished_in_run = 0
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        # wake everybody waiting for progress, later waiters wait for the next change
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    @property
+    def items_per_second(self) -> float:
+        elapsed = time.monotonic() - self.run_started_at
+        return self.finished_in_run / elapsed if elapsed > 0 else 0.0
+
+class BulkJobManager(object):
+    """Runs submitted lists of prompts through `answer_fn` (the chat batcher), at bulk priority,
+    keeping up to `concurrency` items in flight so that full batches form. Progress and answers
+    are written to the `JobStore` as items finish; unfinished jobs resume on `start`.
+
+    With several HTTP workers sharing the store, only the worker holding the lock at `lock_path` runs
+    jobs: it picks up jobs submitted through the others and cancellations made there by polling the
+    store, and the others follow job progress the same way.
+    """
+    RETRY_DELAY = 1.0
+    POLL_SECONDS = 1.0
+
+    def __init__(
+        self,
+        store: JobStore,
+        answer_fn: AnswerFn_t,
+        concurrency: int = 16,
+        max_items: int = 100000,
+        lock_path: Optional[str] = None
+    ):
+        self._store = store
+        self._answer_fn = answer_fn
+        self._concurrency = max(1, concurrency)
+        self._max_items = max_items
+        self._lock_path = lock_path
+        self._lock_file = None
+        self._watcher: Optional[asyncio.Task] = None
+        self._jobs: Dict[str, BulkJob] = {}
+
+        self._items = stats.counter("bulk_job_items")
+        self._failed = stats.counter("bulk_job_items_failed")
+        stats.gauge("bulk_jobs_running", lambda: len(self._jobs))
+
+    @property
+    def runs_jobs(self) -> bool:
+        return self._lock_path is None or self._lock_file is not None
+
+    def _try_lock(self) -> bool:
+        if self.runs_jobs:
+            return True
+        lock_file = open(self._lock_path, "a")
+        try:
+            # released by the OS when this worker exits, so that another one takes over
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    async def start(self):
+        if self._try_lock():
+            await self._resume()
+        if self._lock_path is not None:
+            self._watcher = asyncio.create_task(self._watch())
+
+    async def _resume(self):
+        for job_id in await asyncio.to_thread(self._store.unfinished):
+            if job_id not in self._jobs:
+                logger.info(f"Resuming bulk job {job_id}")
+                self._launch(job_id)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.POLL_SECONDS)
+            if not self._try_lock():
+                continue
+            await self._resume()
+            # cancelled through another worker
+            for job in list(self._jobs.values()):
+                row = await asyncio.to_thread(self._store.get, job.job_id)
+                if row is not None and row["status"] == CANCELLED:
+                    job.context.cancel_token.cancel()
+                    job.notify()
+
+    async def stop(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+        # jobs stay "running" in the store and resume on the next start
+        tasks = [job.task for job in self._jobs.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._store.close()
+        if self._lock_file is not None:
+            self._lock_file.close()
+
+    async def submit(self, prompts: List[str], use_cache: bool = True) -> str:
+        if not prompts:
+            raise ChatbotException.bad_request_exception(message="A job needs at least one prompt.")
+        if len(prompts) > self._max_items:
+            raise ChatbotException.request_entity_too_large(message=f"A job may hold at most {self._max_items} prompts.")
+        job_id = uuid.uuid4().hex
+        await asyncio.to_thread(self._store.create, job_id, prompts, use_cache)
+        if self.runs_jobs:
+            self._launch(job_id)
+        return job_id
+
+    async def status(self, job_id: str) -> Dict[str, Any]:
+        row = await asyncio.to_thread(self._store.get, job_id)
+        if row is None:
+            raise ChatbotException.not_found_exception(message=f"Bulk job {job_id} does not exist.")
+        job = self._jobs.get(job_id)
+        if job is not None:
+            rate = job.items_per_second
+        else:
+            rate = (row["done"] + row["failed"]) / row["active_seconds"] if row["active_seconds"] > 0 else 0.0
+        remaining = row["total"] - row["done"] - row["failed"]
+        return {
+            **row,
+            "items_per_second": rate,
+            "eta_seconds": remaining / rate if rate > 0 and remaining and row["status"] in (QUEUED, RUNNING) else None
+        }
+
+    async def cancel(self, job_id: str) -> Dict[str, Any]:
+        row = await self.status(job_id)
+        if row["status"] in (QUEUED, RUNNING):
+            await asyncio.to_thread(self._store.set_status, job_id, CANCELLED)
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.context.cancel_token.cancel()
+                job.notify()
+        return await self.status(job_id)
+
+    async def results(self, job_id: str, after_seq: int = 0, limit: int = 1000) -> List[Dict[str, Any]]:
+        await self.status(job_id)
+        return await asyncio.to_thread(self._store.results, job_id, after_seq, limit)
+
+    async def stream(self, job_id: str, after_seq: int = 0) -> AsyncIterator[Dict[str, Any]]:
+        """Finished items in completion order, following the job until it is over."""
+        while True:
+            job = self._jobs.get(job_id)
+            changed = job.changed if job is not None else None
+            rows = await self.results(job_id, after_seq)
+            for row in rows:
+                after_seq = row["seq"]
+                yield row
+            if rows:
+                continue
+            if changed is not None:
+                await changed.wait()
+                continue
+            # over, or run by another worker (or not picked up yet): follow it through the store
+            row = await asyncio.to_thread(self._store.get, job_id)
+            if row["status"] not in (QUEUED, RUNNING):
+                return
+            await asyncio.sleep(self.POLL_SECONDS)
+
+    def _launch(self, job_id: str):
+        job = BulkJob(job_id)
+        self._jobs[job_id] = job
+        job.task = asyncio.create_task(self._run(job))
+        job.task.add_done_callback(lambda _: self._finished(job))
+
+    def _finished(self, job: BulkJob):
+        self._jobs.pop(job.job_id, None)
+        # streams following the job see that it is over
+        job.notify()
+
+    async def _run(self, job: BulkJob):
+        row = await asyncio.to_thread(self._store.get, job.job_id)
+        # queued, or running when resumed; cancelled since it was launched, it does not start
+        if not await asyncio.to_thread(self._store.set_status, job.job_id, RUNNING):
+            return
+        use_cache = bool(row["use_cache"])
+        running: Set[asyncio.Task] = set()
+        last_index, last_flush = -1, time.monotonic()
+        try:
+            while not job.context.cancelled:
+                # keep the window full, reading pending items from the store a window at a time
+                if len(running) < self._concurrency:
+                    items = await asyncio.to_thread(self._store.pending_items, job.job_id, last_index, self._concurrency - len(running))
+                    for index, prompt in items:
+                        running.add(asyncio.create_task(self._answer_item(job, index, prompt, use_cache)))
+                        last_index = index
+                if not running:
+                    break
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                results = [task.result() for task in done if task.result() is not None]
+                if results and not job.context.cancelled:
+                    now = time.monotonic()
+                    await asyncio.to_thread(self._store.finish_items, job.job_id, results, now - last_flush)
+                    last_flush = now
+                    job.finished_in_run += len(results)
+                    self._failed.inc(sum(error is not None for _, _, error in results))
+                    self._items.inc(len(results))
+                    job.notify()
+
+            if not job.context.cancelled and await asyncio.to_thread(self._store.set_status, job.job_id, COMPLETED, (RUNNING,)):
+                logger.info(f"Bulk job {job.job_id} completed at {job.items_per_second:.2f} items/s")
+        finally:
+            # cancelled by the user or shutting down: in-flight items are dropped and stay pending
+            job.context.cancel_token.cancel()
+            for task in running:
+                task.cancel()
+
+    async def _answer_item(self, job: BulkJob, index: int, prompt: str, use_cache: bool) -> Optional[ItemResult_t]:
+        while True:
+            try:
+                answer, error = await self._answer_fn(prompt, use_cache=use_cache, context=job.context)
+            except ChatbotException as e:
+                if job.context.cancelled:
+                    return None
+                # overloaded by interactive traffic: wait instead of failing the item
+                if e.http_code in (HTTP_429_TOO_MANY_REQUESTS, HTTP_503_SERVICE_UNAVAILABLE):
+                    await asyncio.sleep(self.RETRY_DELAY)
+                    continue
+                return index, None, e.message
+            return index, answer, error
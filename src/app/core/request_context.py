@@ -0,0 +1,148 @@
+import asyncio
+import time
+from contextlib import ExitStack
+from enum import IntEnum
+from typing import Annotated, AsyncIterator, Callable, Optional, Set, Tuple, TypeVar
+
+from fastapi import Depends, Request
+
+from src.app.exceptions.exception import ChatbotException
+from src.engine.models.cancellation import CancellationToken, GenerationCancelled, SharedCancellationToken
+from src.helpers.logging.logger import logger
+from src.settings import settings
+
+T = TypeVar("T")
+
+class Priority(IntEnum):
+    """Lower values are served first."""
+    INTERACTIVE = 0
+    BULK = 1
+
+class RequestContext(object):
+    """Per-request inference options threaded from the route down to the model call.
+
+    `deadline` is a `time.monotonic()` timestamp by which the answer is needed, if any.
+    """
+    def __init__(
+        self,
+        cancel_token: Optional[CancellationToken] = None,
+        priority: Priority = Priority.INTERACTIVE,
+        deadline: Optional[float] = None,
+        client_id: Optional[str] = None
+    ):
+        self.cancel_token = cancel_token if cancel_token is not None else CancellationToken()
+        self.priority = priority
+        self.deadline = deadline
+        self.client_id = client_id
+        # frees the client's slot and stops the disconnect watch, set by the request dependency
+        self._release: Optional[Callable[[], None]] = None
+        self._streaming = False
+        # queues holding the context, re-sorted when `sort_key` changes
+        self._sort_key_listeners: Set[Callable[[], None]] = set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_token.cancelled
+
+    @property
+    def sort_key(self) -> Tuple[int, float]:
+        """Scheduling order: priority class first, earliest deadline first within a class."""
+        return (int(self.priority), self.deadline if self.deadline is not None else float("inf"))
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise GenerationCancelled("The request was cancelled by the client.")
+
+    def shared(self) -> "RequestContext":
+        """Context of a call shared with other requests, cancelled once all of them are."""
+        return RequestContext(
+            cancel_token=SharedCancellationToken(),
+            priority=self.priority,
+            deadline=self.deadline,
+            client_id=self.client_id
+        )
+
+    def join(self, other: "RequestContext"):
+        """Lets a shared call serve `other` too: it takes the highest priority and the latest deadline of
+        its callers (none once one of them has none), so that it is neither scheduled behind nor dropped
+        for the caller that started it."""
+        sort_key = self.sort_key
+        self.priority = min(self.priority, other.priority)
+        if self.deadline is not None:
+            self.deadline = None if other.deadline is None else max(self.deadline, other.deadline)
+        if self.sort_key != sort_key:
+            for listener in list(self._sort_key_listeners):
+                listener()
+
+    def add_sort_key_listener(self, listener: Callable[[], None]):
+        """Calls `listener` (on the event loop) whenever `sort_key` changes; added once per listener."""
+        self._sort_key_listeners.add(listener)
+
+    def hold_for(self, body: AsyncIterator[T]) -> AsyncIterator[T]:
+        """Wraps the body of a StreamingResponse so that the request keeps its client slot until the body
+        is sent: depending on the FastAPI version, dependencies exit before the response is sent. When
+        the client goes away before the body starts, the disconnect watch releases the slot instead."""
+        self._streaming = True
+        async def held() -> AsyncIterator[T]:
+            try:
+                async for item in body:
+                    yield item
+            finally:
+                await body.aclose()
+                self.release()
+        return held()
+
+    def release(self):
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+
+def parse_priority(value: Optional[str], default: Priority) -> Priority:
+    if not value:
+        return default
+    try:
+        return Priority[value.strip().upper()]
+    except KeyError:
+        raise ChatbotException.bad_request_exception(
+            message=f"Unknown priority {value!r}, expected one of {[p.name.lower() for p in Priority]}."
+        )
+
+def parse_deadline(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return time.monotonic() + float(value) / 1000
+    except ValueError:
+        raise ChatbotException.bad_request_exception(message=f"X-Deadline-Ms must be a number of milliseconds, got {value!r}.")
+
+async def _watch_disconnect(request: Request, context: RequestContext, interval: float):
+    while not await request.is_disconnected():
+        await asyncio.sleep(interval)
+    logger.info(f"Client disconnected from {request.url.path}, cancelling its inference")
+    context.cancel_token.cancel()
+    context.release()
+
+def request_context(default_priority: Priority = Priority.INTERACTIVE) -> Callable[[Request], AsyncIterator[RequestContext]]:
+    """Dependency building the context of an inference request from its headers
+    (X-Priority, X-Deadline-Ms, X-Client-Id) and holding the client's concurrency slot."""
+    async def get_request_context(request: Request) -> AsyncIterator[RequestContext]:
+        context = RequestContext(
+            priority=parse_priority(request.headers.get("X-Priority"), default_priority),
+            deadline=parse_deadline(request.headers.get("X-Deadline-Ms")),
+            client_id=request.headers.get("X-Client-Id") or (request.client.host if request.client else None)
+        )
+        resources = ExitStack()
+        resources.enter_context(request.app.anki_assistant.client_limiter.hold(context.client_id))
+        watcher = asyncio.create_task(_watch_disconnect(request, context, settings.DISCONNECT_POLL_INTERVAL_MS / 1000))
+        resources.callback(watcher.cancel)
+        context._release = resources.close
+        try:
+            yield context
+        finally:
+            # a streamed body releases the request once sent (see `RequestContext.hold_for`)
+            if not context._streaming:
+                context.release()
+    return get_request_context
+
+DepsRequestContext = Annotated[RequestContext, Depends(request_context(Priority.INTERACTIVE))]
+DepsBulkRequestContext = Annotated[RequestContext, Depends(request_context(Priority.BULK))]
@@ -0,0 +1,66 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from src.app.core.request_context import RequestContext
+from src.app.exceptions.exception import ChatbotException
+from src.helpers.metrics.stats import stats
+
+class ServiceTimeEstimator(object):
+    """Exponentially weighted moving average of how long one unit of work (a call, a batch) takes."""
+    def __init__(self, alpha: float = 0.2):
+        self._alpha = alpha
+        self.value: Optional[float] = None
+
+    def observe(self, seconds: float):
+        self.value = seconds if self.value is None else self._alpha * seconds + (1 - self._alpha) * self.value
+
+def check_deadline(name: str, context: Optional[RequestContext], estimated_seconds: Optional[float]):
+    """Rejects a request that is (or is estimated to be) unable to finish before its deadline."""
+    if context is None or context.deadline is None:
+        return
+    remaining = context.deadline - time.monotonic()
+    if remaining <= 0 or (estimated_seconds is not None and estimated_seconds > remaining):
+        stats.counter(f"{name}_deadline_rejected").inc()
+        raise ChatbotException.service_unavailable_exception(
+            message=f"The {name} model cannot answer within the requested deadline "
+                    f"(estimated {estimated_seconds or 0:.2f}s, {max(0.0, remaining):.2f}s left)."
+        )
+
+def estimate_wait(ahead: int, parallelism: int, service_time: Optional[float]) -> Optional[float]:
+    """Time until a request with `ahead` units of work before it is done, `parallelism` running at once."""
+    if service_time is None:
+        return None
+    return math.ceil((ahead + 1) / max(1, parallelism)) * service_time
+
+class ClientLimiter(object):
+    """Caps the number of requests one client may have in progress at once (0 disables the cap)."""
+    def __init__(self, max_per_client: int = 0):
+        self._max_per_client = max_per_client
+        self._active: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._rejected = stats.counter("client_limit_rejected")
+        stats.gauge("client_limit_active_clients", lambda: len(self._active))
+
+    @contextmanager
+    def hold(self, client_id: Optional[str]) -> Iterator[None]:
+        if not self._max_per_client or client_id is None:
+            yield
+            return
+
+        with self._lock:
+            if self._active.get(client_id, 0) >= self._max_per_client:
+                self._rejected.inc()
+                raise ChatbotException.too_many_requests_exception(
+                    message=f"Client {client_id} already has {self._max_per_client} requests in progress."
+                )
+            self._active[client_id] = self._active.get(client_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active[client_id] -= 1
+                if not self._active[client_id]:
+                    del self._active[client_id]
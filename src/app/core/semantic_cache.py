@@ -0,0 +1,265 @@
+import itertools
+import json
+import os
+import threading
+import time
+from typing import Callable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from src.engine.models.model_embedding import EmbeddingModel
+from src.helpers.logging.logger import logger
+from src.helpers.metrics.stats import stats
+
+class EmbeddingIndex(object):
+    """Fixed-capacity matrix of L2-normalized vectors searched by cosine similarity.
+
+    Small indexes are searched exhaustively. From `ivf_min_entries` on, vectors are also clustered
+    (inverted file, sqrt(n) centroids) and a query only scores the vectors of its `nprobe` closest
+    clusters, found through the slot lists of each cluster, so lookup cost stays roughly flat as the
+    index grows. When full, the least recently used slot is overwritten.
+    """
+    KMEANS_ITERATIONS = 10
+    KMEANS_SAMPLES_PER_CENTROID = 32
+
+    def __init__(
+        self,
+        dim: int,
+        max_entries: int = 100000,
+        ivf_min_entries: int = 20000,
+        nprobe: int = 8
+    ):
+        self.dim = dim
+        self._max_entries = max(1, max_entries)
+        self._ivf_min_entries = ivf_min_entries
+        self._nprobe = nprobe
+        self._vectors = np.zeros((self._max_entries, dim), dtype=np.float32)
+        self._last_used = np.zeros(self._max_entries, dtype=np.float64)
+        self._values: List[Optional[str]] = [None] * self._max_entries
+        self._size = 0
+        self._lock = threading.Lock()
+        
+        # inverted file, (re)built by `maybe_train`: centroid of every slot, slots of every centroid,
+        # and the position of every slot in its centroid's list (for O(1) removal)
+        self._assign = np.full(self._max_entries, -1, dtype=np.int32)
+        self._lists: List[List[int]] = []
+        self._positions = np.zeros(self._max_entries, dtype=np.int64)
+        self._centroids: Optional[np.ndarray] = None
+        self._trained_size = 0
+        self._dirty: Optional[Set[int]] = None
+        self._rng = np.random.default_rng(0)
+        self._evictions = stats.counter("semantic_cache_evictions")
+
+    def __len__(self) -> int:
+        return self._size
+
+    def search(self, queries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the best slot and its similarity for every row of `queries`, slot -1 when none."""
+        with self._lock:
+            slots = np.full(len(queries), -1)
+            best = np.full(len(queries), -1.0, dtype=np.float32)
+            if self._size == 0:
+                return slots, best
+
+            if self._centroids is None:
+                scores = queries @ self._vectors[:self._size].T
+                slots = scores.argmax(axis=1)
+                return slots, scores[np.arange(len(queries)), slots]
+
+            probes = np.argsort(-(queries @ self._centroids.T), axis=1)[:, :self._nprobe]
+            for row, query in enumerate(queries):
+                candidates = np.fromiter(itertools.chain.from_iterable(self._lists[centroid] for centroid in probes[row]), dtype=np.int64)
+                if len(candidates) == 0:
+                    continue
+                scores = self._vectors[candidates] @ query
+                position = scores.argmax()
+                slots[row], best[row] = candidates[position], scores[position]
+            return slots, best
+
+    def get(self, slot: int) -> Optional[str]:
+        with self._lock:
+            self._last_used[slot] = time.time()
+            return self._values[slot]
+
+    def add(self, vector: np.ndarray, value: str) -> int:
+        with self._lock:
+            if self._size < self._max_entries:
+                slot = self._size
+                self._size += 1
+            else:
+                slot = int(self._last_used.argmin())
+                self._evictions.inc()
+            self._vectors[slot] = vector
+            self._values[slot] = value
+            self._last_used[slot] = time.time()
+            if self._centroids is not None:
+                self._unlist(self._lists, self._assign, self._positions, slot)
+                self._list(self._lists, self._assign, self._positions, slot, int((self._centroids @ vector).argmax()))
+            if self._dirty is not None:
+                self._dirty.add(slot)
+            return slot
+
+    @staticmethod
+    def _list(lists: List[List[int]], assign: np.ndarray, positions: np.ndarray, slot: int, centroid: int):
+        assign[slot], positions[slot] = centroid, len(lists[centroid])
+        lists[centroid].append(slot)
+
+    @staticmethod
+    def _unlist(lists: List[List[int]], assign: np.ndarray, positions: np.ndarray, slot: int):
+        if assign[slot] < 0:
+            return
+        # the last slot of the list takes the place of the removed one
+        members, position = lists[assign[slot]], positions[slot]
+        last = members.pop()
+        if last != slot:
+            members[position], positions[last] = last, position
+        assign[slot] = -1
+
+    def maybe_train(self):
+        """Blocking, meant for a background thread: (re)clusters the index once it reaches `ivf_min_entries`
+        and then every time it doubled. The heavy part runs without the lock; slots written meanwhile
+        are fixed up at the end."""
+        with self._lock:
+            size = self._size
+            if size < self._ivf_min_entries or size < 2 * self._trained_size or self._dirty is not None:
+                return
+            self._dirty = set()
+            vectors = self._vectors[:size]
+        
+        centroids = self._kmeans(vectors, int(np.sqrt(size)))
+        assign = np.full(self._max_entries, -1, dtype=np.int32)
+        for start in range(0, size, 8192):
+            assign[start:start + 8192] = (vectors[start:start + 8192] @ centroids.T).argmax(axis=1)
+        order = np.argsort(assign[:size], kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(len(centroids) + 1))
+        lists = [order[bounds[centroid]:bounds[centroid + 1]].tolist() for centroid in range(len(centroids))]
+        positions = np.zeros(self._max_entries, dtype=np.int64)
+        positions[order] = np.arange(size) - bounds[assign[order]]
+        
+        with self._lock:
+            for slot in sorted(self._dirty | set(range(size, self._size))):
+                self._unlist(lists, assign, positions, slot)
+                self._list(lists, assign, positions, slot, int((centroids @ self._vectors[slot]).argmax()))
+            self._assign = assign
+            self._lists = lists
+            self._positions = positions
+            self._centroids = centroids
+            self._trained_size = self._size
+            self._dirty = None
+
+    def _kmeans(self, vectors: np.ndarray, nlist: int) -> np.ndarray:
+        """Spherical k-means on a sample of `vectors`."""
+        sample_size = min(len(vectors), nlist * self.KMEANS_SAMPLES_PER_CENTROID)
+        sample = vectors[self._rng.choice(len(vectors), sample_size, replace=False)]
+        centroids = sample[self._rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(self.KMEANS_ITERATIONS):
+            members = (sample @ centroids.T).argmax(axis=1)
+            onehot = np.zeros((sample_size, nlist), dtype=np.float32)
+            onehot[np.arange(sample_size), members] = 1
+            sums = onehot.T @ sample
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # empty clusters keep their previous centroid
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+        return centroids.astype(np.float32)
+
+    def save(self, path: str, namespace: str):
+        with self._lock:
+            size = self._size
+            np.save(f"{path}.vectors.npy", self._vectors[:size])
+            np.save(f"{path}.last_used.npy", self._last_used[:size])
+            with open(f"{path}.json", "w", encoding="utf-8") as f:
+                json.dump({"namespace": namespace, "values": self._values[:size]}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str, namespace: str, max_entries: int, nprobe: int = 8) -> Optional["EmbeddingIndex"]:
+        try:
+            with open(f"{path}.json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            vectors = np.load(f"{path}.vectors.npy")
+            last_used = np.load(f"{path}.last_used.npy")
+        except (OSError, ValueError):
+            return None
+
+        # answers produced under another model/system prompt/generation config are not reusable
+        if meta["namespace"] != namespace:
+            return None
+
+        # keep the most recently used entries when the cap shrank
+        keep = np.argsort(last_used)[::-1][:max_entries]
+        index = cls(vectors.shape[1], max_entries, nprobe=nprobe)
+        index._size = len(keep)
+        index._vectors[:index._size] = vectors[keep]
+        index._last_used[:index._size] = last_used[keep]
+        for position, slot in enumerate(keep):
+            index._values[position] = meta["values"][slot]
+        return index
+
+class SemanticCache(object):
+    """Returns a stored answer when a prompt embeds close enough (cosine >= `threshold`)
+    to a previously answered one."""
+    def __init__(
+        self,
+        embedder_factory: Callable[[], EmbeddingModel],
+        namespace: str,
+        threshold: float = 0.92,
+        max_entries: int = 100000,
+        nprobe: int = 8,
+        path: Optional[str] = None
+    ):
+        self._embedder_factory = embedder_factory
+        self._embedder: Optional[EmbeddingModel] = None
+        self._namespace = namespace
+        self._threshold = threshold
+        self._max_entries = max_entries
+        self._nprobe = nprobe
+        self._path = path
+        self._index: Optional[EmbeddingIndex] = None
+        if path:
+            self._index = EmbeddingIndex.load(path, namespace, max_entries, nprobe)
+            if self._index is not None:
+                logger.info(f"Loaded {len(self._index)} semantic cache entries from {path}")
+
+        self._hits = stats.counter("semantic_cache_hits")
+        self._misses = stats.counter("semantic_cache_misses")
+        self._similarity = stats.summary("semantic_cache_best_similarity")
+        stats.gauge("semantic_cache_entries", lambda: len(self._index) if self._index is not None else 0)
+
+    @staticmethod
+    def normalize(prompt: str) -> str:
+        return " ".join(prompt.lower().split())
+
+    def lookup(self, prompts: List[str]) -> List[Tuple[Optional[str], np.ndarray]]:
+        """Blocking: embeds `prompts` in one batch and searches them in one matrix product.
+        Returns the cached answer (or None) together with the prompt vector for a later `add`."""
+        if self._embedder is None:
+            self._embedder = self._embedder_factory()
+        vectors = self._embedder.embed([self.normalize(prompt) for prompt in prompts])
+        if self._index is None:
+            self._index = EmbeddingIndex(vectors.shape[1], self._max_entries, nprobe=self._nprobe)
+
+        results = []
+        slots, scores = self._index.search(vectors)
+        for vector, slot, score in zip(vectors, slots, scores):
+            if slot >= 0:
+                self._similarity.observe(float(score))
+            if slot >= 0 and score >= self._threshold:
+                self._hits.inc()
+                results.append((self._index.get(int(slot)), vector))
+            else:
+                self._misses.inc()
+                results.append((None, vector))
+        return results
+
+    def add(self, vector: np.ndarray, answer: str):
+        if self._index is not None:
+            self._index.add(vector, answer)
+
+    def train(self):
+        """Blocking: clusters the index when it grew enough (see `EmbeddingIndex.maybe_train`), off the request path."""
+        if self._index is not None:
+            self._index.maybe_train()
+
+    def save(self):
+        if self._path and self._index is not None:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            self._index.save(self._path, self._namespace)
@@ -0,0 +1,52 @@
+import asyncio
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+from src.app.exceptions.exception import ChatbotException
+from src.helpers.metrics.stats import stats
+
+class ChatSession(object):
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.messages: List[Dict[str, str]] = []
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+
+class ChatSessionManager(object):
+    """Keeps the message history of every open chat session; sessions idle for longer
+    than `ttl_seconds` are closed on the next create."""
+    def __init__(
+        self,
+        ttl_seconds: float = 3600,
+        on_close: Optional[Callable[[str], None]] = None
+    ):
+        self._ttl = ttl_seconds
+        self._on_close = on_close
+        self._sessions: Dict[str, ChatSession] = {}
+        stats.gauge("chat_sessions_open", lambda: len(self._sessions))
+
+    def create(self) -> ChatSession:
+        self._expire()
+        session = ChatSession(uuid.uuid4().hex)
+        self._sessions[session.session_id] = session
+        return session
+
+    def get(self, session_id: str) -> ChatSession:
+        session = self._sessions.get(session_id)
+        if session is None:
+            raise ChatbotException.not_found_exception(message=f"Chat session {session_id} does not exist.")
+        session.last_used = time.monotonic()
+        return session
+
+    def close(self, session_id: str) -> ChatSession:
+        session = self.get(session_id)
+        del self._sessions[session_id]
+        if self._on_close is not None:
+            self._on_close(session_id)
+        return session
+
+    def _expire(self):
+        deadline = time.monotonic() - self._ttl
+        for session_id in [sid for sid, session in self._sessions.items() if session.last_used < deadline]:
+            self.close(session_id)
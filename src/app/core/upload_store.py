@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Optional
+
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from src.app.core.uploads import CHUNK_SIZE, too_large
+from src.helpers.logging.logger import logger
+from src.helpers.metrics.stats import stats
+
+class StoredUpload(object):
+    def __init__(self, digest: str, path: str, size: int):
+        self.digest = digest
+        self.path = path
+        self.size = size
+
+class UploadStore(object):
+    """Uploads stored once per content, under the sha256 of their bytes (computed while streaming).
+
+    A new upload is written to a private temporary file and renamed into place, so concurrent
+    uploads of the same content never see a partial file; when the content is already stored the
+    temporary copy is simply dropped. Results derived from an upload (e.g. its description) are
+    kept next to it. Once the store grows past `max_bytes`, the least recently uploaded contents
+    are removed, except those held: from `save` until `release`.
+    """
+    def __init__(self, name: str, root: str, max_bytes: int):
+        self._root = root
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._held: Dict[str, int] = {}
+        os.makedirs(root, exist_ok=True)
+        self._nbytes = sum(entry.stat().st_size for entry in os.scandir(root) if self._is_blob(entry.name))
+
+        self._hits = stats.counter(f"{name}_store_hits")
+        self._misses = stats.counter(f"{name}_store_misses")
+        self._evictions = stats.counter(f"{name}_store_evictions")
+        stats.gauge(f"{name}_store_bytes", lambda: self._nbytes)
+
+    @staticmethod
+    def _is_blob(name: str) -> bool:
+        return not name.endswith((".json", ".part"))
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self._root, digest)
+
+    def _results_path(self, digest: str) -> str:
+        return os.path.join(self._root, f"{digest}.json")
+
+    async def save(self, file: UploadFile, max_bytes: int) -> StoredUpload:
+        """Streams `file` into the store, at most `max_bytes` (413 beyond). The upload is returned held,
+        the caller releases it (`release`) once done with it."""
+        if file.size is not None and file.size > max_bytes:
+            raise too_large(file, max_bytes)
+
+        digest = hashlib.sha256()
+        partial_path = os.path.join(self._root, f"{os.getpid()}.{threading.get_ident()}.{id(file)}.part")
+        size = 0
+        try:
+            with open(partial_path, "wb") as f:
+                while chunk := await file.read(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise too_large(file, max_bytes)
+                    await run_in_threadpool(self._write_chunk, f, digest, chunk)
+            return await run_in_threadpool(self._commit, partial_path, digest.hexdigest(), size)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+    @staticmethod
+    def _write_chunk(f, digest, chunk: bytes):
+        digest.update(chunk)
+        f.write(chunk)
+
+    def _commit(self, partial_path: str, digest: str, size: int) -> StoredUpload:
+        path = self._path(digest)
+        with self._lock:
+            if os.path.exists(path):
+                # same content already stored: keep the stored copy, mark it as recently used
+                os.utime(path)
+                self._hits.inc()
+            else:
+                os.replace(partial_path, path)
+                self._nbytes += size
+                self._misses.inc()
+            # held before the lock is released, so that no prune removes it before the caller gets it
+            self._held[digest] = self._held.get(digest, 0) + 1
+        upload = StoredUpload(digest, path, size)
+        try:
+            self._prune()
+        except Exception:
+            self.release(upload)
+            raise
+        return upload
+
+    def release(self, upload: StoredUpload):
+        """Ends a hold on `upload` (taken by `save`), after which it may be evicted."""
+        with self._lock:
+            self._held[upload.digest] -= 1
+            if not self._held[upload.digest]:
+                del self._held[upload.digest]
+
+    def get_result(self, upload: StoredUpload, key: str) -> Optional[str]:
+        try:
+            with open(self._results_path(upload.digest), "r", encoding="utf-8") as f:
+                return json.load(f).get(key)
+        except (OSError, ValueError):
+            return None
+
+    def set_result(self, upload: StoredUpload, key: str, value: str):
+        path = self._results_path(upload.digest)
+        partial_path = f"{path}.{threading.get_ident()}.part"
+        with self._lock:
+            if not os.path.exists(upload.path):
+                return
+            results = {}
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    results = json.load(f)
+            except (OSError, ValueError):
+                pass
+            results[key] = value
+            try:
+                with open(partial_path, "w", encoding="utf-8") as f:
+                    json.dump(results, f, ensure_ascii=False)
+                os.replace(partial_path, path)
+            except OSError as e:
+                logger.warning(f"Cannot store result for upload {upload.digest}: {e}")
+
+    def _prune(self):
+        with self._lock:
+            if self._nbytes <= self._max_bytes:
+                return
+            blobs = [entry for entry in os.scandir(self._root) if self._is_blob(entry.name) and entry.name not in self._held]
+            blobs.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in blobs:
+                if self._nbytes <= self._max_bytes:
+                    break
+                size = entry.stat().st_size
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    continue
+                if os.path.exists(self._results_path(entry.name)):
+                    os.remove(self._results_path(entry.name))
+                self._nbytes -= size
+                self._evictions.inc()
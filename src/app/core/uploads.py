@@ -0,0 +1,86 @@
+import io
+from typing import Callable, Optional
+
+from fastapi import HTTPException, Request, UploadFile
+from PIL import Image, UnidentifiedImageError
+from starlette.status import HTTP_413_REQUEST_ENTITY_TOO_LARGE
+from starlette.types import Message
+
+from src.app.exceptions.exception import ChatbotException
+
+MB = 1024 * 1024
+CHUNK_SIZE = MB
+# multipart boundaries, part headers and the form fields sent along the files
+FORM_OVERHEAD = MB
+
+def too_large(file: UploadFile, max_bytes: int) -> ChatbotException:
+    return ChatbotException.request_entity_too_large(
+        message=f"{file.filename or 'The upload'} exceeds the {max_bytes / MB:.0f} MB limit."
+    )
+
+class BodyTooLarge(HTTPException):
+    """Raised while the body is received. FastAPI's body parsing lets an `HTTPException` through, any other error becomes a 400."""
+    def __init__(self, max_bytes: int):
+        super(BodyTooLarge, self).__init__(HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.max_bytes = max_bytes
+
+def body_too_large(max_bytes: int) -> ChatbotException:
+    return ChatbotException.request_entity_too_large(
+        message=f"The request body exceeds the {max_bytes / MB:.0f} MB limit."
+    )
+
+def body_limit(max_bytes: int) -> Callable:
+    """Endpoint decorator (below the route's): `TimerRoute` refuses request bodies past `max_bytes`."""
+    def decorate(endpoint: Callable) -> Callable:
+        endpoint.max_body_bytes = max_bytes
+        return endpoint
+    return decorate
+
+def limit_body(request: Request, max_bytes: int) -> Request:
+    """`request` refusing its body past `max_bytes` before the multipart parser spools it: at once from the
+    Content-Length, or as soon as the chunks received (without one) add up to more."""
+    length = request.headers.get("content-length")
+    if length is not None and length.isdigit() and int(length) > max_bytes:
+        raise body_too_large(max_bytes)
+
+    received = 0
+    async def receive() -> Message:
+        nonlocal received
+        message = await request.receive()
+        received += len(message.get("body", b""))
+        if received > max_bytes:
+            raise BodyTooLarge(max_bytes)
+        return message
+    return Request(request.scope, receive)
+
+async def read_upload(file: UploadFile, max_bytes: int) -> bytes:
+    """Reads an upload chunk by chunk, giving up as soon as it grows past `max_bytes`."""
+    if file.size is not None and file.size > max_bytes:
+        raise too_large(file, max_bytes)
+
+    buffer = bytearray()
+    while chunk := await file.read(CHUNK_SIZE):
+        buffer.extend(chunk)
+        if len(buffer) > max_bytes:
+            raise too_large(file, max_bytes)
+    return bytes(buffer)
+
+def decode_image(data: bytes, target_height: Optional[int] = None) -> Image.Image:
+    """Blocking: decodes an image, no larger than needed for `target_height`.
+
+    JPEGs are decoded straight at a reduced DCT scale (`draft`); other formats are shrunk by
+    the largest integer factor that keeps them at least `target_height` pixels high (`reduce`),
+    the model's own resize then only has a small image left to work on.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        if target_height and image.height > target_height:
+            scale = target_height / image.height
+            image.draft("RGB", (max(1, int(image.width * scale)), target_height))
+        image.load()
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise ChatbotException.unprocessable_exception(message=f"Cannot decode image: {e}")
+
+    if target_height and (factor := image.height // target_height) > 1:
+        image = image.reduce(factor)
+    return image
@@ -6,10 +6,15 @@ from starlette.status import (
     HTTP_404_NOT_FOUND,
     HTTP_500_INTERNAL_SERVER_ERROR,
     HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+    HTTP_429_TOO_MANY_REQUESTS,
+    HTTP_503_SERVICE_UNAVAILABLE,
 )
 
 from typing import Optional
 
+# non-standard (nginx) status for requests abandoned by the client, never actually seen by it
+HTTP_499_CLIENT_CLOSED_REQUEST = 499
+
 class ChatbotException(Exception):
     http_code: int
     code: int
@@ -51,4 +56,16 @@ class ChatbotException(Exception):
 
     @staticmethod
     def request_entity_too_large(message: str):
-        return ChatbotException(HTTP_413_REQUEST_ENTITY_TOO_LARGE, message=message)        
\ No newline at end of file
+        return ChatbotException(HTTP_413_REQUEST_ENTITY_TOO_LARGE, message=message)
+
+    @staticmethod
+    def too_many_requests_exception(message: str):
+        return ChatbotException(HTTP_429_TOO_MANY_REQUESTS, message=message)
+
+    @staticmethod
+    def service_unavailable_exception(message: str):
+        return ChatbotException(HTTP_503_SERVICE_UNAVAILABLE, message=message)
+
+    @staticmethod
+    def client_closed_request_exception(message: str):
+        return ChatbotException(HTTP_499_CLIENT_CLOSED_REQUEST, message=message)
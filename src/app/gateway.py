@@ -0,0 +1,60 @@
+from typing import List
+
+from fastapi import FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+
+from src.settings import settings
+from src.app.core.gateway import Gateway
+from src.app.exceptions.exception import ChatbotException
+from src.app.exceptions.exception_handlers import ChatbotExceptionHandler
+from src.app.models.model_http_response import ResponseData
+from src.helpers.metrics.stats import stats
+
+def get_gateway_application(backends: List[str]) -> FastAPI:
+    # setup gateway application
+    async def lifespan(app: FastAPI):
+        app.gateway = Gateway(
+            backends=backends,
+            api_prefix=settings.API_PREFIX,
+            health_check_seconds=settings.GATEWAY_HEALTH_CHECK_SECONDS,
+            max_queue_depth=settings.GATEWAY_MAX_QUEUE_DEPTH,
+            timeout_seconds=settings.GATEWAY_TIMEOUT_SECONDS
+        )
+        await app.gateway.start()
+        yield
+        await app.gateway.close()
+
+    gateway_app = FastAPI(
+        title=f"{settings.PROJECT_NAME} gateway",
+        docs_url=None,
+        redoc_url=None,
+        openapi_url=None,
+        description="AFA Gateway",
+        lifespan=lifespan
+    )
+
+    # CORS
+    if settings.BACKEND_CORS_ORIGINS:
+        origins = ["*"] + [origin.strip() for origin in settings.BACKEND_CORS_ORIGINS.split(",")]
+        gateway_app.add_middleware(
+            CORSMiddleware,
+            allow_origins=origins,
+            allow_credentials=True,
+            allow_methods=["*"],
+            allow_headers=["*"]
+        )
+
+    # setup exceptions
+    gateway_app.add_exception_handler(ChatbotException, ChatbotExceptionHandler())
+
+    @gateway_app.get("/gateway/status", response_model=ResponseData)
+    async def gateway_status(request: Request) -> ResponseData:
+        return ResponseData().success_message(
+            data={**request.app.gateway.status(), "stats": stats.snapshot()}
+        )
+
+    @gateway_app.api_route(settings.API_PREFIX + "/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
+    async def forward(request: Request, path: str):
+        return await request.app.gateway.forward(request, path)
+
+    return gateway_app
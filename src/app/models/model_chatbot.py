@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 
 from pydantic import BaseModel, Field
 
@@ -6,4 +6,26 @@ class ChatResponse(BaseModel):
     answer: str = Field()
     
 class ChatRequest(BaseModel):
-    prompt: str = Field()
\ No newline at end of file
+    prompt: str = Field()
+    no_cache: Optional[bool] = Field(default=False, description="Skip the response cache for this request")
+
+class ChatStreamChunk(BaseModel):
+    token: str = Field()
+
+class ChatMessage(BaseModel):
+    role: str = Field()
+    content: str = Field()
+
+class SessionResponse(BaseModel):
+    session_id: str = Field()
+    messages: List[ChatMessage] = Field(default_factory=list)
+
+class VisionBatchItem(BaseModel):
+    images: List[int] = Field(description="Indices of the uploaded files this item is about")
+    prompt: str = Field()
+
+class VisionBatchResult(BaseModel):
+    index: int = Field()
+    answer: Optional[str] = Field(default=None)
+    code: int = Field(default=0)
+    error: Optional[str] = Field(default=None)
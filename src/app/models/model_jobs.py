@@ -0,0 +1,29 @@
+from typing import List, Optional
+
+from pydantic import BaseModel, Field
+
+class JobRequest(BaseModel):
+    prompts: List[str] = Field()
+    no_cache: Optional[bool] = Field(default=False, description="Skip the response cache for these prompts")
+
+class JobStatus(BaseModel):
+    job_id: str = Field()
+    status: str = Field(description="queued, running, completed or cancelled")
+    total: int = Field()
+    done: int = Field()
+    failed: int = Field()
+    items_per_second: float = Field(description="Throughput of the current run, or over the whole job once it is over")
+    eta_seconds: Optional[float] = Field(default=None)
+    created_at: float = Field()
+    finished_at: Optional[float] = Field(default=None)
+
+class JobItem(BaseModel):
+    index: int = Field()
+    status: str = Field(description="done or failed")
+    answer: Optional[str] = Field(default=None)
+    error: Optional[str] = Field(default=None)
+    seq: int = Field(description="Completion order, pass the last one seen as `after` to continue")
+
+class JobResults(BaseModel):
+    job_id: str = Field()
+    items: List[JobItem] = Field(default_factory=list)
@@ -1,20 +1,28 @@
 import os
 from abc import abstractmethod
-from typing import List, Optional
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import sys
 if not hasattr(sys.stderr, "flush"):
     sys.stderr.flush = lambda: None
     
+import torch
 from PIL import Image
 
-from src.engine.models import model_chat, model_vision
+from src.engine.models import backends, loading, model_chat, model_vision, replicas, residency
+from src.engine.models.cancellation import CancellationToken
+from src.helpers.logging.logger import logger
 
 class Assistant(object):
     @abstractmethod
     def answer(self, prompt: str) -> str:
         raise NotImplementedError
 
+    @abstractmethod
+    def answer_batch(self, prompts: List[str]) -> List[str]:
+        raise NotImplementedError
+
     @abstractmethod
     def generate_image(self, prompt: str) -> Image.Image:
         pass
@@ -28,7 +36,7 @@ class Assistant(object):
         pass
 
     @abstractmethod
-    def describe_video(self, video: str, **kwargs) -> str:
+    def describe_video(self, video: model_vision.Video_t, **kwargs) -> str:
         pass
 
 
@@ -42,29 +50,97 @@ class AnkiAssistant(Assistant):
         vision_model_name: str = "",
         vision_max_token: int = 512,
         enable_vision_model: bool = False,
-        distributed: bool = False
+        distributed: bool = False,
+        chat_system_prompt: Optional[str] = None,
+        chat_prefix_cache: bool = True,
+        chat_session_budget_mb: int = 2048,
+        vision_encoder_cache_mb: int = 1024,
+        vision_encoder_cache_spill: bool = False,
+        vision_encoder_cache_spill_mb: int = 8192,
+        offline: bool = False,
+        preload: bool = True,
+        idle_unload_seconds: float = 0,
+        memory_unload_threshold: float = 0,
+        chat_replicas: int = 1,
+        vision_replicas: int = 1,
+        replica_routing: str = replicas.TOKENS,
+        backend: str = "transformers",
+        cpu_precision: str = "int8",
+        cpu_threads: int = 0,
+        chat_draft_model_name: Optional[str] = None,
+        speculative_min_acceptance: float = 0.3
     ):
         if distributed:
             os.environ["CUDA_VISIBLE_DEVICES"] = ",".join(device_ids)
+            if chat_replicas > 1 or vision_replicas > 1:
+                # every copy would be spread over all the devices
+                logger.warning("Replicas are not supported with distributed models, using one of each.")
+                chat_replicas = vision_replicas = 1
 
-        self.chat_model_device_id, self.vision_model_device_id = self._select_devices(device_ids, 2)
-        self.chat_model = model_chat.GwenModel(
-            device_id=self.chat_model_device_id,
-            cache_dir=cache_dir,
-            max_new_token=chat_max_token,
-            chat_model=chat_model_name,
-            distributed=distributed
-        )
+        self.backend = backends.create_backend(backend, cpu_precision=cpu_precision, cpu_threads=cpu_threads)
+        self.chat_max_token = chat_max_token
+        self.vision_max_token = vision_max_token
+        counts = {"chat": max(1, chat_replicas)}
         if enable_vision_model:
-            self.vision_model = model_vision.GwenVisionModel(
-                device_id=self.vision_model_device_id,
+            counts["vision"] = max(1, vision_replicas)
+        # chat replicas first, then vision ones, round-robin over the devices
+        selected_devices = iter(self._select_devices(device_ids, sum(counts.values())))
+        loaders: Dict[str, Callable[..., Any]] = {
+            "chat": partial(
+                model_chat.GwenModel,
+                cache_dir=cache_dir,
+                max_new_token=chat_max_token,
+                chat_model=chat_model_name,
+                distributed=distributed,
+                system_prompt=chat_system_prompt,
+                prefix_cache=chat_prefix_cache,
+                session_budget_mb=chat_session_budget_mb,
+                offline=offline,
+                backend=self.backend,
+                draft_model=chat_draft_model_name,
+                speculative_min_acceptance=speculative_min_acceptance
+            ),
+            "vision": partial(
+                model_vision.GwenVisionModel,
                 cache_dir=cache_dir,
                 model_name=vision_model_name,
                 max_token=vision_max_token,
-                distributed=distributed
+                distributed=distributed,
+                encoder_cache_mb=vision_encoder_cache_mb,
+                encoder_cache_spill=vision_encoder_cache_spill,
+                encoder_cache_spill_mb=vision_encoder_cache_spill_mb,
+                offline=offline,
+                backend=self.backend
             )
+        }
+
+        self.residency = residency.ModelResidency(idle_unload_seconds, memory_unload_threshold)
+        self.pools: Dict[str, replicas.ReplicaPool] = {}
+        for name, count in counts.items():
+            models = []
+            for index in range(count):
+                device_id = next(selected_devices)
+                device = None if distributed else self.backend.device(torch.device(f"cuda:{device_id}" if torch.cuda.is_available() else "cpu"))
+                # a single replica keeps the model's name (and its metrics' names)
+                replica_name = name if count == 1 else f"{name}_{index}"
+                models.append(self.residency.add(replica_name, partial(loaders[name], device_id=device_id), device))
+            self.pools[name] = replicas.ReplicaPool(name, models, replica_routing)
+            logger.info(f"{count} {name} replica(s) on devices {[str(model.device) for model in models]}, {self.backend.describe()} backend")
+
+        if preload:
+            with loading.startup.phase("models"):
+                self.residency.load_all()
+            logger.info(f"Models loaded: {loading.startup.breakdown()}")
+
+    def _use(self, name: str, tokens: int = 0, affinity: Optional[str] = None):
+        if name not in self.pools:
+            raise RuntimeError(f"[WARN] The {name} model is not enabled.")
+        return self.pools[name].use(tokens, affinity)
+
+    def _chat_tokens(self, prompts: List[str]) -> int:
+        # what routing weighs a call by: roughly 4 characters per prompt token, plus the new tokens
+        return sum(len(prompt) for prompt in prompts) // 4 + len(prompts) * self.chat_max_token
 
-    
     def _select_devices(self, 
         device_ids: List[str], 
         number_models: int,
@@ -83,22 +159,51 @@ class AnkiAssistant(Assistant):
         return [f"{device_ids[i % len(device_ids)]}" for i in range(number_models)]
     
     def answer(self, prompt: str, **kwargs):
-        if not hasattr(self, "chat_model"):
-            raise RuntimeError("[WARN] ChatModel haven't initialized yet.")
-        return self.chat_model.answer(prompt)
+        with self._use("chat", self._chat_tokens([prompt])) as chat_model:
+            return chat_model.answer(prompt)
+
+    def answer_batch(self, prompts: List[str], cancel_tokens: Optional[List[Optional[CancellationToken]]] = None, **kwargs) -> List[str]:
+        with self._use("chat", self._chat_tokens(prompts)) as chat_model:
+            return chat_model.answer_batch(prompts, cancel_tokens=cancel_tokens)
+
+    def answer_stream(self, prompt: str, on_text: Callable[[str], None], cancel_token: Optional[CancellationToken] = None, **kwargs) -> str:
+        with self._use("chat", self._chat_tokens([prompt])) as chat_model:
+            return chat_model.answer_stream(prompt, on_text, cancel_token=cancel_token)
+
+    def answer_session(self, session_id: str, messages: List[Dict[str, str]], cancel_token: Optional[CancellationToken] = None, **kwargs) -> str:
+        # the session's KV cache lives in the replica that answered its first turn
+        tokens = self._chat_tokens([message.get("content", "") for message in messages[-1:]])
+        with self._use("chat", tokens, affinity=session_id) as chat_model:
+            return chat_model.answer_session(session_id, messages, cancel_token=cancel_token)
 
-    def describe_image(self, image: Image.Image, **kwargs) -> str:
+    def close_session(self, session_id: str):
+        # an unloaded model took its session caches with it
+        if (chat_model := self.pools["chat"].forget(session_id)) is not None:
+            chat_model.close_session(session_id)
+
+    def is_image_cached(self, image: model_vision.Image_t, resized_height: Optional[int] = None) -> bool:
+        vision_models = self.pools["vision"].loaded() if "vision" in self.pools else []
+        return any(vision_model.is_image_cached(image, resized_height) for vision_model in vision_models)
+
+    def describe_image(self, image: model_vision.Image_t, **kwargs) -> str:
         return self.analyse_images_with_prompt([image], "Describe this image.", **kwargs)
     
-    def analyse_images_with_prompt(self, images: List[Image.Image], prompt: str, **kwargs) -> str:
-        if not hasattr(self, "vision_model"):
-            raise RuntimeError("[WARN] VisionModel haven't initialized yet.")
-        return self.vision_model.analyse_images_with_prompt(images, prompt, **kwargs)
+    def analyse_images_with_prompt(self, images: List[model_vision.Image_t], prompt: str, **kwargs) -> str:
+        with self._use("vision", self.vision_max_token) as vision_model:
+            return vision_model.analyse_images_with_prompt(images, prompt, **kwargs)
     
-    def describe_video(self, video: str, **kwargs) -> str:
-        if not hasattr(self, "vision_model"):
-            raise RuntimeError("[WARN] VisionModel haven't initialized yet.")
-        return self.vision_model.describe_video(video, **kwargs)
+    def analyse_batch(self, items: List[Tuple[List[model_vision.Image_t], str, Optional[int]]], **kwargs) -> List[str]:
+        with self._use("vision", len(items) * self.vision_max_token) as vision_model:
+            return vision_model.analyse_batch(items, **kwargs)
+
+    def vision_batch_capacity(self, max_tokens: int) -> int:
+        # a batch may run on any replica: the one with the least free memory bounds it
+        vision_models = self.pools["vision"].loaded() if "vision" in self.pools else []
+        return min((vision_model.batch_token_capacity(max_tokens) for vision_model in vision_models), default=max_tokens)
+
+    def describe_video(self, video: model_vision.Video_t, **kwargs) -> str:
+        with self._use("vision", self.vision_max_token) as vision_model:
+            return vision_model.describe_video(video, **kwargs)
               
 def run(args):
     assistant = AnkiAssistant(args.devices)
@@ -0,0 +1,205 @@
+import csv
+import hashlib
+import html
+import io
+import json
+import os
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from src.helpers.logging.logger import logger
+
+Row_t = Dict[str, Any]
+AnswerBatchFn_t = Callable[[List[str]], List[str]]
+
+JSONL, ANKI = "jsonl", "anki"
+ANKI_HEADER = "#separator:tab\n#html:true\n#columns:Front\tBack\n"
+
+class _LineReader(object):
+    """Lines of a file opened in binary mode, keeping the byte offset just past the last line read,
+    so that a row boundary can be checkpointed and seeked back to."""
+    def __init__(self, f, offset: int):
+        f.seek(offset)
+        self._f = f
+        self.offset = offset
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        raw = self._f.readline()
+        if not raw:
+            raise StopIteration
+        line = raw.decode("utf-8-sig" if self.offset == 0 else "utf-8")
+        self.offset += len(raw)
+        return line
+
+def read_rows(path: str, offset: int = 0) -> Iterator[Tuple[Row_t, int]]:
+    """Rows of a CSV (with a header line) or JSONL file, one at a time, each with the byte offset
+    where the next row starts. Reading resumes at `offset`, which must be such an offset."""
+    with open(path, "rb") as f:
+        if path.endswith(".jsonl"):
+            lines = _LineReader(f, offset)
+            for line in lines:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                yield (row if isinstance(row, dict) else {"term": row}), lines.offset
+            return
+
+        dialect = "excel-tab" if path.endswith((".tsv", ".txt")) else "excel"
+        lines = _LineReader(f, 0)
+        header = next(csv.reader(lines, dialect=dialect), None)
+        if header is None:
+            return
+        if offset > lines.offset:
+            lines = _LineReader(f, offset)
+        for values in csv.reader(lines, dialect=dialect):
+            if values:
+                yield dict(zip(header, values)), lines.offset
+
+def _atomic_write_json(path: str, data: Dict[str, Any]):
+    partial_path = f"{path}.part"
+    with open(partial_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial_path, path)
+
+class DeckBuilder(object):
+    """Answers a prompt template for every row of a (possibly huge) CSV/JSONL file, a batch at a time.
+
+    Only one batch of rows is held in memory. Answers are appended to `output_path`, either as JSONL
+    (the input row plus `answer`) or as a tab-separated file Anki imports as Front/Back notes. Every
+    `checkpoint_every` batches the output is synced and the input/output offsets are saved next to it,
+    so that a killed run resumes from the last checkpoint, dropping whatever was written after it.
+    """
+    def __init__(
+        self,
+        answer_batch: AnswerBatchFn_t,
+        template: str,
+        output_format: str = JSONL,
+        batch_size: int = 8,
+        checkpoint_every: int = 8,
+        front_field: str = "term",
+        report_seconds: float = 30.0
+    ):
+        if output_format not in (JSONL, ANKI):
+            raise ValueError(f"Unknown output format {output_format}, expected {JSONL} or {ANKI}.")
+        self._answer_batch = answer_batch
+        self._template = template
+        self._output_format = output_format
+        self._batch_size = max(1, batch_size)
+        self._checkpoint_every = max(1, checkpoint_every)
+        self._front_field = front_field
+        self._report_seconds = report_seconds
+
+    @staticmethod
+    def checkpoint_path(output_path: str) -> str:
+        return f"{output_path}.checkpoint.json"
+
+    def _fingerprint(self, input_path: str) -> str:
+        # a checkpoint only applies to the same input, template and output format
+        return hashlib.sha256("\0".join(
+            [os.path.abspath(input_path), self._template, self._output_format, self._front_field]
+        ).encode("utf-8")).hexdigest()
+
+    def _prompt(self, row: Row_t) -> str:
+        try:
+            return self._template.format_map(row)
+        except KeyError as e:
+            raise ValueError(f"The template uses the field {e}, which rows of the input do not have: {sorted(row)}") from None
+
+    def _format(self, row: Row_t, answer: Optional[str], error: Optional[str]) -> str:
+        if self._output_format == JSONL:
+            record = {**row, "answer": answer}
+            if error is not None:
+                record["error"] = error
+            return json.dumps(record, ensure_ascii=False) + "\n"
+        if error is not None:
+            return ""
+        buffer = io.StringIO()
+        front = str(row.get(self._front_field, next(iter(row.values()), "")))
+        csv.writer(buffer, dialect="excel-tab", lineterminator="\n").writerow(
+            [html.escape(text).replace("\n", "<br>") for text in (front, answer)]
+        )
+        return buffer.getvalue()
+
+    def _answer(self, prompts: List[str]) -> List[Tuple[Optional[str], Optional[str]]]:
+        try:
+            return [(answer, None) for answer in self._answer_batch(prompts)]
+        except Exception as e:
+            if len(prompts) == 1:
+                return [(None, str(e))]
+            logger.warning(f"Batch of {len(prompts)} prompts failed ({e}), answering them one by one")
+            return [result for prompt in prompts for result in self._answer([prompt])]
+
+    def _load_checkpoint(self, input_path: str, output_path: str, restart: bool) -> Dict[str, Any]:
+        checkpoint = {"fingerprint": self._fingerprint(input_path), "input_offset": 0, "output_offset": 0, "rows": 0, "failed": 0, "completed": False}
+        path = self.checkpoint_path(output_path)
+        if restart or not os.path.exists(path):
+            return checkpoint
+        with open(path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved["fingerprint"] != checkpoint["fingerprint"]:
+            raise ValueError(f"{path} belongs to another input, template or format, pass --restart to start over.")
+        return saved
+
+    def run(self, input_path: str, output_path: str, restart: bool = False) -> Dict[str, Any]:
+        checkpoint = self._load_checkpoint(input_path, output_path, restart)
+        if checkpoint["completed"]:
+            logger.info(f"{output_path} is already complete ({checkpoint['rows']} rows)")
+            return checkpoint
+        if checkpoint["rows"]:
+            logger.info(f"Resuming after row {checkpoint['rows']} of {input_path}")
+
+        input_size = max(1, os.path.getsize(input_path))
+        with open(output_path, "ab") as out:
+            # drop what a killed run wrote after its last checkpoint
+            out.truncate(checkpoint["output_offset"])
+            out.seek(checkpoint["output_offset"])
+            if out.tell() == 0 and self._output_format == ANKI:
+                out.write(ANKI_HEADER.encode("utf-8"))
+
+            started_at = last_report = time.monotonic()
+            start_offset, rows_in_run, batches = checkpoint["input_offset"], 0, 0
+
+            def save(completed: bool = False):
+                out.flush()
+                os.fsync(out.fileno())
+                checkpoint.update(output_offset=out.tell(), completed=completed)
+                _atomic_write_json(self.checkpoint_path(output_path), checkpoint)
+
+            def report():
+                elapsed = time.monotonic() - started_at
+                rate = rows_in_run / elapsed if elapsed > 0 else 0.0
+                # rows are of similar size, so the remaining bytes of the input predict the remaining time
+                read = checkpoint["input_offset"] - start_offset
+                eta = f"{(input_size - checkpoint['input_offset']) * elapsed / read:.0f}s" if read > 0 else "unknown"
+                logger.info(
+                    f"{checkpoint['rows']} rows ({checkpoint['failed']} failed), "
+                    f"{100 * checkpoint['input_offset'] / input_size:.1f}% of input, {rate:.2f} rows/s, ETA {eta}"
+                )
+
+            rows = read_rows(input_path, checkpoint["input_offset"])
+            while True:
+                batch: List[Tuple[Row_t, int]] = [item for _, item in zip(range(self._batch_size), rows)]
+                if not batch:
+                    break
+                results = self._answer([self._prompt(row) for row, _ in batch])
+                for (row, _), (answer, error) in zip(batch, results):
+                    out.write(self._format(row, answer, error).encode("utf-8"))
+                checkpoint["input_offset"] = batch[-1][1]
+                checkpoint["rows"] += len(batch)
+                checkpoint["failed"] += sum(error is not None for _, error in results)
+                rows_in_run += len(batch)
+                batches += 1
+                if batches % self._checkpoint_every == 0:
+                    save()
+                if time.monotonic() - last_report >= self._report_seconds:
+                    report()
+                    last_report = time.monotonic()
+
+            save(completed=True)
+            report()
+        return checkpoint
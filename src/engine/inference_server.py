@@ -0,0 +1,292 @@
+import os
+import threading
+import time
+from contextlib import nullcontext
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from src.engine import ipc
+from src.engine.chatbot import AnkiAssistant
+from src.engine.models.cancellation import CancellationToken
+from src.helpers.logging.logger import logger
+from src.helpers.metrics.stats import stats
+
+AUTHKEY_ENV = "AIFA_INFERENCE_AUTHKEY"
+
+# AnkiAssistant methods served to HTTP workers, with the model each one occupies
+SERVED_METHODS: Dict[str, Optional[str]] = {
+    "answer_batch": "chat",
+    "answer_stream": "chat",
+    "answer_session": "chat",
+    "close_session": None,
+    "describe_image": "vision",
+    "analyse_images_with_prompt": "vision",
+    "analyse_batch": "vision",
+    "vision_batch_capacity": None,
+    "describe_video": "vision",
+    # the server's own metrics (model residency, ...), not an assistant method
+    "stats": None
+}
+
+def authkey_from_env() -> Optional[bytes]:
+    key = os.environ.get(AUTHKEY_ENV)
+    return bytes.fromhex(key) if key else None
+
+class _TokenRef(object):
+    def __init__(self, index: int):
+        self.index = index
+
+class _CallbackRef(object):
+    def __init__(self, index: int):
+        self.index = index
+
+def _swap(value: Any, swap: Callable[[Any], Any]) -> Any:
+    if isinstance(value, list):
+        return [swap(item) for item in value]
+    return swap(value)
+
+class InferenceServer(object):
+    """Serves one `AnkiAssistant` (the only copy of the models) to the HTTP workers over a Unix socket.
+
+    Every worker connection is served by its own thread; at most `concurrency[model]` calls run on
+    a model at once, the others wait. A call streams back the invocations of its callbacks (text
+    pieces) and its result, while the worker may send cancellations of its tokens in between.
+    """
+    POLL_SECONDS = 0.05
+
+    def __init__(
+        self,
+        assistant: AnkiAssistant,
+        address: str,
+        authkey: Optional[bytes] = None,
+        concurrency: Optional[Dict[str, int]] = None,
+        sweep_seconds: float = 0
+    ):
+        self._assistant = assistant
+        self._address = address
+        self._authkey = authkey
+        self._slots = {model: threading.BoundedSemaphore(max(1, count)) for model, count in (concurrency or {}).items()}
+        self._sweep_seconds = sweep_seconds
+
+        self._calls = stats.counter("inference_server_calls")
+        self._connections = 0
+        stats.gauge("inference_server_connections", lambda: self._connections)
+
+    def serve_forever(self):
+        if os.path.exists(self._address):
+            os.unlink(self._address)
+        with Listener(self._address, family="AF_UNIX", authkey=self._authkey) as listener:
+            os.chmod(self._address, 0o600)
+            if self._sweep_seconds > 0:
+                threading.Thread(target=self._sweep_models, name="inference-sweeper", daemon=True).start()
+            logger.info(f"Inference server listening on {self._address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    # e.g. a peer with the wrong key, the listener itself is fine
+                    logger.warning(f"Rejected an inference connection: {e}")
+                    continue
+                threading.Thread(target=self._serve_connection, args=(conn,), name="inference-conn", daemon=True).start()
+
+    def _sweep_models(self):
+        while True:
+            time.sleep(self._sweep_seconds)
+            self._assistant.residency.sweep()
+
+    def _serve_connection(self, conn: Connection):
+        self._connections += 1
+        try:
+            with conn:
+                while True:
+                    try:
+                        message = ipc.unpack(conn.recv_bytes())
+                        # a cancellation that crossed the result of its call
+                        if message[0] != "cancel":
+                            self._serve_call(conn, *message)
+                    except (EOFError, OSError):
+                        return
+        finally:
+            self._connections -= 1
+
+    def _serve_call(self, conn: Connection, method: str, args: Tuple, kwargs: Dict[str, Any], num_tokens: int):
+        self._calls.inc()
+        tokens = [CancellationToken() for _ in range(num_tokens)]
+        send_lock = threading.Lock()
+
+        def send(message: Tuple[str, Any]):
+            with send_lock:
+                conn.send_bytes(ipc.pack(message, shared=False)[0])
+
+        def resolve(value: Any) -> Any:
+            if isinstance(value, _TokenRef):
+                return tokens[value.index]
+            if isinstance(value, _CallbackRef):
+                index = value.index
+                return lambda *callback_args: send(("callback", (index, callback_args)))
+            return value
+
+        args = tuple(_swap(arg, resolve) for arg in args)
+        kwargs = {name: _swap(value, resolve) for name, value in kwargs.items()}
+        outcome: Dict[str, Any] = {}
+
+        def run():
+            try:
+                if method not in SERVED_METHODS:
+                    raise RuntimeError(f"The inference server does not serve {method}.")
+                model = SERVED_METHODS[method]
+                target = stats.snapshot if method == "stats" else getattr(self._assistant, method)
+                with self._slots[model] if model in self._slots else nullcontext():
+                    outcome["result"] = target(*args, **kwargs)
+            except Exception as e:
+                outcome["error"] = e
+
+        worker = threading.Thread(target=run, name=f"inference-{method}", daemon=True)
+        worker.start()
+        try:
+            while worker.is_alive():
+                if conn.poll(self.POLL_SECONDS):
+                    kind, indices = ipc.unpack(conn.recv_bytes())
+                    for index in indices if kind == "cancel" else ():
+                        tokens[index].cancel()
+        except (EOFError, OSError):
+            # the worker went away: stop its generation, nobody reads the result
+            for token in tokens:
+                token.cancel()
+            raise
+
+        if "error" in outcome:
+            try:
+                send(("error", outcome["error"]))
+            except Exception:
+                send(("error", RuntimeError(f"{type(outcome['error']).__name__}: {outcome['error']}")))
+        else:
+            send(("result", outcome["result"]))
+
+class RemoteAssistant(object):
+    """`AnkiAssistant` of an `InferenceServer`, for HTTP workers that do not load the models themselves.
+
+    Calls block the calling thread (an inference executor thread) like local ones; connections are
+    pooled, one per concurrent call. Cancellation tokens are watched while a call runs and forwarded,
+    callbacks (streamed text) are invoked as the server reports them.
+    """
+    POLL_SECONDS = 0.05
+
+    def __init__(self, address: str, authkey: Optional[bytes] = None):
+        self._address = address
+        self._authkey = authkey
+        self._idle: List[Connection] = []
+        self._lock = threading.Lock()
+        self._latency = stats.summary("inference_client_call_seconds")
+        self._shared_bytes = stats.counter("inference_client_shared_bytes")
+
+    def _connect(self) -> Connection:
+        return Client(self._address, family="AF_UNIX", authkey=self._authkey)
+
+    def _send(self, payload: bytes) -> Connection:
+        """Sends `payload` on an idle connection, or a new one when there is none or the idle one is dead
+        (e.g. the server restarted)."""
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is not None:
+            try:
+                conn.send_bytes(payload)
+                return conn
+            except OSError:
+                conn.close()
+        conn = self._connect()
+        conn.send_bytes(payload)
+        return conn
+
+    def _call(self, method: str, *args, **kwargs) -> Any:
+        tokens: List[CancellationToken] = []
+        callbacks: List[Callable] = []
+
+        def reference(value: Any) -> Any:
+            if isinstance(value, CancellationToken):
+                tokens.append(value)
+                return _TokenRef(len(tokens) - 1)
+            if callable(value) and not isinstance(value, type):
+                callbacks.append(value)
+                return _CallbackRef(len(callbacks) - 1)
+            return value
+
+        args = tuple(_swap(arg, reference) for arg in args)
+        kwargs = {name: _swap(value, reference) for name, value in kwargs.items()}
+        payload, segment = ipc.pack((method, args, kwargs, len(tokens)))
+        if segment is not None:
+            self._shared_bytes.inc(segment.size)
+
+        timing = time.perf_counter()
+        conn, reusable = None, False
+        try:
+            try:
+                conn = self._send(payload)
+            except BaseException:
+                ipc.discard(segment)
+                raise
+            ipc.release(segment)
+            forwarded = set()
+            while True:
+                cancelled = [index for index, token in enumerate(tokens) if token.cancelled and index not in forwarded]
+                if cancelled:
+                    conn.send_bytes(ipc.pack(("cancel", cancelled), shared=False)[0])
+                    forwarded.update(cancelled)
+                if not conn.poll(self.POLL_SECONDS):
+                    continue
+                kind, value = ipc.unpack(conn.recv_bytes())
+                if kind == "callback":
+                    index, callback_args = value
+                    callbacks[index](*callback_args)
+                    continue
+                reusable = True
+                if kind == "error":
+                    raise value
+                return value
+        finally:
+            self._latency.observe(time.perf_counter() - timing)
+            if reusable:
+                with self._lock:
+                    self._idle.append(conn)
+            elif conn is not None:
+                conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def answer_batch(self, prompts, cancel_tokens=None, **kwargs) -> List[str]:
+        return self._call("answer_batch", prompts, cancel_tokens=cancel_tokens)
+
+    def answer_stream(self, prompt, on_text, cancel_token=None, **kwargs) -> str:
+        return self._call("answer_stream", prompt, on_text, cancel_token=cancel_token)
+
+    def answer_session(self, session_id, messages, cancel_token=None, **kwargs) -> str:
+        return self._call("answer_session", session_id, messages, cancel_token=cancel_token)
+
+    def close_session(self, session_id):
+        self._call("close_session", session_id)
+
+    def is_image_cached(self, image, resized_height=None) -> bool:
+        # not worth a round trip: workers decode every image, the server still skips the encoder for cached ones
+        return False
+
+    def describe_image(self, image, **kwargs) -> str:
+        return self._call("describe_image", image, **kwargs)
+
+    def analyse_images_with_prompt(self, images, prompt, **kwargs) -> str:
+        return self._call("analyse_images_with_prompt", images, prompt, **kwargs)
+
+    def analyse_batch(self, items, **kwargs) -> List[str]:
+        return self._call("analyse_batch", items, **kwargs)
+
+    def vision_batch_capacity(self, max_tokens: int) -> int:
+        return self._call("vision_batch_capacity", max_tokens)
+
+    def describe_video(self, video, **kwargs) -> str:
+        return self._call("describe_video", video, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        return self._call("stats")
@@ -0,0 +1,88 @@
+import io
+import pickle
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from src.engine.models.vision_cache import ImageSource
+
+# buffers smaller than this travel inline with the message
+SHARED_MIN_BYTES = 64 * 1024
+_ARRAY_MODES = ("RGB", "RGBA", "L")
+
+def _image_from_array(array: np.ndarray) -> Image.Image:
+    return Image.fromarray(array)
+
+def _image_source(key: str, data: Any, decoder: Any, image: Optional[Image.Image], size: Optional[Tuple[int, int]]) -> ImageSource:
+    source = ImageSource(key, bytes(data), decoder)
+    source.image = image
+    source._size = size
+    return source
+
+class _Pickler(pickle.Pickler):
+    """Pickles images as pixel arrays and image bytes as raw buffers, so that both can be passed
+    out-of-band (protocol 5) instead of being copied through the pickle stream."""
+    def reducer_override(self, obj: Any) -> Any:
+        if isinstance(obj, Image.Image) and obj.mode in _ARRAY_MODES:
+            return _image_from_array, (np.asarray(obj),)
+        if isinstance(obj, ImageSource):
+            # a decoded image is all the receiver needs, the encoded bytes only when it is not
+            data = b"" if obj.image is not None else obj.data
+            decoder = obj._decoder if getattr(obj._decoder, "__name__", None) != "<lambda>" else None
+            return _image_source, (obj.key, pickle.PickleBuffer(data), decoder, obj.image, obj._size)
+        return NotImplemented
+
+def pack(obj: Any, shared: bool = True) -> Tuple[bytes, Optional[shared_memory.SharedMemory]]:
+    """Serializes `obj` for a `multiprocessing.connection` peer. With `shared`, large buffers (pixel arrays,
+    image bytes, video frames) are laid out in one shared-memory segment that the receiver copies out
+    and unlinks; the sender `release`s its mapping of the returned segment once the message is sent,
+    or `discard`s the segment when the message could not be delivered."""
+    buffers: List[pickle.PickleBuffer] = []
+
+    def out_of_band(buffer: pickle.PickleBuffer) -> bool:
+        if not shared or buffer.raw().nbytes < SHARED_MIN_BYTES:
+            return True
+        buffers.append(buffer)
+        return False
+
+    stream = io.BytesIO()
+    _Pickler(stream, protocol=5, buffer_callback=out_of_band).dump(obj)
+    if not buffers:
+        return pickle.dumps((stream.getvalue(), None, [])), None
+
+    spans, offset = [], 0
+    for buffer in buffers:
+        spans.append((offset, buffer.raw().nbytes))
+        offset += buffer.raw().nbytes
+    segment = shared_memory.SharedMemory(create=True, size=offset)
+    # the receiver unlinks the segment: creating and attaching both register it with the resource tracker
+    # (which may be shared by the two processes), so each side unregisters what it registered
+    resource_tracker.unregister(segment._name, "shared_memory")
+    for buffer, (start, length) in zip(buffers, spans):
+        segment.buf[start:start + length] = buffer.raw().cast("B")
+    return pickle.dumps((stream.getvalue(), segment.name, spans)), segment
+
+def unpack(payload: bytes) -> Any:
+    body, name, spans = pickle.loads(payload)
+    if name is None:
+        return pickle.loads(body)
+
+    segment = shared_memory.SharedMemory(name=name)
+    try:
+        buffers = [bytearray(segment.buf[start:start + length]) for start, length in spans]
+    finally:
+        segment.close()
+        segment.unlink()
+    return pickle.loads(body, buffers=buffers)
+
+def release(segment: Optional[shared_memory.SharedMemory]):
+    if segment is not None:
+        segment.close()
+
+def discard(segment: Optional[shared_memory.SharedMemory]):
+    if segment is not None:
+        segment.close()
+        resource_tracker.register(segment._name, "shared_memory")
+        segment.unlink()
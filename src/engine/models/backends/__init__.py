@@ -0,0 +1,23 @@
+from src.engine.models.backends.base import InferenceBackend
+from src.engine.models.backends.cpu import CPUBackend
+from src.engine.models.backends.transformers_backend import TransformersBackend
+
+__all__ = [
+    "InferenceBackend",
+    "CPUBackend",
+    "TransformersBackend",
+    "BACKENDS",
+    "create_backend"
+]
+
+BACKENDS = {
+    TransformersBackend.name: TransformersBackend,
+    CPUBackend.name: CPUBackend
+}
+
+def create_backend(name: str, cpu_precision: str = "int8", cpu_threads: int = 0) -> InferenceBackend:
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {name}, expected one of {sorted(BACKENDS)}.")
+    if name == CPUBackend.name:
+        return CPUBackend(precision=cpu_precision, threads=cpu_threads)
+    return BACKENDS[name]()
@@ -0,0 +1,25 @@
+from abc import abstractmethod
+from typing import Any, Dict, Optional
+
+import torch
+
+class InferenceBackend(object):
+    """How a model's weights are placed and prepared for inference. Generation itself always goes through
+    the model's `generate`, so every backend keeps prefix/session KV reuse and the vision encoder cache."""
+    name: str = ""
+
+    def device(self, requested: torch.device) -> torch.device:
+        """The device a model assigned to `requested` actually runs on."""
+        return requested
+
+    @abstractmethod
+    def weights_kwargs(self, device: Optional[torch.device], distributed: bool) -> Dict[str, Any]:
+        """`from_pretrained` arguments placing the weights on `device` (or over every device when `distributed`)."""
+        raise NotImplementedError
+
+    def prepare(self, model: Any) -> Any:
+        """The model to serve, once its weights are loaded."""
+        return model
+
+    def describe(self) -> str:
+        return self.name
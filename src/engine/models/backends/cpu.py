@@ -0,0 +1,59 @@
+from typing import Any, Dict, Optional
+
+import torch
+
+from src.engine.models.backends.base import InferenceBackend
+from src.helpers.logging.logger import logger
+
+INT8, BF16, FP32 = "int8", "bf16", "fp32"
+
+def bf16_supported() -> bool:
+    """Whether the CPU has native bf16 arithmetic (AVX512-BF16 or AMX); emulated bf16 is slower than fp32."""
+    checks = [getattr(torch.cpu, name, None) for name in ("_is_avx512_bf16_supported", "_is_amx_tile_supported")]
+    return any(check is not None and check() for check in checks)
+
+class CPUBackend(InferenceBackend):
+    """Models kept on CPU whatever devices are configured, for hosts without a GPU.
+
+    `int8` quantizes the weights of every linear layer but the output head (dynamic quantization:
+    activations are quantized on the fly, so there is no calibration), which roughly quarters their
+    size and the memory traffic of each decode step. `bf16` halves it where the CPU computes in bf16
+    natively, and falls back to `fp32` elsewhere. `threads` sets the intra-op threads (0 keeps torch's
+    default, one per physical core), shared by every model of the process.
+    """
+    name = "cpu"
+
+    def __init__(self, precision: str = INT8, threads: int = 0):
+        if precision not in (INT8, BF16, FP32):
+            raise ValueError(f"Unknown CPU precision {precision}, expected {INT8}, {BF16} or {FP32}.")
+        if precision == BF16 and not bf16_supported():
+            logger.warning("This CPU has no native bf16 support, the CPU backend falls back to fp32.")
+            precision = FP32
+        self.precision = precision
+        if threads > 0:
+            torch.set_num_threads(threads)
+
+    def device(self, requested: torch.device) -> torch.device:
+        return torch.device("cpu")
+
+    def weights_kwargs(self, device: Optional[torch.device], distributed: bool) -> Dict[str, Any]:
+        return {
+            # dynamically quantized layers take fp32 activations
+            "torch_dtype": torch.bfloat16 if self.precision == BF16 else torch.float32,
+            "device_map": {"": "cpu"},
+            "low_cpu_mem_usage": True
+        }
+
+    def prepare(self, model: Any) -> Any:
+        if self.precision == INT8:
+            # the output head stays in full precision: it decides every token, and its weights are often tied to the embeddings
+            layers = {
+                name: torch.ao.quantization.default_dynamic_qconfig
+                for name, module in model.named_modules()
+                if isinstance(module, torch.nn.Linear) and not name.endswith("lm_head")
+            }
+            model = torch.ao.quantization.quantize_dynamic(model, layers, dtype=torch.qint8, inplace=True)
+        return model.eval()
+
+    def describe(self) -> str:
+        return f"{self.name} ({self.precision}, {torch.get_num_threads()} threads)"
@@ -0,0 +1,17 @@
+from typing import Any, Dict, Optional
+
+import torch
+
+from src.engine.models.backends.base import InferenceBackend
+
+class TransformersBackend(InferenceBackend):
+    """Eager PyTorch with the checkpoint's own dtype, on the assigned GPU (or CPU when there is none)."""
+    name = "transformers"
+
+    def weights_kwargs(self, device: Optional[torch.device], distributed: bool) -> Dict[str, Any]:
+        # safetensors are memory-mapped and copied tensor by tensor onto the device, without a full copy on CPU first
+        return {
+            "torch_dtype": "auto",
+            "device_map": "auto" if distributed else {"": str(device)},
+            "low_cpu_mem_usage": True
+        }
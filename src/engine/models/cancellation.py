@@ -0,0 +1,99 @@
+import threading
+from typing import Any, Callable, Collection, List, Optional, Sequence, Set
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+from src.helpers.metrics.stats import stats
+
+class GenerationCancelled(RuntimeError):
+    pass
+
+class CancellationToken(object):
+    """Thread-safe flag set by the web layer and polled by the generating thread between decode steps."""
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks: List[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        if self._event.is_set():
+            return
+        self._event.set()
+        for callback in self._callbacks:
+            callback()
+
+    def add_callback(self, callback: Callable[[], None]):
+        self._callbacks.append(callback)
+        if self.cancelled:
+            callback()
+
+class SharedCancellationToken(CancellationToken):
+    """Token of a call shared by several callers: cancelled once every attached caller is."""
+    def __init__(self):
+        super(SharedCancellationToken, self).__init__()
+        self._tokens: List[CancellationToken] = []
+
+    def attach(self, token: CancellationToken):
+        self._tokens.append(token)
+        token.add_callback(self._on_attached_cancelled)
+
+    def _on_attached_cancelled(self):
+        if all(token.cancelled for token in self._tokens):
+            self.cancel()
+
+class CancellationCriteria(StoppingCriteria):
+    """Stops the rows of a batch whose token got cancelled and remembers how many tokens
+    each of them had produced at that point."""
+    def __init__(
+        self,
+        tokens: Sequence[Optional[CancellationToken]],
+        prompt_length: int,
+        finished_ids: Collection[int] = ()
+    ):
+        self._tokens = tokens
+        self._prompt_length = prompt_length
+        self._finished_ids = set(finished_ids)
+        self.cancelled_at: List[Optional[int]] = [None] * len(tokens)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        for row, token in enumerate(self._tokens):
+            if self.cancelled_at[row] is not None or token is None or not token.cancelled:
+                continue
+            # rows that already hit EOS are only padded from now on, nothing to save there
+            if int(input_ids[row, -1]) in self._finished_ids:
+                continue
+            self.cancelled_at[row] = input_ids.shape[1] - self._prompt_length
+        return torch.tensor([at is not None for at in self.cancelled_at], device=input_ids.device, dtype=torch.bool)
+
+    def report(self, name: str, max_new_tokens: int):
+        for generated in self.cancelled_at:
+            if generated is None:
+                continue
+            stats.counter(f"{name}_cancelled_requests").inc()
+            stats.counter(f"{name}_cancelled_tokens_generated").inc(generated)
+            stats.counter(f"{name}_cancelled_tokens_saved").inc(max(0, max_new_tokens - generated))
+
+def finished_token_ids(generation_config: Any) -> Set[int]:
+    """Ids `generate` writes into rows that are already done (EOS and padding)."""
+    ids = set()
+    for value in (generation_config.eos_token_id, generation_config.pad_token_id):
+        if value is None:
+            continue
+        ids.update(value if isinstance(value, (list, tuple)) else [value])
+    return ids
+
+def cancellation_criteria(
+    tokens: Optional[Sequence[Optional[CancellationToken]]],
+    prompt_length: int,
+    generation_config: Any
+) -> Optional[CancellationCriteria]:
+    if not tokens or all(token is None for token in tokens):
+        return None
+    return CancellationCriteria(tokens, prompt_length, finished_token_ids(generation_config))
+
+def stopping_criteria(criteria: Optional[CancellationCriteria]) -> Optional[StoppingCriteriaList]:
+    return StoppingCriteriaList([criteria]) if criteria is not None else None
@@ -0,0 +1,98 @@
+import threading
+from collections import OrderedDict
+from typing import Any, List, Optional, Tuple
+
+import torch
+from transformers import DynamicCache
+
+from src.helpers.metrics.stats import stats
+
+KVLayers_t = List[Tuple[torch.Tensor, torch.Tensor]]
+
+def cache_layers(cache: Any) -> KVLayers_t:
+    """Returns the (keys, values) tensors of every layer of a transformers cache."""
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    if hasattr(cache, "key_cache"):
+        return list(zip(cache.key_cache, cache.value_cache))
+    return [(keys, values) for keys, values in cache]
+
+def build_cache(layers: KVLayers_t, batch_size: int = 1) -> DynamicCache:
+    """Builds a fresh DynamicCache holding `layers`, broadcast to `batch_size` rows.
+
+    DynamicCache concatenates new tokens into new tensors, so the (expanded) source
+    tensors are never written to and can be shared between requests.
+    """
+    cache = DynamicCache()
+    for layer_idx, (keys, values) in enumerate(layers):
+        cache.update(
+            keys.expand(batch_size, -1, -1, -1),
+            values.expand(batch_size, -1, -1, -1),
+            layer_idx
+        )
+    return cache
+
+@torch.no_grad()
+def compute_prefix_layers(model: torch.nn.Module, input_ids: torch.Tensor) -> KVLayers_t:
+    outputs = model(input_ids=input_ids, use_cache=True)
+    return [(keys.detach(), values.detach()) for keys, values in cache_layers(outputs.past_key_values)]
+
+def layers_nbytes(layers: KVLayers_t) -> int:
+    return sum(keys.numel() * keys.element_size() + values.numel() * values.element_size() for keys, values in layers)
+
+def crop_layers(layers: KVLayers_t, length: int) -> KVLayers_t:
+    return [(keys[:, :, :length], values[:, :, :length]) for keys, values in layers]
+
+def common_prefix_length(a: torch.Tensor, b: torch.Tensor) -> int:
+    length = min(a.shape[-1], b.shape[-1])
+    mismatches = (a[:length] != b[:length]).nonzero()
+    return int(mismatches[0]) if len(mismatches) else length
+
+class KVCacheEntry(object):
+    def __init__(self, token_ids: torch.Tensor, layers: KVLayers_t):
+        self.token_ids = token_ids
+        self.layers = layers
+        self.nbytes = layers_nbytes(layers)
+
+class KVCacheStore(object):
+    """Per-session KV caches kept under a global memory budget, least recently used evicted first.
+
+    An evicted entry only costs a recomputation: callers rebuild it from the conversation history.
+    """
+    def __init__(self, name: str, budget_bytes: int):
+        self._budget_bytes = budget_bytes
+        self._entries: "OrderedDict[str, KVCacheEntry]" = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+        self._evictions = stats.counter(f"{name}_kv_store_evictions")
+        stats.gauge(f"{name}_kv_store_bytes", lambda: self._nbytes)
+        stats.gauge(f"{name}_kv_store_entries", lambda: len(self._entries))
+
+    def get(self, key: str) -> Optional[KVCacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: KVCacheEntry):
+        with self._lock:
+            self._discard(key)
+            if entry.nbytes > self._budget_bytes:
+                return
+            self._entries[key] = entry
+            self._nbytes += entry.nbytes
+            while self._nbytes > self._budget_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+                self._evictions.inc()
+
+    def pop(self, key: str):
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._nbytes -= entry.nbytes
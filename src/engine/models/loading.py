@@ -0,0 +1,94 @@
+import glob
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
+import torch
+from huggingface_hub import snapshot_download
+
+from src.engine.models.backends import InferenceBackend, TransformersBackend
+from src.helpers.metrics.stats import stats
+
+# `from_pretrained` swaps process-wide state while it builds a model (default dtype, weight init functions,
+# `nn.Module.register_parameter` patched to put new parameters on the meta device), and the weights it then
+# loads into the skeleton are registered through that same method: two builds at once would corrupt each
+# other, so they take this lock one at a time. Inference does not take it. It registers no parameters and
+# its tensors carry their own dtype, so resident models keep serving while another one loads.
+construction_lock = threading.Lock()
+
+def from_pretrained_cached(loader: Callable[..., Any], name: str, cache_dir: str, offline: bool = False, **kwargs) -> Any:
+    """`loader(name)` resolved from `cache_dir` without a round trip to the hub. Only when the files
+    are not cached yet (first start) are they downloaded, unless `offline`."""
+    try:
+        return loader(name, cache_dir=cache_dir, local_files_only=True, **kwargs)
+    except OSError:
+        if offline:
+            raise
+        return loader(name, cache_dir=cache_dir, **kwargs)
+
+def weight_files(name: str, cache_dir: str) -> List[str]:
+    """Safetensors shards of `name` already on disk (a local directory or the hub cache)."""
+    if os.path.isdir(name):
+        directory = name
+    else:
+        try:
+            directory = snapshot_download(name, cache_dir=cache_dir, local_files_only=True, allow_patterns=["*.safetensors"])
+        except Exception:
+            return []
+    return sorted(glob.glob(os.path.join(directory, "*.safetensors")))
+
+def prefetch(paths: List[str]):
+    """Asks the kernel to read `paths` into the page cache in the background, so that the memory-mapped
+    shards are resident by the time the model is built (e.g. while another model is being loaded)."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+def load_weights(
+    loader: Callable[..., Any],
+    name: str,
+    cache_dir: str,
+    device: Optional[torch.device],
+    distributed: bool,
+    offline: bool = False,
+    phase: str = "weights",
+    backend: Optional[InferenceBackend] = None
+) -> Any:
+    """Builds the model with `backend`'s placement (transformers by default) and returns it prepared for inference."""
+    backend = backend or TransformersBackend()
+    # while waiting for another model to be built, this one's shards are already being read
+    prefetch(weight_files(name, cache_dir))
+    with construction_lock, startup.phase(phase):
+        model = from_pretrained_cached(loader, name, cache_dir, offline=offline, **backend.weights_kwargs(device, distributed))
+        return backend.prepare(model)
+
+class StartupTimings(object):
+    """Wall time of each phase of model startup (weights, tokenizer, ...), recorded from any thread."""
+    def __init__(self):
+        self._phases: List[Tuple[str, float]] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        timing = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - timing
+            stats.gauge(f"startup_{name.replace('.', '_')}_seconds", lambda: elapsed)
+            with self._lock:
+                self._phases.append((name, elapsed))
+
+    def breakdown(self) -> str:
+        with self._lock:
+            phases = list(self._phases)
+        return ", ".join(f"{name} {elapsed:.2f}s" for name, elapsed in phases)
+
+startup = StartupTimings()
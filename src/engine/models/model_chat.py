@@ -1,13 +1,28 @@
 import os
 from abc import abstractmethod
-from typing import List, Optional
+from typing import Any, Callable, Dict, List, Optional
     
 import torch
-from transformers import (AutoModelForCausalLM,  AutoTokenizer,)
+from transformers import (AutoModelForCausalLM,  AutoTokenizer, TextStreamer)
 
 from transformers.models.qwen2.modeling_qwen2 import Qwen2ForCausalLM
 from transformers.models.qwen2.tokenization_qwen2_fast import Qwen2TokenizerFast
 
+from src.engine.models import cancellation, kv_cache, loading, speculative
+from src.engine.models.backends import InferenceBackend, TransformersBackend
+from src.engine.models.cancellation import CancellationToken
+from src.helpers.metrics.stats import stats
+
+class CallbackStreamer(TextStreamer):
+    """Hands every finalized piece of decoded text to `on_text` (called from the generating thread)."""
+    def __init__(self, tokenizer, on_text: Callable[[str], None], **decode_kwargs):
+        super(CallbackStreamer, self).__init__(tokenizer, skip_prompt=True, **decode_kwargs)
+        self._on_text = on_text
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text:
+            self._on_text(text)
+
 class ChatModel(object):
     def __init__(
         self, 
@@ -24,58 +39,226 @@ class ChatModel(object):
     def answer(self, prompt: str) -> str:
         raise NotImplementedError
 
+    @abstractmethod
+    def answer_batch(self, prompts: List[str], cancel_tokens: Optional[List[Optional[CancellationToken]]] = None) -> List[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def answer_stream(self, prompt: str, on_text: Callable[[str], None], cancel_token: Optional[CancellationToken] = None) -> str:
+        raise NotImplementedError
+
+    @abstractmethod
+    def answer_session(self, session_id: str, messages: List[Dict[str, str]], cancel_token: Optional[CancellationToken] = None) -> str:
+        raise NotImplementedError
+
+    @abstractmethod
+    def close_session(self, session_id: str):
+        raise NotImplementedError
+
 class GwenModel(ChatModel):
+    SYSTEM_PROMPT = "You are Qwen, created by Alibaba Cloud. You are a helpful assistant."
+    
     def __init__(
         self,
         device_id: str, 
         cache_dir: str = "./.caches",
         max_new_token: int = 512,
         chat_model: str = "Qwen/Qwen2.5-7B-Instruct",
-        distributed: bool = False
+        distributed: bool = False,
+        system_prompt: Optional[str] = None,
+        prefix_cache: bool = True,
+        session_budget_mb: int = 2048,
+        offline: bool = False,
+        backend: Optional[InferenceBackend] = None,
+        draft_model: Optional[str] = None,
+        speculative_min_acceptance: float = 0.3
     ):
         super(GwenModel, self).__init__(device_id, distributed)
+        self._backend = backend or TransformersBackend()
+        if not distributed:
+            self.device = self._backend.device(self.device)
         self._model_name = chat_model
         self._cache_dir = cache_dir
         self._max_token = max_new_token
+        self._system_prompt = system_prompt or self.SYSTEM_PROMPT
+        self._offline = offline
+        self._draft_model_name = draft_model
+        self._speculative_min_acceptance = speculative_min_acceptance
+        self.session_store = kv_cache.KVCacheStore("chat_session", session_budget_mb * 1024 * 1024)
         self._init_model()
+        if prefix_cache:
+            with loading.startup.phase("chat.prefix_cache"):
+                self._init_prefix_cache()
         
     def _init_model(self):
-        if self._distributed:
-            self.chat_model: Qwen2ForCausalLM = AutoModelForCausalLM.from_pretrained(
-                pretrained_model_name_or_path=self._model_name,
-                torch_dtype="auto",
-                device_map="auto",
-                cache_dir=os.path.join(self._cache_dir, "ChatAssistant")
+        cache_dir = os.path.join(self._cache_dir, "ChatAssistant")
+        with loading.startup.phase("chat.tokenizer"):
+            self.chat_tokenizer: Qwen2TokenizerFast = loading.from_pretrained_cached(
+                AutoTokenizer.from_pretrained, self._model_name, cache_dir, offline=self._offline
             )
-        else:
-            self.chat_model: Qwen2ForCausalLM = AutoModelForCausalLM.from_pretrained(
-                pretrained_model_name_or_path=self._model_name,
-                torch_dtype="auto",
-                device_map=None,
-                cache_dir=os.path.join(self._cache_dir, "ChatAssistant")
-            ).to(self.device)
-            
-        self.chat_tokenizer: Qwen2TokenizerFast = AutoTokenizer.from_pretrained(self._model_name)
+        self.chat_model: Qwen2ForCausalLM = loading.load_weights(
+            AutoModelForCausalLM.from_pretrained,
+            self._model_name,
+            cache_dir,
+            getattr(self, "device", None),
+            self._distributed,
+            offline=self._offline,
+            phase="chat.weights",
+            backend=self._backend
+        )
+        # batched prompts are left-padded so every row ends right where generation starts
+        self.chat_tokenizer.padding_side = "left"
+        self.speculative: Optional[speculative.SpeculativeDecoder] = None
+        if self._draft_model_name:
+            self._init_draft_model(cache_dir)
+
+    def _init_draft_model(self, cache_dir: str):
+        with loading.startup.phase("chat.draft_tokenizer"):
+            draft_tokenizer = loading.from_pretrained_cached(
+                AutoTokenizer.from_pretrained, self._draft_model_name, cache_dir, offline=self._offline
+            )
+        # on the target's device, the draft runs in lockstep with it
+        draft_model = loading.load_weights(
+            AutoModelForCausalLM.from_pretrained,
+            self._draft_model_name,
+            cache_dir,
+            getattr(self, "device", None),
+            self._distributed,
+            offline=self._offline,
+            phase="chat.draft_weights",
+            backend=self._backend
+        )
+        self.speculative = speculative.SpeculativeDecoder(
+            "chat",
+            self.chat_model,
+            draft_model,
+            target_tokenizer=self.chat_tokenizer,
+            draft_tokenizer=draft_tokenizer,
+            min_acceptance=self._speculative_min_acceptance
+        )
             
-    def answer(self, question: str) -> str:
-        messages = [
-            {"role": "system", "content": "You are Qwen, created by Alibaba Cloud. You are a helpful assistant."},
-            {"role": "user", "content": question}
-        ]
+    def _init_prefix_cache(self):
+        """Encodes the system turn, which every request starts with, once and keeps its past-key-values."""
+        self._prefix_text = self.chat_tokenizer.apply_chat_template(
+            [{"role": "system", "content": self._system_prompt}],
+            tokenize=False
+        )
+        # the template has to render the system turn as a plain prefix of the full conversation
+        if not self._render("").startswith(self._prefix_text):
+            self._prefix_text = None
+            return
         
+        self._prefix_ids = self.chat_tokenizer(self._prefix_text, return_tensors="pt").input_ids.to(self.chat_model.device)
+        self._prefix_layers = kv_cache.compute_prefix_layers(self.chat_model, self._prefix_ids)
+
+    def _render(self, question: str) -> str:
+        return self.chat_tokenizer.apply_chat_template(
+            [
+                {"role": "system", "content": self._system_prompt},
+                {"role": "user", "content": question}
+            ],
+            tokenize=False,
+            add_generation_prompt=True
+        )
+
+    def _build_inputs(self, questions: List[str]) -> Dict[str, Any]:
+        texts = [self._render(question) for question in questions]
+        if getattr(self, "_prefix_text", None) is None:
+            return dict(self.chat_tokenizer(texts, padding=True, return_tensors="pt").to(self.chat_model.device))
+        
+        # only the per-request suffix is tokenized; rows are laid out as [prefix][padding][suffix],
+        # positions come from the attention mask so the padding hole does not shift the suffix
+        suffix_inputs = self.chat_tokenizer(
+            [text[len(self._prefix_text):] for text in texts],
+            padding=True,
+            add_special_tokens=False,
+            return_tensors="pt"
+        ).to(self.chat_model.device)
+        batch_size = len(texts)
+        prefix_ids = self._prefix_ids.expand(batch_size, -1)
+        return {
+            "input_ids": torch.cat([prefix_ids, suffix_inputs.input_ids], dim=1),
+            "attention_mask": torch.cat([torch.ones_like(prefix_ids), suffix_inputs.attention_mask], dim=1),
+            "past_key_values": kv_cache.build_cache(self._prefix_layers, batch_size)
+        }
+
+    def answer(self, question: str) -> str:
+        return self.answer_batch([question])[0]
+
+    def _generate(self, model_inputs: Dict[str, Any], **kwargs) -> Any:
+        if self.speculative is None:
+            return self.chat_model.generate(**model_inputs, **kwargs)
+        return self.speculative.generate(self.chat_model, model_inputs, **kwargs)
+
+    def _cancellation(self, cancel_tokens: Optional[List[Optional[CancellationToken]]], prompt_length: int) -> Optional[cancellation.CancellationCriteria]:
+        return cancellation.cancellation_criteria(cancel_tokens, prompt_length, self.chat_model.generation_config)
+
+    def answer_batch(self, questions: List[str], cancel_tokens: Optional[List[Optional[CancellationToken]]] = None) -> List[str]:
+        """Rows whose token gets cancelled stop at the next decode step and return what they had so far."""
+        model_inputs = self._build_inputs(questions)
+        prompt_length = model_inputs["input_ids"].shape[1]
+        criteria = self._cancellation(cancel_tokens, prompt_length)
+        generated_ids = self._generate(
+            model_inputs,
+            max_new_tokens=self._max_token,
+            stopping_criteria=cancellation.stopping_criteria(criteria)
+        )
+        if criteria is not None:
+            criteria.report("chat", self._max_token)
+        generated_ids = generated_ids[:, prompt_length:]
+        return self.chat_tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
+
+    def answer_stream(self, question: str, on_text: Callable[[str], None], cancel_token: Optional[CancellationToken] = None) -> str:
+        model_inputs = self._build_inputs([question])
+        prompt_length = model_inputs["input_ids"].shape[1]
+        criteria = self._cancellation([cancel_token], prompt_length)
+        generated_ids = self._generate(
+            model_inputs,
+            max_new_tokens=self._max_token,
+            streamer=CallbackStreamer(self.chat_tokenizer, on_text, skip_special_tokens=True),
+            stopping_criteria=cancellation.stopping_criteria(criteria)
+        )
+        if criteria is not None:
+            criteria.report("chat", self._max_token)
+        generated_ids = generated_ids[:, prompt_length:]
+        return self.chat_tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
+
+    def answer_session(self, session_id: str, messages: List[Dict[str, str]], cancel_token: Optional[CancellationToken] = None) -> str:
+        """Answers the last user turn of `messages`, re-using the session's KV cache for every token
+        already encoded in previous turns. A missing (evicted) cache is rebuilt from the history."""
         text = self.chat_tokenizer.apply_chat_template(
-            messages,
+            [{"role": "system", "content": self._system_prompt}, *messages],
             tokenize=False,
             add_generation_prompt=True
         )
+        input_ids = self.chat_tokenizer(text, return_tensors="pt").input_ids.to(self.chat_model.device)
+        
+        cached = self.session_store.get(session_id)
+        if cached is None and getattr(self, "_prefix_text", None) is not None:
+            cached = kv_cache.KVCacheEntry(self._prefix_ids[0], self._prefix_layers)
+        
+        # re-use the longest cached prefix, at least the last token has to be fed to get logits
+        reused = 0
+        if cached is not None:
+            reused = min(kv_cache.common_prefix_length(cached.token_ids, input_ids[0]), cached.layers[0][0].shape[-2], input_ids.shape[1] - 1)
+        past_key_values = kv_cache.build_cache(kv_cache.crop_layers(cached.layers, reused)) if reused > 0 else None
+        stats.summary("chat_session_reused_tokens").observe(reused)
+        stats.summary("chat_session_new_tokens").observe(input_ids.shape[1] - reused)
         
-        model_inputs = self.chat_tokenizer([text], return_tensors="pt").to(self.chat_model.device)
-        generated_ids = self.chat_model.generate(
-            **model_inputs,
-            max_new_tokens=self._max_token
+        criteria = self._cancellation([cancel_token], input_ids.shape[1])
+        outputs = self._generate(
+            {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids), "past_key_values": past_key_values},
+            max_new_tokens=self._max_token,
+            return_dict_in_generate=True,
+            stopping_criteria=cancellation.stopping_criteria(criteria)
         )
-        generated_ids = [
-            output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
-        ]
-        response = self.chat_tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
-        return response
\ No newline at end of file
+        if criteria is not None:
+            criteria.report("chat", self._max_token)
+        
+        # the cache covers every token but the last generated one
+        layers = kv_cache.cache_layers(outputs.past_key_values)
+        self.session_store.put(session_id, kv_cache.KVCacheEntry(outputs.sequences[0, :layers[0][0].shape[-2]], layers))
+        return self.chat_tokenizer.decode(outputs.sequences[0, input_ids.shape[1]:], skip_special_tokens=True)
+
+    def close_session(self, session_id: str):
+        self.session_store.pop(session_id)
@@ -0,0 +1,61 @@
+import os
+from abc import abstractmethod
+from typing import List
+
+import numpy as np
+import torch
+from transformers import AutoModel, AutoTokenizer
+
+from src.engine.models import loading
+
+class EmbeddingModel(object):
+    @abstractmethod
+    def embed(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+class SentenceEmbeddingModel(EmbeddingModel):
+    """Small sentence encoder run on CPU: mean-pooled, L2-normalized float32 vectors."""
+    def __init__(
+        self,
+        model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+        cache_dir: str = "./.caches",
+        max_length: int = 256,
+        offline: bool = False
+    ):
+        self._model_name = model_name
+        self._cache_dir = cache_dir
+        self._max_length = max_length
+        self._offline = offline
+        self._init_model()
+
+    def _init_model(self):
+        cache_dir = os.path.join(self._cache_dir, "EmbeddingModel")
+        # built lazily, possibly while the chat or vision model is being built or generates
+        self.embedding_model = loading.load_weights(
+            AutoModel.from_pretrained,
+            self._model_name,
+            cache_dir,
+            torch.device("cpu"),
+            False,
+            offline=self._offline,
+            phase="embedding.weights"
+        )
+        with loading.startup.phase("embedding.tokenizer"):
+            self.embedding_tokenizer = loading.from_pretrained_cached(
+                AutoTokenizer.from_pretrained, self._model_name, cache_dir, offline=self._offline
+            )
+
+    @torch.no_grad()
+    def embed(self, texts: List[str]) -> np.ndarray:
+        inputs = self.embedding_tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=self._max_length,
+            return_tensors="pt"
+        )
+        hidden = self.embedding_model(**inputs).last_hidden_state
+        mask = inputs.attention_mask.unsqueeze(-1).to(hidden.dtype)
+        vectors = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+        vectors = torch.nn.functional.normalize(vectors, p=2, dim=1)
+        return vectors.float().numpy()
@@ -1,8 +1,12 @@
+import hashlib
 import os
+import threading
 from abc import abstractmethod
-from typing import List, Optional
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple, Union
 
 import sys   
+import numpy as np
 import torch
 from PIL import Image
 from qwen_vl_utils import process_vision_info
@@ -11,6 +15,16 @@ from transformers import (AutoProcessor,
 
 from transformers.models.qwen2_vl.processing_qwen2_vl import Qwen2VLProcessor
 
+from src.engine.models import cancellation, loading, video_sampling
+from src.engine.models.backends import InferenceBackend, TransformersBackend
+from src.engine.models.cancellation import CancellationToken
+from src.engine.models.vision_cache import ImageSource, VisionCacheEntry, VisionEncoderCache
+from src.helpers.logging.logger import logger
+from src.helpers.metrics.stats import stats
+
+Image_t = Union[Image.Image, ImageSource]
+Video_t = Union[str, np.ndarray]
+
 class VisionModel(object):
     def __init__(self, 
         device_id: Optional[str] = None,
@@ -27,15 +41,28 @@ class VisionModel(object):
         pass
     
     @abstractmethod
-    def describe_image(self, image: Image.Image) -> str:
+    def describe_image(self, image: Image_t, cancel_token: Optional[CancellationToken] = None) -> str:
         pass
 
     @abstractmethod
-    def analyse_images_with_prompt(self, images: List[Image.Image], prompt: str) -> List[str]:
+    def analyse_images_with_prompt(self, images: List[Image_t], prompt: str, cancel_token: Optional[CancellationToken] = None) -> List[str]:
         pass
 
+    def analyse_batch(
+        self,
+        items: List[Tuple[List[Image_t], str, Optional[int]]],
+        cancel_tokens: Optional[List[Optional[CancellationToken]]] = None
+    ) -> List[str]:
+        raise NotImplementedError
+
+    def batch_token_capacity(self, max_tokens: int) -> int:
+        return max_tokens
+
+    def is_image_cached(self, image: Image_t, resized_height: Optional[int] = None) -> bool:
+        return False
+
     @abstractmethod
-    def describe_video(self, video: str, **kwargs) -> str:
+    def describe_video(self, video: Video_t, cancel_token: Optional[CancellationToken] = None, **kwargs) -> str:
         pass
 
 class GwenVisionModel(VisionModel):
@@ -47,93 +74,231 @@ class GwenVisionModel(VisionModel):
         cache_dir: str = "",
         model_name: str = "Qwen/Qwen2-VL-7B-Instruct",
         max_token: int = 128,
-        distributed: bool = False        
+        distributed: bool = False,
+        encoder_cache_mb: int = 1024,
+        encoder_cache_spill: bool = False,
+        encoder_cache_spill_mb: int = 8192,
+        offline: bool = False,
+        backend: Optional[InferenceBackend] = None
     ):
         super(GwenVisionModel, self).__init__(device_id, distributed)
+        self._backend = backend or TransformersBackend()
+        if not distributed:
+            self.device = self._backend.device(self.device)
         self._cache_dir = cache_dir
+        self._offline = offline
         self._model_name = model_name
         self._max_token = max_token
+        self.encoder_cache = VisionEncoderCache(
+            name="vision",
+            budget_bytes=encoder_cache_mb * 1024 * 1024,
+            spill_dir=os.path.join(cache_dir, "vision_encoder_cache") if encoder_cache_spill else None,
+            spill_max_bytes=encoder_cache_spill_mb * 1024 * 1024
+        ) if encoder_cache_mb > 0 else None
+        self._pending = threading.local()
+        self._encoded_images = stats.counter("vision_encoded_images")
         self._init_model()
+        self._init_feature_cache()
         
     def _init_model(self):
-        if self._distributed:
-            self.vision_model = Qwen2VLForConditionalGeneration.from_pretrained(
-                pretrained_model_name_or_path=self._model_name, 
-                torch_dtype="auto", 
-                device_map="auto", 
-                cache_dir=os.path.join(self._cache_dir, "VisionLanguageAssistant")
+        cache_dir = os.path.join(self._cache_dir, "VisionLanguageAssistant")
+        with loading.startup.phase("vision.processor"):
+            self.processor: Qwen2VLProcessor = loading.from_pretrained_cached(
+                AutoProcessor.from_pretrained, self._model_name, cache_dir, offline=self._offline
             )
-        else:
-            self.vision_model = Qwen2VLForConditionalGeneration.from_pretrained(
-                pretrained_model_name_or_path=self._model_name, 
-                torch_dtype="auto", 
-                device_map=None, 
-                cache_dir=os.path.join(self._cache_dir, "VisionLanguageAssistant")
-            ).to(self.device)
-        
-        self.processor: Qwen2VLProcessor = AutoProcessor.from_pretrained(self._model_name)
+        self.vision_model = loading.load_weights(
+            Qwen2VLForConditionalGeneration.from_pretrained,
+            self._model_name,
+            cache_dir,
+            getattr(self, "device", None),
+            self._distributed,
+            offline=self._offline,
+            phase="vision.weights",
+            backend=self._backend
+        )
+        # batched prompts are padded on the left so that generation continues every row at the end
+        self.processor.tokenizer.padding_side = "left"
         
     def generate_image(self, prompt: str) -> Image.Image:
         pass
     
-    def describe_image(self, image: Image.Image) -> str:
-        return self.analyse_images_with_prompt([image], "Describe this image.")
+    def _init_feature_cache(self):
+        """Routes the model's image encoding through the entries of the current call, so that
+        images whose encoder output is cached skip the vision tower."""
+        inner = getattr(self.vision_model, "model", self.vision_model)
+        if not hasattr(inner, "get_image_features"):
+            # the cache relies on the hook: without it, cached entries would be encoded again from pixels that are not kept
+            if self.encoder_cache is not None:
+                logger.warning("This transformers version does not expose get_image_features, the vision encoder cache is disabled.")
+            self.encoder_cache = None
+            return
+        encode = inner.get_image_features
+        
+        def get_image_features(pixel_values: torch.Tensor, image_grid_thw: Optional[torch.Tensor] = None, *args, **kwargs):
+            entries: Optional[List[VisionCacheEntry]] = getattr(self._pending, "entries", None)
+            if not entries:
+                return encode(pixel_values, image_grid_thw, *args, **kwargs)
+            
+            missing = list({id(entry): entry for entry in entries if entry.embeds is None}.values())
+            if missing:
+                self._encoded_images.inc(len(missing))
+                embeds = encode(
+                    torch.cat([entry.pixel_values for entry in missing]).to(pixel_values.device),
+                    torch.cat([entry.grid_thw for entry in missing]).to(image_grid_thw.device),
+                    *args,
+                    **kwargs
+                )
+                for entry, entry_embeds in zip(missing, embeds):
+                    # the pixels are only ever read here, the encoder output replaces them; both are fresh
+                    # tensors, a view (of the batch output, or an empty slice) would keep the whole storage alive
+                    entry.embeds = entry_embeds.detach().to("cpu", copy=True)
+                    entry.pixel_values = entry.pixel_values.new_empty((0, entry.pixel_values.shape[-1]))
+            return tuple(entry.embeds.to(pixel_values.device) for entry in entries)
+        
+        inner.get_image_features = get_image_features
 
-    def analyse_images_with_prompt(self, images: List[Image.Image], prompt: str) -> List[str]:
-        messages = [
+    @contextmanager
+    def _encoding(self, entries: List[VisionCacheEntry]) -> Iterator[None]:
+        self._pending.entries = entries
+        try:
+            yield
+        finally:
+            self._pending.entries = None
+
+    def _cache_key(self, image: Image_t, resized_height: int) -> Optional[str]:
+        if self.encoder_cache is None or not isinstance(image, ImageSource):
+            return None
+        # the entry depends on the bytes, the resize and the model (encoder output)
+        return hashlib.sha256(f"{image.key}|{resized_height}|{self._model_name}".encode()).hexdigest()
+
+    def is_image_cached(self, image: Image_t, resized_height: Optional[int] = None) -> bool:
+        key = self._cache_key(image, resized_height or self.FIXED_RESIZED_HEIGHT)
+        return key is not None and self.encoder_cache.contains(key)
+
+    def _preprocess_image(self, image: Image.Image, resized_height: int) -> VisionCacheEntry:
+        image_inputs, _ = process_vision_info([
             {
                 "role": "user",
                 "content": [
-                    *[
-                        {
-                            "type": "image",
-                            "image": image,
-                            "resized_height": self.FIXED_RESIZED_HEIGHT,
-                            "resized_width": self.FIXED_RESIZED_HEIGHT / image.height * image.width
-                        }
-                        for image in images
-                    ],
                     {
-                        "type": "text", 
-                        "text": prompt
-                    },
-                ],
+                        "type": "image",
+                        "image": image,
+                        "resized_height": resized_height,
+                        "resized_width": resized_height / image.height * image.width
+                    }
+                ]
             }
-        ]
+        ])
+        inputs = self.processor.image_processor(images=image_inputs, return_tensors="pt")
+        # the encoder casts its input to its own dtype anyway
+        return VisionCacheEntry(inputs["pixel_values"].to(self.vision_model.visual.dtype), inputs["image_grid_thw"])
 
-        text = self.processor.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True
-        )
-        image_inputs, video_inputs = process_vision_info(messages)
-        inputs = self.processor(
-            text=[text],
-            images=image_inputs,
-            videos=video_inputs,
-            padding=True,
-            return_tensors="pt",
-        ).to(self.vision_model.device)
+    def _image_entries(self, images: List[Image_t], resized_height: int) -> List[VisionCacheEntry]:
+        """Decoded, resized and normalized patches of every image, from the cache when possible."""
+        entries = []
+        for image in images:
+            key = self._cache_key(image, resized_height)
+            entry = self.encoder_cache.get(key) if key is not None else None
+            if entry is None:
+                entry = self._preprocess_image(image.load() if isinstance(image, ImageSource) else image, resized_height)
+            entries.append(entry)
+        return entries
 
-        # Inference: Generation of the output
-        generated_ids = self.vision_model.generate(**inputs, max_new_tokens=self._max_token)
-        generated_ids_trimmed = [
-            out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
+    def _expand_image_tokens(self, text: str, entries: List[VisionCacheEntry]) -> str:
+        # same expansion as the processor: one pad token per merged patch of each image
+        merge_length = self.processor.image_processor.merge_size ** 2
+        for entry in entries:
+            text = text.replace(self.processor.image_token, "<|placeholder|>" * int(entry.grid_thw.prod() // merge_length), 1)
+        return text.replace("<|placeholder|>", self.processor.image_token)
+
+    def describe_image(self, image: Image_t, cancel_token: Optional[CancellationToken] = None, resized_height: Optional[int] = None) -> str:
+        return self.analyse_images_with_prompt([image], "Describe this image.", cancel_token=cancel_token, resized_height=resized_height)
+
+    def analyse_images_with_prompt(
+        self,
+        images: List[Image_t],
+        prompt: str,
+        cancel_token: Optional[CancellationToken] = None,
+        resized_height: Optional[int] = None
+    ) -> List[str]:
+        """Images are resized to `resized_height` (default FIXED_RESIZED_HEIGHT), keeping their aspect ratio."""
+        return self.analyse_batch([(images, prompt, resized_height)], cancel_tokens=[cancel_token])[0]
+
+    def analyse_batch(
+        self,
+        items: List[Tuple[List[Image_t], str, Optional[int]]],
+        cancel_tokens: Optional[List[Optional[CancellationToken]]] = None
+    ) -> List[str]:
+        """Answers several (images, prompt, resized_height) items with one left-padded generate call."""
+        entries, texts = [], []
+        for images, prompt, resized_height in items:
+            item_entries = self._image_entries(images, resized_height or self.FIXED_RESIZED_HEIGHT)
+            messages = [
+                {
+                    "role": "user",
+                    "content": [
+                        *[{"type": "image"} for _ in item_entries],
+                        {
+                            "type": "text", 
+                            "text": prompt
+                        },
+                    ],
+                }
+            ]
+            text = self.processor.apply_chat_template(
+                messages, tokenize=False, add_generation_prompt=True
+            )
+            texts.append(self._expand_image_tokens(text, item_entries))
+            entries.extend(item_entries)
+
+        inputs = self.processor.tokenizer(
+            texts,
+            padding=True,
+            return_tensors="pt"
+        )
+        inputs["pixel_values"] = torch.cat([entry.pixel_values for entry in entries])
+        inputs["image_grid_thw"] = torch.cat([entry.grid_thw for entry in entries])
+        inputs = inputs.to(self.vision_model.device)
+        
+        with self._encoding(entries):
+            output_texts = self._generate_batch(inputs, cancel_tokens)
+        
+        # store (or refresh the size of) entries now that their encoder output is known
+        keys = [
+            self._cache_key(image, resized_height or self.FIXED_RESIZED_HEIGHT)
+            for images, _, resized_height in items
+            for image in images
         ]
-        output_text = self.processor.batch_decode(
-            generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
-        )[0]
-        return output_text
+        for key, entry in zip(keys, entries):
+            if key is not None:
+                self.encoder_cache.put(key, entry)
+        return output_texts
 
-    def describe_video(self, video: str, **kwargs) -> str:
+    def batch_token_capacity(self, max_tokens: int) -> int:
+        """Tokens (padded prompt plus new tokens, summed over rows) one batch may hold: `max_tokens`,
+        or less when the free GPU memory cannot hold their KV cache twice over (activations)."""
+        if self._distributed or self.device.type != "cuda":
+            return max_tokens
+        config = getattr(self.vision_model.config, "text_config", self.vision_model.config)
+        head_dim = config.hidden_size // config.num_attention_heads
+        kv_heads = getattr(config, "num_key_value_heads", config.num_attention_heads)
+        bytes_per_token = 2 * config.num_hidden_layers * kv_heads * head_dim * self.vision_model.dtype.itemsize
+        free_bytes, _ = torch.cuda.mem_get_info(self.device)
+        return max(1, min(max_tokens, int(free_bytes / 2 / bytes_per_token)))
+
+    def describe_video(self, video: Video_t, cancel_token: Optional[CancellationToken] = None, **kwargs) -> str:
+        """`video` is either a path or frames already sampled at the model's resolution (T x H x W x 3, uint8)."""
+        if isinstance(video, str):
+            video = video_sampling.sample_frames(
+                video,
+                fps=kwargs.get("fps", 1.0),
+                max_pixels=kwargs.get("resolution", 360 * 420)
+            )
         messages = [
             {
                 "role": "user",
                 "content": [
-                    {
-                        "type": "video",
-                        "video": video,
-                        "max_pixels": kwargs.get("resolution", 360 * 420),
-                        "video_fps": kwargs.get("fps", 1.0),
-                    },
+                    {"type": "video"},
                     {"type": "text", "text": "Describe this video."},
                 ],
             }
@@ -142,21 +307,32 @@ class GwenVisionModel(VisionModel):
         text = self.processor.apply_chat_template(
             messages, tokenize=False, add_generation_prompt=True
         )
-        image_inputs, video_inputs = process_vision_info(messages)
+        # copied: cached frames are read-only memory maps
+        frames = torch.from_numpy(np.array(video)).permute(0, 3, 1, 2)
         inputs = self.processor(
             text=[text],
-            images=image_inputs,
-            videos=video_inputs,
+            videos=[frames],
             padding=True,
             return_tensors="pt",
         ).to(self.vision_model.device)
+        return self._generate(inputs, cancel_token)
 
-        # Inference: Generation of the output
-        generated_ids = self.vision_model.generate(**inputs, max_new_tokens=self._max_token)
+    def _generate(self, inputs, cancel_token: Optional[CancellationToken] = None) -> str:
+        return self._generate_batch(inputs, [cancel_token])[0]
+
+    def _generate_batch(self, inputs, cancel_tokens: Optional[List[Optional[CancellationToken]]] = None) -> List[str]:
+        # Inference: Generation of the output, rows stopped between decode steps once their caller is gone
+        criteria = cancellation.cancellation_criteria(cancel_tokens, inputs.input_ids.shape[1], self.vision_model.generation_config)
+        generated_ids = self.vision_model.generate(
+            **inputs,
+            max_new_tokens=self._max_token,
+            stopping_criteria=cancellation.stopping_criteria(criteria)
+        )
+        if criteria is not None:
+            criteria.report("vision", self._max_token)
         generated_ids_trimmed = [
             out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
         ]
-        output_text = self.processor.batch_decode(
+        return self.processor.batch_decode(
             generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
-        )[0]
-        return output_text        
\ No newline at end of file
+        )
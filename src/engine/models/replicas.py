@@ -0,0 +1,118 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Hashable, Iterator, List, Optional, Tuple
+
+from src.engine.models.residency import ResidentModel
+from src.helpers.metrics.stats import stats
+
+QUEUE, TOKENS = "queue", "tokens"
+
+class _Replica(object):
+    """Load of one replica: calls and (estimated) tokens in flight, and the time it spent busy."""
+    UTILIZATION_WINDOW_SECONDS = 60.0
+
+    def __init__(self, model: ResidentModel):
+        self.model = model
+        self.in_flight = 0
+        self.in_flight_tokens = 0
+        self._busy_since: Optional[float] = None
+        self._busy: Deque[Tuple[float, float]] = deque()
+        self._created_at = time.monotonic()
+        self._lock = threading.Lock()
+
+        name = model.name
+        self.calls = stats.counter(f"{name}_replica_calls")
+        self.busy_seconds = stats.counter(f"{name}_replica_busy_seconds")
+        stats.gauge(f"{name}_replica_in_flight", lambda: self.in_flight)
+        stats.gauge(f"{name}_replica_in_flight_tokens", lambda: self.in_flight_tokens)
+        stats.gauge(f"{name}_replica_utilization", lambda: self.utilization())
+
+    def start(self, tokens: int):
+        with self._lock:
+            if self.in_flight == 0:
+                self._busy_since = time.monotonic()
+            self.in_flight += 1
+            self.in_flight_tokens += tokens
+        self.calls.inc()
+
+    def finish(self, tokens: int):
+        with self._lock:
+            self.in_flight -= 1
+            self.in_flight_tokens -= tokens
+            if self.in_flight > 0:
+                return
+            now = time.monotonic()
+            self._busy.append((self._busy_since, now))
+            busy, self._busy_since = now - self._busy_since, None
+        self.busy_seconds.inc(busy)
+
+    def utilization(self) -> float:
+        """Fraction of the last minute during which at least one call was running on the replica."""
+        now = time.monotonic()
+        since = now - self.UTILIZATION_WINDOW_SECONDS
+        with self._lock:
+            while self._busy and self._busy[0][1] <= since:
+                self._busy.popleft()
+            busy = sum(end - max(start, since) for start, end in self._busy)
+            if self._busy_since is not None:
+                busy += now - max(self._busy_since, since)
+        return busy / max(1e-9, min(self.UTILIZATION_WINDOW_SECONDS, now - self._created_at))
+
+class ReplicaPool(object):
+    """Copies of one model (e.g. one per GPU), each call running on the least loaded of them.
+
+    The load of a replica is the number of calls it is running (`queue` routing) or the tokens they
+    are estimated to process, prompts plus new tokens (`tokens` routing); ties go to a loaded replica
+    (a lazy pool only loads more replicas under load), then to the one that finished a call the longest ago. Calls with an `affinity` key (chat sessions, whose KV cache lives
+    in one replica) stick to the replica that served the key first, until it is `forget`-ten.
+    """
+    def __init__(self, name: str, replicas: List[ResidentModel], routing: str = TOKENS):
+        if not replicas:
+            raise ValueError(f"The {name} replica pool needs at least one replica.")
+        if routing not in (QUEUE, TOKENS):
+            raise ValueError(f"Unknown replica routing {routing}, expected {QUEUE} or {TOKENS}.")
+        self.name = name
+        self._replicas = [_Replica(model) for model in replicas]
+        self._routing = routing
+        self._affinity: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def replicas(self) -> List[ResidentModel]:
+        return [replica.model for replica in self._replicas]
+
+    def _load(self, replica: _Replica) -> Tuple[int, int, bool, float]:
+        busy = (replica.in_flight_tokens, replica.in_flight) if self._routing == TOKENS else (replica.in_flight, replica.in_flight_tokens)
+        return (*busy, not replica.model.loaded, replica.model.last_used)
+
+    def _pick(self, affinity: Optional[Hashable]) -> _Replica:
+        if affinity is not None and affinity in self._affinity:
+            return self._replicas[self._affinity[affinity]]
+        index = min(range(len(self._replicas)), key=lambda i: self._load(self._replicas[i]))
+        if affinity is not None:
+            self._affinity[affinity] = index
+        return self._replicas[index]
+
+    @contextmanager
+    def use(self, tokens: int = 0, affinity: Optional[Hashable] = None) -> Iterator[Any]:
+        """The model of the least loaded replica (loaded if needed), counted as busy until the block exits."""
+        with self._lock:
+            replica = self._pick(affinity)
+            replica.start(tokens)
+        try:
+            with replica.model.use() as model:
+                yield model
+        finally:
+            replica.finish(tokens)
+
+    def forget(self, affinity: Hashable) -> Optional[Any]:
+        """Drops the replica `affinity` sticks to; returns its model if that is loaded."""
+        with self._lock:
+            index = self._affinity.pop(affinity, None)
+        return self._replicas[index].model.peek() if index is not None else None
+
+    def loaded(self) -> List[Any]:
+        """Models of the replicas that are loaded, without loading the others."""
+        return [model for replica in self._replicas if (model := replica.model.peek()) is not None]
@@ -0,0 +1,145 @@
+import gc
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import psutil
+import torch
+
+from src.helpers.logging.logger import logger
+from src.helpers.metrics.stats import stats
+
+def memory_usage(device: Optional[torch.device]) -> float:
+    """Used fraction of the memory `device` allocates from (host memory for CPU, the fullest GPU when
+    the model is spread over all of them)."""
+    if device is not None and device.type != "cuda":
+        return psutil.virtual_memory().percent / 100
+    if not torch.cuda.is_available():
+        return psutil.virtual_memory().percent / 100
+    devices = [device] if device is not None else range(torch.cuda.device_count())
+    usage = 0.0
+    for cuda_device in devices:
+        free, total = torch.cuda.mem_get_info(cuda_device)
+        usage = max(usage, 1 - free / total)
+    return usage
+
+class ResidentModel(object):
+    """A model built by `load_fn` on first use and droppable while nobody uses it.
+
+    Callers wrap every use in `use()`, which loads the model if needed (concurrent first callers wait
+    for the same load) and pins it until they are done, so that an unload never pulls a model from
+    under a running generation. A use never waits for another model being built.
+    """
+    def __init__(self, name: str, load_fn: Callable[[], Any], device: Optional[torch.device] = None):
+        self.name = name
+        self.device = device
+        self._load_fn = load_fn
+        self._model: Optional[Any] = None
+        self._users = 0
+        self.last_used = time.monotonic()
+        # `_state` guards the fields above, `_transition` serializes loads and unloads
+        self._state = threading.Lock()
+        self._transition = threading.Lock()
+
+        self._loads = stats.counter(f"{name}_model_loads")
+        self._load_seconds = stats.summary(f"{name}_model_load_seconds")
+        self._cold_wait = stats.summary(f"{name}_model_cold_wait_seconds")
+        stats.gauge(f"{name}_model_resident", lambda: int(self._model is not None))
+        stats.gauge(f"{name}_model_idle_seconds", lambda: self.idle_seconds())
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def idle_seconds(self) -> float:
+        with self._state:
+            return 0.0 if self._users else time.monotonic() - self.last_used
+
+    def load(self) -> Any:
+        with self._transition:
+            if self._model is None:
+                timing = time.perf_counter()
+                model = self._load_fn()
+                elapsed = time.perf_counter() - timing
+                with self._state:
+                    self._model = model
+                    self.last_used = time.monotonic()
+                self._loads.inc()
+                self._load_seconds.observe(elapsed)
+                logger.info(f"Loaded the {self.name} model in {elapsed:.2f}s")
+            return self._model
+
+    @contextmanager
+    def use(self) -> Iterator[Any]:
+        with self._state:
+            self._users += 1
+            model = self._model
+        try:
+            if model is None:
+                # cold: this request pays for the load, or waits for the one in progress
+                timing = time.perf_counter()
+                model = self.load()
+                self._cold_wait.observe(time.perf_counter() - timing)
+            yield model
+        finally:
+            with self._state:
+                self._users -= 1
+                self.last_used = time.monotonic()
+
+    def peek(self) -> Optional[Any]:
+        """The model if it is loaded, without loading it or counting as a use."""
+        return self._model
+
+    def unload(self, reason: str) -> bool:
+        with self._transition:
+            with self._state:
+                if self._model is None or self._users:
+                    return False
+                idle, self._model = time.monotonic() - self.last_used, None
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        stats.counter(f"{self.name}_model_unloads").inc()
+        stats.counter(f"{self.name}_model_unloads_{reason}").inc()
+        logger.info(f"Unloaded the {self.name} model ({reason}, idle for {idle:.0f}s)")
+        return True
+
+class ModelResidency(object):
+    """The models of an assistant, loaded on first use and unloaded by `sweep` once idle for
+    `idle_seconds`, or least recently used first while the memory of their device is used above
+    `memory_threshold` (0 disables either rule)."""
+    def __init__(self, idle_seconds: float = 0, memory_threshold: float = 0):
+        self._idle_seconds = idle_seconds
+        self._memory_threshold = memory_threshold
+        self.models: Dict[str, ResidentModel] = {}
+
+    def add(self, name: str, load_fn: Callable[[], Any], device: Optional[torch.device] = None) -> ResidentModel:
+        self.models[name] = ResidentModel(name, load_fn, device)
+        return self.models[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.models
+
+    def __getitem__(self, name: str) -> ResidentModel:
+        return self.models[name]
+
+    def load_all(self):
+        # one after the other: builds take `loading.construction_lock` anyway
+        for model in self.models.values():
+            model.load()
+
+    def sweep(self) -> List[str]:
+        """Unloads what the idle and memory rules say should go; returns the names unloaded."""
+        unloaded = []
+        if self._idle_seconds > 0:
+            for model in self.models.values():
+                if model.loaded and model.idle_seconds() >= self._idle_seconds and model.unload("idle"):
+                    unloaded.append(model.name)
+
+        if self._memory_threshold > 0:
+            resident = sorted((model for model in self.models.values() if model.loaded), key=lambda model: model.last_used)
+            for model in resident:
+                if memory_usage(model.device) >= self._memory_threshold and model.unload("memory"):
+                    unloaded.append(model.name)
+        return unloaded
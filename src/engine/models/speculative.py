@@ -0,0 +1,116 @@
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from src.helpers.logging.logger import logger
+from src.helpers.metrics.stats import stats
+
+class SpeculativeDecoder(object):
+    """Speculative (assisted) generation: a small draft model proposes a few tokens, which the target
+    model verifies in a single forward pass, so that one memory-bound decode step of the target can
+    emit several tokens. Greedy outputs are identical to plain decoding, sampled ones follow the same
+    distribution.
+
+    The acceptance rate of a request (drafted tokens the target kept) is measured by counting the
+    forward passes of both models. While its moving average is below `min_acceptance` (after `warmup`
+    requests), drafting costs more than it saves and requests decode without the draft model; every
+    `probe_every`-th of them still drafts, to notice when the prompts became predictable again.
+    Only single-sequence calls are drafted, `generate` does not support assisted batches.
+    """
+    ALPHA = 0.2
+
+    def __init__(
+        self,
+        name: str,
+        target_model: Any,
+        draft_model: Any,
+        target_tokenizer: Any = None,
+        draft_tokenizer: Any = None,
+        min_acceptance: float = 0.3,
+        warmup: int = 8,
+        probe_every: int = 50
+    ):
+        self.draft_model = draft_model
+        self._generate_kwargs: Dict[str, Any] = {"assistant_model": draft_model}
+        if target_model.config.get_text_config().vocab_size != draft_model.config.get_text_config().vocab_size:
+            # e.g. Qwen2.5-0.5B pads its embeddings to another size than 7B: tokens are matched through text
+            self._generate_kwargs.update(tokenizer=target_tokenizer, assistant_tokenizer=draft_tokenizer)
+        self._min_acceptance = min_acceptance
+        self._warmup = warmup
+        self._probe_every = max(1, probe_every)
+
+        # forward passes of the current call, per thread (concurrent generations share the models)
+        self._passes = threading.local()
+        target_model.register_forward_hook(lambda *_: self._count("target"))
+        draft_model.register_forward_hook(lambda *_: self._count("draft"))
+
+        self._lock = threading.Lock()
+        self.acceptance: Optional[float] = None
+        self._samples = 0
+        self._skipped = 0
+        self.enabled = True
+
+        self._requests = stats.counter(f"{name}_speculative_requests")
+        self._fallbacks = stats.counter(f"{name}_speculative_fallbacks")
+        self._request_acceptance = stats.summary(f"{name}_speculative_request_acceptance")
+        self._request_speed = stats.summary(f"{name}_speculative_tokens_per_second")
+        self._plain_speed = stats.summary(f"{name}_plain_tokens_per_second")
+        stats.gauge(f"{name}_speculative_enabled", lambda: int(self.enabled))
+        stats.gauge(f"{name}_speculative_acceptance", lambda: self.acceptance or 0.0)
+
+    def _count(self, model: str):
+        passes = getattr(self._passes, "counts", None)
+        if passes is not None:
+            passes[model] += 1
+
+    def _should_draft(self) -> bool:
+        with self._lock:
+            if self.enabled:
+                return True
+            self._skipped += 1
+            if self._skipped >= self._probe_every:
+                self._skipped = 0
+                return True
+            return False
+
+    def _record(self, acceptance: float):
+        with self._lock:
+            self._samples += 1
+            self.acceptance = acceptance if self.acceptance is None else self.ALPHA * acceptance + (1 - self.ALPHA) * self.acceptance
+            enabled = self._samples < self._warmup or self.acceptance >= self._min_acceptance
+            changed, self.enabled = enabled != self.enabled, enabled
+        if changed and not enabled:
+            self._fallbacks.inc()
+            logger.info(f"Draft tokens are rarely accepted ({self.acceptance:.2f}), decoding without the draft model")
+        elif changed:
+            logger.info(f"Draft tokens are accepted again ({self.acceptance:.2f}), decoding with the draft model")
+
+    def generate(self, model: Any, model_inputs: Dict[str, Any], **kwargs) -> Any:
+        """`model.generate(**model_inputs, **kwargs)`, drafted when worthwhile; records acceptance and tokens/s."""
+        batch_size, prompt_length = model_inputs["input_ids"].shape
+        drafted = batch_size == 1 and self._should_draft()
+        self._passes.counts = {"target": 0, "draft": 0}
+        timing = time.perf_counter()
+        try:
+            outputs = model.generate(**model_inputs, **kwargs, **(self._generate_kwargs if drafted else {}))
+        finally:
+            passes, self._passes.counts = self._passes.counts, None
+        elapsed = time.perf_counter() - timing
+
+        sequences = outputs.sequences if hasattr(outputs, "sequences") else outputs
+        new_tokens = sequences.shape[1] - prompt_length
+        if not drafted:
+            # the baseline drafted requests compare to
+            if batch_size == 1:
+                self._plain_speed.observe(new_tokens / elapsed)
+            return outputs
+
+        self._requests.inc()
+        self._request_speed.observe(new_tokens / elapsed)
+        if passes["draft"] > 0:
+            # every verification pass of the target keeps the drafted tokens it agrees with, plus one of its own
+            acceptance = max(0, new_tokens - passes["target"]) / passes["draft"]
+            self._request_acceptance.observe(acceptance)
+            self._record(acceptance)
+            logger.debug(f"Speculative decoding: {new_tokens} tokens, acceptance {acceptance:.2f}, {new_tokens / elapsed:.1f} tokens/s")
+        return outputs
@@ -0,0 +1,166 @@
+import hashlib
+import math
+import os
+import threading
+from typing import List, Optional, Tuple
+
+import av
+import numpy as np
+
+from src.helpers.metrics.stats import stats
+
+# sampling rules of Qwen2-VL's video pipeline (qwen_vl_utils), kept here so the
+# decode workers do not need to import torch
+IMAGE_FACTOR = 28
+FRAME_FACTOR = 2
+FPS_MIN_FRAMES = 4
+FPS_MAX_FRAMES = 768
+VIDEO_MIN_PIXELS = 128 * IMAGE_FACTOR * IMAGE_FACTOR
+
+def smart_resize(height: int, width: int, factor: int = IMAGE_FACTOR, min_pixels: int = VIDEO_MIN_PIXELS, max_pixels: int = 360 * 420) -> Tuple[int, int]:
+    """Closest size with both sides divisible by `factor` and an area within [min_pixels, max_pixels]."""
+    h_bar = max(factor, round(height / factor) * factor)
+    w_bar = max(factor, round(width / factor) * factor)
+    if h_bar * w_bar > max_pixels:
+        beta = math.sqrt((height * width) / max_pixels)
+        h_bar = max(factor, math.floor(height / beta / factor) * factor)
+        w_bar = max(factor, math.floor(width / beta / factor) * factor)
+    elif h_bar * w_bar < min_pixels:
+        beta = math.sqrt(min_pixels / (height * width))
+        h_bar = math.ceil(height * beta / factor) * factor
+        w_bar = math.ceil(width * beta / factor) * factor
+    return h_bar, w_bar
+
+def sample_count(total_frames: int, video_fps: float, fps: float) -> int:
+    min_frames = math.ceil(FPS_MIN_FRAMES / FRAME_FACTOR) * FRAME_FACTOR
+    max_frames = math.floor(min(FPS_MAX_FRAMES, total_frames) / FRAME_FACTOR) * FRAME_FACTOR
+    nframes = min(max(total_frames / video_fps * fps, min_frames), max_frames, total_frames)
+    return max(FRAME_FACTOR, math.floor(nframes / FRAME_FACTOR) * FRAME_FACTOR)
+
+def _frame_count(container, stream) -> Tuple[int, float]:
+    rate = float(stream.average_rate or stream.guessed_rate or 25)
+    if stream.duration:
+        duration = float(stream.duration * stream.time_base)
+    else:
+        duration = container.duration / av.time_base if container.duration else 0.0
+    return stream.frames or max(1, int(round(duration * rate))), rate
+
+def probe_video(path: str) -> Tuple[int, float, int, int]:
+    """Frame count, frame rate, height and width of a video, from its headers only."""
+    try:
+        with av.open(path) as container:
+            stream = container.streams.video[0]
+            total_frames, rate = _frame_count(container, stream)
+            return total_frames, rate, stream.codec_context.height, stream.codec_context.width
+    except (av.FFmpegError, IndexError) as e:
+        raise ValueError(f"Cannot read video {path}: {e}")
+
+def sample_frames(
+    path: str,
+    fps: float = 1.0,
+    max_pixels: int = 360 * 420,
+    seek_threshold: float = 1.0,
+    keyframes_only: bool = False
+) -> np.ndarray:
+    """Decodes only the frames sampled at `fps` (uint8, T x H x W x 3), already at the model's resolution.
+
+    Samples that are more than `seek_threshold` seconds ahead of the decoder are reached by seeking
+    to the preceding keyframe instead of decoding everything in between. With `keyframes_only`,
+    the keyframe found by the seek is used as is (faster, timestamps approximate).
+    """
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        total_frames, rate = _frame_count(container, stream)
+        start = float(stream.start_time * stream.time_base) if stream.start_time is not None else 0.0
+
+        nframes = sample_count(total_frames, rate, fps)
+        targets = start + np.linspace(0, total_frames - 1, nframes).round() / rate
+        height, width = smart_resize(stream.codec_context.height, stream.codec_context.width, max_pixels=max_pixels)
+
+        frames: List[np.ndarray] = []
+        decoder, current, last = None, None, None
+        half_frame = 0.5 / rate
+        for target in targets:
+            seeked = False
+            if decoder is None or current is None or target - current > seek_threshold:
+                container.seek(int(max(0.0, target) / stream.time_base), stream=stream, backward=True, any_frame=False)
+                decoder, seeked = container.decode(stream), True
+
+            for frame in decoder:
+                current = float(frame.time) if frame.time is not None else (current or 0.0) + 1 / rate
+                last = frame
+                if current >= target - half_frame or (keyframes_only and seeked):
+                    break
+
+            # past the end of the stream: repeat the last frame
+            if last is None:
+                raise ValueError(f"No video frame could be decoded from {path}")
+            frames.append(last.to_ndarray(format="rgb24", width=width, height=height, interpolation="AREA"))
+
+        return np.stack(frames)
+
+def sample_frames_to_file(path: str, out_path: str, fps: float, max_pixels: int) -> Tuple[int, ...]:
+    """Worker entry point: samples `path` and writes the frames as .npy to `out_path` (atomically),
+    so that only a file name crosses the process boundary."""
+    frames = sample_frames(path, fps=fps, max_pixels=max_pixels)
+    partial_path = f"{out_path}.{os.getpid()}.tmp.npy"
+    np.save(partial_path, frames)
+    os.replace(partial_path, out_path)
+    return frames.shape
+
+class VideoFrameCache(object):
+    """Sampled frames stored as .npy files keyed by video content, fps and resolution, read back
+    memory-mapped. Least recently used files are removed once the directory exceeds `max_bytes`."""
+    PRUNE_EVERY = 16
+
+    def __init__(self, cache_dir: str, max_bytes: int = 4 * 1024 ** 3):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._writes = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._hits = stats.counter("video_frame_cache_hits")
+        self._misses = stats.counter("video_frame_cache_misses")
+
+    @staticmethod
+    def make_key(video_key: str, fps: float, max_pixels: int) -> str:
+        return hashlib.sha256(f"{video_key}|{fps}|{max_pixels}".encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self._cache_dir, f"{key}.npy")
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        path = self.path(key)
+        try:
+            frames = np.load(path, mmap_mode="r")
+            os.utime(path)
+        except (OSError, ValueError):
+            self._misses.inc()
+            return None
+        self._hits.inc()
+        return frames
+
+    def added(self, key: str) -> np.ndarray:
+        """Registers the frames just written under `path(key)` and returns them."""
+        frames = np.load(self.path(key), mmap_mode="r")
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % self.PRUNE_EVERY == 0
+        if prune:
+            self._prune()
+        return frames
+
+    def _prune(self):
+        files = [entry for entry in os.scandir(self._cache_dir) if entry.name.endswith(".npy") and ".tmp" not in entry.name]
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in files)
+        for entry in files:
+            if total <= self._max_bytes:
+                break
+            total -= entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
@@ -0,0 +1,168 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+import torch
+from PIL import Image
+
+from src.helpers.logging.logger import logger
+from src.helpers.metrics.stats import stats
+
+class ImageSource(object):
+    """An uploaded image known by the hash of its bytes, decoded only when its
+    preprocessed form is not cached (or eagerly by whoever sets `image`)."""
+    def __init__(
+        self,
+        key: str,
+        data: bytes,
+        decoder: Optional[Callable[[bytes], Image.Image]] = None
+    ):
+        self.key = key
+        self.data = data
+        self.image: Optional[Image.Image] = None
+        self._size: Optional[Tuple[int, int]] = None
+        self._decoder = decoder or (lambda data: Image.open(io.BytesIO(data)))
+
+    def load(self) -> Image.Image:
+        if self.image is None:
+            self.image = self._decoder(self.data)
+        return self.image
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        """(width, height) of the original image, read from its header when not decoded yet."""
+        if self._size is None:
+            self._size = Image.open(io.BytesIO(self.data)).size
+        return self._size
+
+class VisionCacheEntry(object):
+    """Preprocessed pixel patches of one image, its patch grid and (once computed) the vision-encoder
+    output. Models that can take the encoder output directly drop the pixels once it is known."""
+    def __init__(self, pixel_values: torch.Tensor, grid_thw: torch.Tensor, embeds: Optional[torch.Tensor] = None):
+        self.pixel_values = pixel_values
+        self.grid_thw = grid_thw
+        self.embeds = embeds
+
+    @property
+    def nbytes(self) -> int:
+        tensors = [self.pixel_values, self.grid_thw] + ([self.embeds] if self.embeds is not None else [])
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+class VisionEncoderCache(object):
+    """In-memory LRU of `VisionCacheEntry` under a byte budget.
+
+    With `spill_dir`, evicted entries are written there and memory-mapped back on a later hit
+    instead of being recomputed; the spill directory is pruned (oldest first) to `spill_max_bytes`.
+    """
+    PRUNE_EVERY = 64
+
+    def __init__(
+        self,
+        name: str,
+        budget_bytes: int,
+        spill_dir: Optional[str] = None,
+        spill_max_bytes: int = 8 * 1024 ** 3
+    ):
+        self._budget_bytes = budget_bytes
+        self._spill_dir = spill_dir
+        self._spill_max_bytes = spill_max_bytes
+        self._spill_writes = 0
+        self._entries: "OrderedDict[str, VisionCacheEntry]" = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+        self._hits = stats.counter(f"{name}_encoder_cache_hits")
+        self._spill_hits = stats.counter(f"{name}_encoder_cache_spill_hits")
+        self._misses = stats.counter(f"{name}_encoder_cache_misses")
+        self._evictions = stats.counter(f"{name}_encoder_cache_evictions")
+        stats.gauge(f"{name}_encoder_cache_bytes", lambda: self._nbytes)
+        stats.gauge(f"{name}_encoder_cache_entries", lambda: len(self._entries))
+
+    def _spill_path(self, key: str) -> str:
+        return os.path.join(self._spill_dir, f"{key}.pt")
+
+    def contains(self, key: str) -> bool:
+        with self._lock:
+            if key in self._entries:
+                return True
+        return bool(self._spill_dir) and os.path.exists(self._spill_path(key))
+
+    def get(self, key: str) -> Optional[VisionCacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._hits.inc()
+                return entry
+
+        entry = self._load_spilled(key)
+        if entry is None:
+            self._misses.inc()
+            return None
+        self._spill_hits.inc()
+        self.put(key, entry)
+        return entry
+
+    def put(self, key: str, entry: VisionCacheEntry):
+        """Adds or refreshes `entry` (e.g. once its encoder output got computed)."""
+        evicted = []
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._nbytes -= previous.nbytes
+            if entry.nbytes > self._budget_bytes:
+                evicted.append((key, entry))
+            else:
+                self._entries[key] = entry
+                self._nbytes += entry.nbytes
+            while self._nbytes > self._budget_bytes:
+                evicted_key, evicted_entry = self._entries.popitem(last=False)
+                self._nbytes -= evicted_entry.nbytes
+                self._evictions.inc()
+                evicted.append((evicted_key, evicted_entry))
+
+        for evicted_key, evicted_entry in evicted:
+            self._spill(evicted_key, evicted_entry)
+
+    def _spill(self, key: str, entry: VisionCacheEntry):
+        # only entries with encoder output are worth the disk space
+        if not self._spill_dir or entry.embeds is None or os.path.exists(self._spill_path(key)):
+            return
+        path = self._spill_path(key)
+        partial_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            torch.save({"pixel_values": entry.pixel_values, "grid_thw": entry.grid_thw, "embeds": entry.embeds}, partial_path)
+            os.replace(partial_path, path)
+        except OSError as e:
+            logger.warning(f"Cannot spill vision cache entry {key}: {e}")
+            return
+
+        self._spill_writes += 1
+        if self._spill_writes % self.PRUNE_EVERY == 0:
+            self._prune_spill()
+
+    def _load_spilled(self, key: str) -> Optional[VisionCacheEntry]:
+        if not self._spill_dir:
+            return None
+        try:
+            tensors = torch.load(self._spill_path(key), mmap=True, weights_only=True)
+        except (OSError, RuntimeError):
+            return None
+        return VisionCacheEntry(tensors["pixel_values"], tensors["grid_thw"], tensors["embeds"])
+
+    def _prune_spill(self):
+        files = [entry for entry in os.scandir(self._spill_dir) if entry.name.endswith(".pt")]
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in files)
+        for entry in files:
+            if total <= self._spill_max_bytes:
+                break
+            total -= entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
@@ -0,0 +1,106 @@
+import math
+from typing import List, Sequence, Tuple
+
+from src.engine.models.video_sampling import (FPS_MIN_FRAMES, FRAME_FACTOR, IMAGE_FACTOR, VIDEO_MIN_PIXELS,
+                                              sample_count, smart_resize)
+from src.helpers.metrics.stats import stats
+
+# Qwen2-VL: 14px patches merged 2x2, so one visual token per 28x28 pixels,
+# and video frames are merged in pairs (temporal patch of 2)
+TOKEN_PIXELS = IMAGE_FACTOR
+TEMPORAL_PATCH = FRAME_FACTOR
+MIN_IMAGE_HEIGHT = 2 * TOKEN_PIXELS
+# resize bounds applied to images by qwen_vl_utils
+IMAGE_MIN_PIXELS = 4 * TOKEN_PIXELS * TOKEN_PIXELS
+IMAGE_MAX_PIXELS = 16384 * TOKEN_PIXELS * TOKEN_PIXELS
+
+class VisualBudgetExceeded(ValueError):
+    pass
+
+def image_tokens(height: int, sizes: Sequence[Tuple[int, int]]) -> int:
+    """Visual tokens of images of `sizes` (width, height) resized to `height`, keeping their aspect ratio."""
+    tokens = 0
+    for w, h in sizes:
+        resized_height, resized_width = smart_resize(height, height / h * w, min_pixels=IMAGE_MIN_PIXELS, max_pixels=IMAGE_MAX_PIXELS)
+        tokens += (resized_height // TOKEN_PIXELS) * (resized_width // TOKEN_PIXELS)
+    return tokens
+
+def video_tokens(total_frames: int, rate: float, height: int, width: int, fps: float, max_pixels: int) -> int:
+    frames = sample_count(total_frames, rate, fps)
+    resized_height, resized_width = smart_resize(height, width, max_pixels=max_pixels)
+    return math.ceil(frames / TEMPORAL_PATCH) * (resized_height // TOKEN_PIXELS) * (resized_width // TOKEN_PIXELS)
+
+class VisualTokenBudget(object):
+    """Caps the visual tokens of one request so that sequence length, latency and memory stay bounded.
+
+    The budget is `max_tokens` on an idle model and shrinks as requests queue up: it halves every
+    `halving_queue_depth` waiting requests, down to `min_tokens`. Images are resized to a common height
+    and videos sampled at a lower fps/resolution until they fit; what cannot fit even at the smallest
+    size is rejected before it reaches the model.
+    """
+    def __init__(self, max_tokens: int = 16384, min_tokens: int = 2048, halving_queue_depth: int = 4):
+        self._max_tokens = max_tokens
+        self._min_tokens = min(min_tokens, max_tokens)
+        self._halving_queue_depth = max(1, halving_queue_depth)
+
+        self._planned = stats.summary("visual_tokens_planned")
+        self._reduced = stats.counter("visual_budget_reduced")
+        self._rejected = stats.counter("visual_budget_rejected")
+
+    def tokens(self, queue_depth: int = 0) -> int:
+        return max(self._min_tokens, int(self._max_tokens * 0.5 ** (queue_depth / self._halving_queue_depth)))
+
+    def _reject(self, message: str):
+        self._rejected.inc()
+        raise VisualBudgetExceeded(message)
+
+    def plan_images(self, sizes: List[Tuple[int, int]], height: int, queue_depth: int = 0) -> int:
+        """Height (at most `height`) to resize images of `sizes` (width, height) to."""
+        budget, requested_height = self.tokens(queue_depth), height
+        tokens = image_tokens(height, sizes)
+        while tokens > budget:
+            # tokens grow with the square of the height
+            reduced = math.floor(height * math.sqrt(budget / tokens) / TOKEN_PIXELS) * TOKEN_PIXELS
+            height = min(reduced, height - TOKEN_PIXELS)
+            if height < MIN_IMAGE_HEIGHT:
+                self._reject(
+                    f"{len(sizes)} images need more than {budget} visual tokens even at the smallest size, "
+                    f"please send fewer images."
+                )
+            tokens = image_tokens(height, sizes)
+        if height < requested_height:
+            self._reduced.inc()
+        self._planned.observe(tokens)
+        return height
+
+    def plan_video(
+        self,
+        total_frames: int,
+        rate: float,
+        height: int,
+        width: int,
+        fps: float,
+        max_pixels: int,
+        queue_depth: int = 0
+    ) -> Tuple[float, int]:
+        """Sampling rate and frame size (at most `fps` and `max_pixels`) keeping the video within budget."""
+        budget = self.tokens(queue_depth)
+        min_fps = FPS_MIN_FRAMES * rate / total_frames
+        tokens = video_tokens(total_frames, rate, height, width, fps, max_pixels)
+        if tokens > budget:
+            self._reduced.inc()
+            # share the reduction between frame rate and frame size first
+            scale = math.sqrt(budget / tokens)
+            fps, max_pixels = max(min_fps, fps * scale), max(VIDEO_MIN_PIXELS, int(max_pixels * scale))
+            tokens = video_tokens(total_frames, rate, height, width, fps, max_pixels)
+        while tokens > budget:
+            scale = 0.9 * budget / tokens
+            if max_pixels > VIDEO_MIN_PIXELS:
+                max_pixels = max(VIDEO_MIN_PIXELS, int(max_pixels * scale))
+            elif fps > min_fps:
+                fps = max(min_fps, fps * scale)
+            else:
+                self._reject(f"The video needs more than {budget} visual tokens even at the lowest frame rate and size.")
+            tokens = video_tokens(total_frames, rate, height, width, fps, max_pixels)
+        self._planned.observe(tokens)
+        return fps, max_pixels
@@ -0,0 +1,84 @@
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Dict
+
+__all__ = ["stats"]
+
+class Counter(object):
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def snapshot(self) -> float:
+        return self._value
+
+class Gauge(object):
+    def __init__(self, fn: Callable[[], float]):
+        self._fn = fn
+
+    def snapshot(self) -> float:
+        return self._fn()
+
+class Summary(object):
+    """Keeps the last `window` observations to report mean/percentiles of a distribution."""
+    def __init__(self, window: int = 1024):
+        self._values: Deque[float] = deque(maxlen=window)
+        self._count = 0
+        self._total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self._values.append(value)
+            self._count += 1
+            self._total += value
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            values = sorted(self._values)
+            count, total = self._count, self._total
+
+        if not values:
+            return {"count": count, "total": total}
+
+        return {
+            "count": count,
+            "total": total,
+            "mean": sum(values) / len(values),
+            "p50": values[int(0.50 * (len(values) - 1))],
+            "p95": values[int(0.95 * (len(values) - 1))],
+            "max": values[-1]
+        }
+
+class StatsRegistry(object):
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, name: str, factory):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = factory()
+            return self._metrics[name]
+
+    def counter(self, name: str) -> Counter:
+        return self._get_or_create(name, Counter)
+
+    def summary(self, name: str) -> Summary:
+        return self._get_or_create(name, Summary)
+
+    def gauge(self, name: str, fn: Callable[[], float]) -> Gauge:
+        with self._lock:
+            self._metrics[name] = Gauge(fn)
+            return self._metrics[name]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            metrics = dict(self._metrics)
+        return {name: metric.snapshot() for name, metric in sorted(metrics.items())}
+
+stats = StatsRegistry()
@@ -40,11 +40,75 @@ class ChatbotSettings(BaseSettings):
     CHAT_MODEL_NAME: Optional[str] = Field()
     VISION_MODEL_NAME: Optional[str] = Field()
     DISTRIBUTED: Optional[bool] = Field()
+    CHAT_BATCH_MAX_SIZE: Optional[int] = Field(default=8)
+    CHAT_BATCH_WINDOW_MS: Optional[float] = Field(default=10.0)
+    CHAT_MAX_CONCURRENCY: Optional[int] = Field(default=1)
+    VISION_MAX_CONCURRENCY: Optional[int] = Field(default=1)
+    INFERENCE_QUEUE_SIZE: Optional[int] = Field(default=32)
+    RESPONSE_CACHE_ENABLED: Optional[bool] = Field(default=True)
+    RESPONSE_CACHE_MAX_ENTRIES: Optional[int] = Field(default=1024)
+    RESPONSE_CACHE_TTL_SECONDS: Optional[float] = Field(default=86400)
+    RESPONSE_CACHE_DISK: Optional[bool] = Field(default=False)
+    CHAT_SYSTEM_PROMPT: Optional[str] = Field(default="You are Qwen, created by Alibaba Cloud. You are a helpful assistant.")
+    CHAT_SYSTEM_PROMPT_FILE: Optional[str] = Field(default=None)
+    CHAT_PREFIX_CACHE: Optional[bool] = Field(default=True)
+    CHAT_SESSION_KV_BUDGET_MB: Optional[int] = Field(default=2048)
+    CHAT_SESSION_TTL_SECONDS: Optional[float] = Field(default=3600)
+    COALESCE_REQUESTS: Optional[bool] = Field(default=True)
+    SEMANTIC_CACHE_ENABLED: Optional[bool] = Field(default=False)
+    SEMANTIC_CACHE_MODEL_NAME: Optional[str] = Field(default="sentence-transformers/all-MiniLM-L6-v2")
+    SEMANTIC_CACHE_THRESHOLD: Optional[float] = Field(default=0.92)
+    SEMANTIC_CACHE_MAX_ENTRIES: Optional[int] = Field(default=100000)
+    SEMANTIC_CACHE_NPROBE: Optional[int] = Field(default=8)
+    SEMANTIC_CACHE_TRAIN_CHECK_SECONDS: Optional[float] = Field(default=30.0)
+    DISCONNECT_POLL_INTERVAL_MS: Optional[float] = Field(default=250)
+    MAX_CONCURRENT_REQUESTS_PER_CLIENT: Optional[int] = Field(default=4)
+    MAX_IMAGE_UPLOAD_MB: Optional[float] = Field(default=20)
+    MAX_VIDEO_UPLOAD_MB: Optional[float] = Field(default=512)
+    MAX_IMAGE_UPLOAD_FILES: Optional[int] = Field(default=16)
+    IMAGE_DECODE_WORKERS: Optional[int] = Field(default=2)
+    VISION_ENCODER_CACHE_MB: Optional[int] = Field(default=1024)
+    VISION_ENCODER_CACHE_SPILL: Optional[bool] = Field(default=False)
+    VISION_ENCODER_CACHE_SPILL_MB: Optional[int] = Field(default=8192)
+    VIDEO_DECODE_WORKERS: Optional[int] = Field(default=2)
+    VIDEO_SAMPLE_FPS: Optional[float] = Field(default=1.0)
+    VIDEO_MAX_PIXELS: Optional[int] = Field(default=360 * 420)
+    VIDEO_FRAME_CACHE_MB: Optional[int] = Field(default=4096)
+    VIDEO_UPLOAD_STORE_MB: Optional[int] = Field(default=10240)
+    VISUAL_TOKEN_BUDGET: Optional[int] = Field(default=16384)
+    VISUAL_TOKEN_BUDGET_MIN: Optional[int] = Field(default=2048)
+    VISUAL_TOKEN_BUDGET_HALVING_DEPTH: Optional[int] = Field(default=4)
+    VISION_BATCH_MAX_SIZE: Optional[int] = Field(default=8)
+    VISION_BATCH_MAX_TOKENS: Optional[int] = Field(default=32768)
+    BULK_JOB_CONCURRENCY: Optional[int] = Field(default=16)
+    BULK_JOB_MAX_ITEMS: Optional[int] = Field(default=100000)
+    MODELS_OFFLINE: Optional[bool] = Field(default=False)
+    MODEL_IDLE_UNLOAD_SECONDS: Optional[float] = Field(default=0)
+    MODEL_MEMORY_UNLOAD_THRESHOLD: Optional[float] = Field(default=0)
+    MODEL_RESIDENCY_CHECK_SECONDS: Optional[float] = Field(default=10.0)
+    INFERENCE_SERVER: Optional[bool] = Field(default=False)
+    INFERENCE_SOCKET: Optional[str] = Field(default=None)
+    CHAT_REPLICAS: Optional[int] = Field(default=1)
+    VISION_REPLICAS: Optional[int] = Field(default=1)
+    REPLICA_ROUTING: Optional[str] = Field(default="tokens")
+    INFERENCE_BACKEND: Optional[str] = Field(default="transformers")
+    CPU_BACKEND_PRECISION: Optional[str] = Field(default="int8")
+    CPU_BACKEND_THREADS: Optional[int] = Field(default=0)
+    CHAT_DRAFT_MODEL_NAME: Optional[str] = Field(default=None)
+    SPECULATIVE_MIN_ACCEPTANCE: Optional[float] = Field(default=0.3)
+
+class GatewaySettings(BaseSettings):
+    GATEWAY_BACKENDS: Optional[List[str]] = Field(default=[])
+    GATEWAY_HOST: Optional[str] = Field(default="0.0.0.0")
+    GATEWAY_PORT: Optional[int] = Field(default=8500)
+    GATEWAY_HEALTH_CHECK_SECONDS: Optional[float] = Field(default=2.0)
+    GATEWAY_MAX_QUEUE_DEPTH: Optional[int] = Field(default=8)
+    GATEWAY_TIMEOUT_SECONDS: Optional[float] = Field(default=600)
 
 class AnkiSettings(BaseSettings):
     API_DOMAIN: Optional[str] = Field()
 
-class AppSettings(CommonSettings, ServerSettings, ChatbotSettings, AnkiSettings):
+class AppSettings(CommonSettings, ServerSettings, ChatbotSettings, GatewaySettings, AnkiSettings):
     config: ClassVar[SettingsConfigDict] = SettingsConfigDict(extra="ignore")
     
 settings = AppSettings.model_validate(dyna_settings.as_dict())
\ No newline at end of file
@@ -0,0 +1,76 @@
+import time
+from typing import List, Tuple
+
+import torch
+
+from src.engine.models.backends import CPUBackend, InferenceBackend, TransformersBackend
+from src.engine.models.model_chat import GwenModel
+
+PROMPTS = [
+    "Create a flashcard for the English word \"intrigue\": an example sentence with the word as a cloze, then its definition.",
+    "Give the phonetic transcription, definition and an example sentence of the word \"meticulous\".",
+    "Write a short quiz question about photosynthesis with its answer.",
+    "Explain the difference between \"affect\" and \"effect\" with one example each."
+]
+
+def configurations(args) -> List[Tuple[str, InferenceBackend]]:
+    configs = []
+    for name in args.backends:
+        if name == "transformers":
+            configs.append(("transformers", TransformersBackend()))
+        else:
+            precision = name.split(":", 1)[1] if ":" in name else "int8"
+            configs.append((f"cpu:{precision}", CPUBackend(precision=precision, threads=args.threads)))
+    return configs
+
+def bench(model: GwenModel, prompts: List[str], max_token: int, rounds: int) -> float:
+    """Decoded tokens per second; every row generates exactly `max_token` tokens so that backends compare."""
+    tokens, elapsed = 0, 0.0
+    for _ in range(rounds):
+        inputs = model._build_inputs(prompts)
+        timing = time.perf_counter()
+        with torch.inference_mode():
+            model.chat_model.generate(**inputs, max_new_tokens=max_token, min_new_tokens=max_token, do_sample=False)
+        elapsed += time.perf_counter() - timing
+        tokens += len(prompts) * max_token
+    return tokens / elapsed
+
+def run(args):
+    prompts = (PROMPTS * args.batch_size)[:args.batch_size]
+    print(f"{'backend':>16} {'load s':>7} {'tokens/s':>9} {'speedup':>8}  sample")
+    baseline = None
+    for label, backend in configurations(args):
+        timing = time.perf_counter()
+        model = GwenModel(
+            device_id=args.device,
+            cache_dir=args.cache_dir,
+            max_new_token=args.max_token,
+            chat_model=args.model,
+            backend=backend
+        )
+        load_seconds = time.perf_counter() - timing
+        # warm-up
+        model.answer_batch(prompts[:1])
+
+        throughput = bench(model, prompts, args.max_token, args.rounds)
+        baseline = baseline or throughput
+        sample = model.answer(PROMPTS[0])[:40].replace("\n", " ")
+        print(f"{label:>16} {load_seconds:>7.2f} {throughput:>9.2f} {throughput / baseline:>7.2f}x  {sample!r}")
+        del model
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser("Inference backend benchmark")
+    parser.add_argument("--model", default="Qwen/Qwen2.5-0.5B-Instruct")
+    parser.add_argument("--device", default="0")
+    parser.add_argument("--cache-dir", default="./.caches")
+    parser.add_argument("--backends", nargs="+", default=["transformers", "cpu:fp32", "cpu:bf16", "cpu:int8"],
+                        help="transformers, or cpu:<int8|bf16|fp32>")
+    parser.add_argument("--threads", type=int, default=0, help="Intra-op threads of the CPU backend (0: torch default)")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--max-token", type=int, default=64)
+    parser.add_argument("--rounds", type=int, default=3)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    run(parse_args())
@@ -0,0 +1,57 @@
+import time
+
+import numpy as np
+
+from src.app.core.semantic_cache import EmbeddingIndex
+
+def bench_lookup(index: EmbeddingIndex, queries: np.ndarray, repeats: int) -> float:
+    timing = time.perf_counter()
+    for _ in range(repeats):
+        index.search(queries)
+    return (time.perf_counter() - timing) / repeats
+
+def build_index(vectors: np.ndarray, ivf_min_entries: int, nprobe: int) -> EmbeddingIndex:
+    index = EmbeddingIndex(vectors.shape[1], max_entries=len(vectors), ivf_min_entries=ivf_min_entries, nprobe=nprobe)
+    for vector in vectors:
+        index.add(vector, "")
+    index.maybe_train()
+    return index
+
+def run(args):
+    rng = np.random.default_rng(0)
+    print(
+        f"{'entries':>10} {'exact (1) ms':>13} {'index (1) ms':>13} "
+        f"{f'index ({args.batch}) ms':>15} {'recall@1':>9}"
+    )
+    for size in args.sizes:
+        vectors = rng.standard_normal((size, args.dim)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        
+        # queries are near-duplicates of stored prompts
+        targets = rng.integers(0, size, args.batch)
+        queries = vectors[targets] + args.noise * rng.standard_normal((args.batch, args.dim)).astype(np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        
+        exact = build_index(vectors, ivf_min_entries=size + 1, nprobe=args.nprobe)
+        index = build_index(vectors, ivf_min_entries=args.ivf_min_entries, nprobe=args.nprobe)
+        recall = float((index.search(queries)[0] == exact.search(queries)[0]).mean())
+        print(
+            f"{size:>10} {bench_lookup(exact, queries[:1], args.repeats) * 1e3:>13.3f} "
+            f"{bench_lookup(index, queries[:1], args.repeats) * 1e3:>13.3f} "
+            f"{bench_lookup(index, queries, args.repeats) * 1e3:>15.3f} {recall:>9.2f}"
+        )
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser("Semantic cache lookup benchmark")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 10000, 50000, 100000])
+    parser.add_argument("--dim", type=int, default=384, help="Embedding size (all-MiniLM-L6-v2: 384)")
+    parser.add_argument("--batch", type=int, default=32, help="Queries per batched lookup")
+    parser.add_argument("--noise", type=float, default=0.02, help="Gaussian noise added to stored vectors to form queries")
+    parser.add_argument("--ivf-min-entries", type=int, default=20000)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=50)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    run(parse_args())
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import time
+
+import av
+import numpy as np
+
+from src.engine.models.video_sampling import sample_count, sample_frames, smart_resize
+
+def make_clip(path: str, seconds: float, fps: int, width: int, height: int, gop: int):
+    with av.open(path, "w") as container:
+        stream = container.add_stream("libx264", rate=fps)
+        stream.width, stream.height, stream.pix_fmt = width, height, "yuv420p"
+        stream.codec_context.gop_size = gop
+        for i in range(int(seconds * fps)):
+            pixels = np.full((height, width, 3), (i * 3) % 256, dtype=np.uint8)
+            pixels[: height // 8, (i * 5) % width :, 1] = 255
+            for packet in stream.encode(av.VideoFrame.from_ndarray(pixels, format="rgb24")):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+
+def full_decode(path: str, fps: float, max_pixels: int) -> np.ndarray:
+    """What reading the whole clip then sub-sampling (torchvision / qwen_vl_utils) amounts to."""
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        frames = [frame.to_ndarray(format="rgb24") for frame in container.decode(stream)]
+    rate = float(stream.average_rate)
+    indices = np.linspace(0, len(frames) - 1, sample_count(len(frames), rate, fps)).round().astype(int)
+    height, width = smart_resize(frames[0].shape[0], frames[0].shape[1], max_pixels=max_pixels)
+    return np.stack([
+        av.VideoFrame.from_ndarray(frames[i], format="rgb24").to_ndarray(format="rgb24", width=width, height=height, interpolation="AREA")
+        for i in indices
+    ])
+
+def timed(fn, *args, **kwargs):
+    timing = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - timing, result
+
+def run(args):
+    print(f"{'seconds':>8} {'frames':>7} {'full decode s':>14} {'seek s':>8} {'keyframes s':>12} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for seconds in args.lengths:
+            path = os.path.join(tmp, f"clip_{seconds}.mp4")
+            make_clip(path, seconds, args.clip_fps, args.width, args.height, args.gop)
+
+            full_time, full = timed(full_decode, path, args.fps, args.max_pixels)
+            seek_time, sampled = timed(sample_frames, path, fps=args.fps, max_pixels=args.max_pixels)
+            key_time, _ = timed(sample_frames, path, fps=args.fps, max_pixels=args.max_pixels, keyframes_only=True)
+            assert full.shape == sampled.shape, (full.shape, sampled.shape)
+            print(
+                f"{seconds:>8} {len(sampled):>7} {full_time:>14.3f} {seek_time:>8.3f} "
+                f"{key_time:>12.3f} {full_time / seek_time:>7.1f}x"
+            )
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser("Video frame sampling benchmark")
+    parser.add_argument("--lengths", nargs="+", type=int, default=[10, 60, 300], help="Clip lengths in seconds")
+    parser.add_argument("--fps", type=float, default=1.0, help="Sampling rate")
+    parser.add_argument("--max-pixels", type=int, default=360 * 420)
+    parser.add_argument("--clip-fps", type=int, default=25)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--gop", type=int, default=50, help="Keyframe interval of the synthetic clips")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    run(parse_args())
@@ -0,0 +1,60 @@
+import time
+from typing import List
+
+import numpy as np
+from PIL import Image
+
+from src.engine.models.model_vision import GwenVisionModel
+
+def make_images(count: int, width: int, height: int) -> List[Image.Image]:
+    rng = np.random.default_rng(0)
+    return [Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8)) for _ in range(count)]
+
+def bench_single(model: GwenVisionModel, images: List[Image.Image], prompt: str) -> float:
+    timing = time.perf_counter()
+    for image in images:
+        model.analyse_images_with_prompt([image], prompt)
+    return len(images) / (time.perf_counter() - timing)
+
+def bench_batch(model: GwenVisionModel, images: List[Image.Image], prompt: str, batch_size: int) -> float:
+    timing = time.perf_counter()
+    for start in range(0, len(images), batch_size):
+        model.analyse_batch([([image], prompt, None) for image in images[start:start + batch_size]])
+    return len(images) / (time.perf_counter() - timing)
+
+def run(args):
+    # plain PIL images are never served from the encoder cache, every image is encoded
+    model = GwenVisionModel(
+        device_id=args.device,
+        cache_dir=args.cache_dir,
+        model_name=args.model,
+        max_token=args.max_token,
+        encoder_cache_mb=0
+    )
+    images = make_images(args.images, args.width, args.height)
+    # warm-up
+    model.analyse_batch([([image], args.prompt, None) for image in images[:2]])
+
+    single = bench_single(model, images, args.prompt)
+    print(f"{'batch size':>10} {'images/s':>9} {'speedup':>8}")
+    print(f"{1:>10} {single:>9.2f} {1.0:>7.1f}x  (single-item path)")
+    for batch_size in args.batch_sizes:
+        throughput = bench_batch(model, images, args.prompt, batch_size)
+        print(f"{batch_size:>10} {throughput:>9.2f} {throughput / single:>7.1f}x")
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser("Batched vision inference benchmark")
+    parser.add_argument("--model", default="Qwen/Qwen2-VL-2B-Instruct")
+    parser.add_argument("--device", default="0")
+    parser.add_argument("--cache-dir", default="./.caches")
+    parser.add_argument("--images", type=int, default=32)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[2, 4, 8, 16])
+    parser.add_argument("--max-token", type=int, default=64)
+    parser.add_argument("--prompt", default="Describe this image.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    run(parse_args())
@@ -54,8 +54,12 @@ class SimpleDialog(QDialog):
             showInfo("Please enter a question before generating an answer.")
             return
         
-        answer = self.engine.answer(question)
-        self.answer_display.setText(answer)  # Display the answer in the read-only box
+        # Display the answer in the read-only box as it is being generated
+        answer = ""
+        for token in self.engine.answer_stream(question):
+            answer += token
+            self.answer_display.setText(answer)
+            mw.app.processEvents()
     
 def run_anki_assistant_tool(afa: AFAAnki):
     afa.dialog = SimpleDialog()
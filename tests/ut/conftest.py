@@ -0,0 +1,70 @@
+import asyncio
+import os
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pytest
+
+# the logging config writes to logs/app.log relative to the working directory, as when the server runs
+os.makedirs("logs", exist_ok=True)
+
+from src.app.core.jobs import BulkJobManager, JobStore
+from src.app.core.request_context import RequestContext
+from src.engine.deck_builder import JSONL, DeckBuilder
+
+class Killed(BaseException):
+    """Stands for the process being killed: not an `Exception`, so that nothing on the way catches it."""
+
+class StubAssistant(object):
+    """Answers "answer to {prompt}", as the engine's `answer` (after `delay`, raising the queued `errors`
+    of a prompt first) or as the model's `answer_batch` (killed on its `kill_at`-th call if set)."""
+    Killed = Killed
+
+    def __init__(self, delay: float = 0.005, errors: Optional[Dict[str, list]] = None, kill_at: Optional[int] = None):
+        self.delay = delay
+        self.errors = errors or {}
+        self.kill_at = kill_at
+        # `answer` calls per prompt, `answer_batch` calls and the prompts they answered
+        self.calls = Counter()
+        self.batches = 0
+        self.prompts: List[str] = []
+
+    async def answer(self, prompt: str, use_cache: bool = True, context: Optional[RequestContext] = None) -> Tuple[Optional[str], Optional[str]]:
+        self.calls[prompt] += 1
+        await asyncio.sleep(self.delay)
+        if self.errors.get(prompt):
+            raise self.errors[prompt].pop(0)
+        return f"answer to {prompt}", None
+
+    def answer_batch(self, prompts: List[str]) -> List[str]:
+        self.batches += 1
+        if self.batches == self.kill_at:
+            raise Killed()
+        self.prompts.extend(prompts)
+        return [f"answer to {prompt}" for prompt in prompts]
+
+@pytest.fixture
+def stub_assistant() -> type:
+    return StubAssistant
+
+@pytest.fixture
+def bulk_jobs(tmp_path) -> Callable[[StubAssistant], BulkJobManager]:
+    """Job managers answering through a stub assistant, all over the same store (as after a restart)."""
+    def create(assistant: StubAssistant) -> BulkJobManager:
+        jobs = BulkJobManager(JobStore(str(tmp_path / "jobs.sqlite3")), assistant.answer, concurrency=4)
+        jobs.RETRY_DELAY = 0.01
+        return jobs
+    return create
+
+@pytest.fixture
+def deck_builder() -> Callable[..., DeckBuilder]:
+    """Deck builders answering through a stub assistant, in batches of 3 checkpointed every 2."""
+    def create(assistant: StubAssistant, output_format: str = JSONL) -> DeckBuilder:
+        return DeckBuilder(
+            assistant.answer_batch,
+            template="define {term}",
+            output_format=output_format,
+            batch_size=3,
+            checkpoint_every=2
+        )
+    return create
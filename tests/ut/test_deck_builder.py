@@ -0,0 +1,97 @@
+import csv
+import json
+import os
+from typing import List
+
+import pytest
+
+from src.engine.deck_builder import ANKI, ANKI_HEADER, DeckBuilder
+
+def write_jsonl(path: str, terms: List[str]):
+    with open(path, "w", encoding="utf-8") as f:
+        for term in terms:
+            f.write(json.dumps({"term": term}) + "\n")
+
+def read_jsonl(path: str) -> List[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+TERMS = [f"word{index}" for index in range(20)]
+
+def test_resume_after_kill_writes_every_row_once(tmp_path, deck_builder, stub_assistant):
+    input_path, output_path = str(tmp_path / "terms.jsonl"), str(tmp_path / "deck.jsonl")
+    write_jsonl(input_path, TERMS)
+
+    # killed on the 4th batch: batches 1-2 are checkpointed, batch 3 is written after the checkpoint
+    killed = stub_assistant(kill_at=4)
+    with pytest.raises(stub_assistant.Killed):
+        deck_builder(killed).run(input_path, output_path)
+    assert len(read_jsonl(output_path)) == 9
+
+    resumed = stub_assistant()
+    checkpoint = deck_builder(resumed).run(input_path, output_path)
+
+    rows = read_jsonl(output_path)
+    assert [row["term"] for row in rows] == TERMS
+    assert all(row["answer"] == f"answer to define {row['term']}" for row in rows)
+    # only what followed the checkpoint is answered again
+    assert resumed.prompts == [f"define {term}" for term in TERMS[6:]]
+    assert checkpoint["completed"] and checkpoint["rows"] == len(TERMS) and checkpoint["failed"] == 0
+
+def test_resume_multiline_csv_into_anki(tmp_path, deck_builder, stub_assistant):
+    input_path, output_path = str(tmp_path / "terms.csv"), str(tmp_path / "deck.txt")
+    with open(input_path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["term", "note"])
+        for index, term in enumerate(TERMS):
+            writer.writerow([term, f"line one\nline two of {index}"])
+
+    with pytest.raises(stub_assistant.Killed):
+        deck_builder(stub_assistant(kill_at=4), ANKI).run(input_path, output_path)
+    deck_builder(stub_assistant(), ANKI).run(input_path, output_path)
+
+    with open(output_path, "r", encoding="utf-8") as f:
+        content = f.read()
+    assert content.startswith(ANKI_HEADER)
+    notes = list(csv.reader(content[len(ANKI_HEADER):].splitlines(), dialect="excel-tab"))
+    assert [front for front, _ in notes] == TERMS
+    assert all(back == f"answer to define {front}" for front, back in notes)
+
+def test_completed_run_is_not_redone(tmp_path, deck_builder, stub_assistant):
+    input_path, output_path = str(tmp_path / "terms.jsonl"), str(tmp_path / "deck.jsonl")
+    write_jsonl(input_path, TERMS)
+    deck_builder(stub_assistant()).run(input_path, output_path)
+
+    again = stub_assistant()
+    checkpoint = deck_builder(again).run(input_path, output_path)
+    assert again.batches == 0 and checkpoint["completed"]
+    assert len(read_jsonl(output_path)) == len(TERMS)
+
+def test_checkpoint_of_another_template_is_refused(tmp_path, deck_builder, stub_assistant):
+    input_path, output_path = str(tmp_path / "terms.jsonl"), str(tmp_path / "deck.jsonl")
+    write_jsonl(input_path, TERMS)
+    with pytest.raises(stub_assistant.Killed):
+        deck_builder(stub_assistant(kill_at=4)).run(input_path, output_path)
+
+    other = DeckBuilder(stub_assistant().answer_batch, template="translate {term}", batch_size=3)
+    with pytest.raises(ValueError):
+        other.run(input_path, output_path)
+    # --restart starts over, from an empty output
+    other.run(input_path, output_path, restart=True)
+    assert [row["term"] for row in read_jsonl(output_path)] == TERMS
+    assert os.path.exists(DeckBuilder.checkpoint_path(output_path))
+
+def test_failed_batch_is_answered_row_by_row(tmp_path):
+    input_path, output_path = str(tmp_path / "terms.jsonl"), str(tmp_path / "deck.jsonl")
+    write_jsonl(input_path, TERMS[:6])
+
+    def answer_batch(prompts: List[str]) -> List[str]:
+        if "define word4" in prompts:
+            raise RuntimeError("out of memory")
+        return [f"answer to {prompt}" for prompt in prompts]
+
+    checkpoint = DeckBuilder(answer_batch, template="define {term}", batch_size=3).run(input_path, output_path)
+    rows = read_jsonl(output_path)
+    assert [row["term"] for row in rows] == TERMS[:6]
+    assert [row.get("error") for row in rows] == [None] * 4 + ["out of memory", None]
+    assert checkpoint["failed"] == 1
@@ -0,0 +1,98 @@
+import asyncio
+
+from src.app.core.jobs import CANCELLED, COMPLETED, BulkJobManager
+from src.app.exceptions.exception import ChatbotException
+
+PROMPTS = [f"prompt {index}" for index in range(30)]
+
+async def wait_for(jobs: BulkJobManager, job_id: str, condition, timeout: float = 10.0):
+    async def poll():
+        while not condition(await jobs.status(job_id)):
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout)
+
+def test_interrupted_job_resumes_without_duplicates_or_losses(bulk_jobs, stub_assistant):
+    async def scenario():
+        # shut down part way, with items in flight
+        first = bulk_jobs(stub_assistant())
+        await first.start()
+        job_id = await first.submit(PROMPTS)
+        await wait_for(first, job_id, lambda row: row["done"] >= 10)
+        await first.stop()
+
+        second = bulk_jobs(stub_assistant())
+        await second.start()
+        await wait_for(second, job_id, lambda row: row["status"] == COMPLETED)
+        status = await second.status(job_id)
+        rows = await second.results(job_id, limit=1000)
+        await second.stop()
+        return status, rows
+
+    status, rows = asyncio.run(scenario())
+    assert status["done"] == len(PROMPTS) and status["failed"] == 0
+    assert sorted(row["idx"] for row in rows) == list(range(len(PROMPTS)))
+    assert [row["seq"] for row in rows] == list(range(1, len(PROMPTS) + 1))
+    assert all(row["answer"] == f"answer to {PROMPTS[row['idx']]}" for row in rows)
+
+def test_overload_is_retried_and_other_errors_fail_the_item(bulk_jobs, stub_assistant):
+    assistant = stub_assistant(errors={
+        "prompt 3": [ChatbotException.too_many_requests_exception(message="busy")] * 2,
+        "prompt 7": [ChatbotException.service_unavailable_exception(message="overloaded")],
+        "prompt 9": [ChatbotException.bad_request_exception(message="invalid prompt")]
+    })
+
+    async def scenario():
+        jobs = bulk_jobs(assistant)
+        await jobs.start()
+        job_id = await jobs.submit(PROMPTS[:12])
+        await wait_for(jobs, job_id, lambda row: row["status"] == COMPLETED)
+        status, rows = await jobs.status(job_id), await jobs.results(job_id)
+        await jobs.stop()
+        return status, {row["idx"]: row for row in rows}
+
+    status, rows = asyncio.run(scenario())
+    assert status["done"] == 11 and status["failed"] == 1
+    assert rows[3]["answer"] == "answer to prompt 3" and assistant.calls["prompt 3"] == 3
+    assert rows[7]["answer"] == "answer to prompt 7" and assistant.calls["prompt 7"] == 2
+    assert rows[9]["answer"] is None and rows[9]["error"] == "invalid prompt"
+    assert len(rows) == 12
+
+def test_cancelled_job_is_not_resumed(bulk_jobs, stub_assistant):
+    async def scenario():
+        first = bulk_jobs(stub_assistant(delay=0.02))
+        await first.start()
+        job_id = await first.submit(PROMPTS)
+        await wait_for(first, job_id, lambda row: row["done"] >= 4)
+        await first.cancel(job_id)
+        await first.stop()
+
+        second_assistant = stub_assistant()
+        second = bulk_jobs(second_assistant)
+        await second.start()
+        await asyncio.sleep(0.1)
+        status = await second.status(job_id)
+        await second.stop()
+        return status, second_assistant.calls
+
+    status, calls = asyncio.run(scenario())
+    assert status["status"] == CANCELLED
+    assert status["done"] < len(PROMPTS)
+    assert not calls
+
+def test_job_cancelled_before_it_starts_stays_cancelled(bulk_jobs, stub_assistant):
+    assistant = stub_assistant()
+
+    async def scenario():
+        jobs = bulk_jobs(assistant)
+        job_id = await jobs.submit(PROMPTS)
+        # cancelled between its launch and its first step
+        await jobs.cancel(job_id)
+        jobs._launch(job_id)
+        await jobs._jobs[job_id].task
+        status = await jobs.status(job_id)
+        await jobs.stop()
+        return status
+
+    status = asyncio.run(scenario())
+    assert status["status"] == CANCELLED
+    assert not assistant.calls
@@ -0,0 +1,60 @@
+import pytest
+
+from src.engine.models.replicas import QUEUE, TOKENS, ReplicaPool
+from src.engine.models.residency import ResidentModel
+
+def pool(routing: str = TOKENS, count: int = 3, fail_loads: int = 0) -> ReplicaPool:
+    """Replicas whose model is their index; the first `fail_loads` loads of replica 0 fail."""
+    failures = [fail_loads]
+
+    def load(index: int):
+        if index == 0 and failures[0]:
+            failures[0] -= 1
+            raise RuntimeError("out of memory")
+        return index
+
+    return ReplicaPool(f"test_{routing}", [ResidentModel(f"test_{routing}_{index}", lambda index=index: load(index)) for index in range(count)], routing)
+
+def test_tokens_routing_picks_the_replica_with_the_fewest_tokens_in_flight():
+    replicas = pool(TOKENS)
+    with replicas.use(tokens=100) as first, replicas.use(tokens=10) as second, replicas.use(tokens=50) as third:
+        assert (first, second, third) == (0, 1, 2)
+        with replicas.use(tokens=5) as fourth:
+            assert fourth == 1
+            # 100, 15 and 50 tokens in flight
+            with replicas.use(tokens=5) as fifth:
+                assert fifth == 1
+
+def test_queue_routing_picks_the_replica_with_the_fewest_calls():
+    replicas = pool(QUEUE, count=2)
+    with replicas.use(tokens=1000) as first, replicas.use(tokens=1) as second:
+        with replicas.use(tokens=1) as third:
+            # one call each: the tie goes to fewer tokens
+            assert (first, second, third) == (0, 1, 1)
+            with replicas.use() as fourth:
+                assert fourth == 0
+
+def test_replica_is_released_when_the_call_fails():
+    replicas = pool(TOKENS, count=2)
+    with pytest.raises(ValueError):
+        with replicas.use(tokens=100) as model:
+            assert model == 0
+            raise ValueError("generation failed")
+    # replica 0 is idle again, and loaded: it wins the tie
+    with replicas.use(tokens=100) as model:
+        assert model == 0
+
+def test_replica_is_released_when_its_load_fails():
+    replicas = pool(TOKENS, count=2, fail_loads=1)
+    with pytest.raises(RuntimeError):
+        with replicas.use(tokens=100):
+            pass
+    with replicas.use(tokens=10) as first, replicas.use(tokens=10) as second:
+        assert {first, second} == {0, 1}
+
+def test_affinity_sticks_to_the_first_replica_until_forgotten():
+    replicas = pool(TOKENS, count=2)
+    with replicas.use(tokens=100, affinity="session") as first:
+        with replicas.use(tokens=100, affinity="session") as again:
+            assert again == first
+    assert replicas.forget("session") == first
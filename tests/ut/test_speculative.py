@@ -0,0 +1,76 @@
+from types import SimpleNamespace
+from typing import List
+
+import pytest
+import torch
+
+from src.engine.models.speculative import SpeculativeDecoder
+
+NEW_TOKENS = 10
+
+class StubModel(torch.nn.Module):
+    """Counts as a model for `SpeculativeDecoder`: `generate` runs the forward passes of an assisted
+    generation of `NEW_TOKENS` tokens in which the target kept `accepted` of every 10 drafted ones."""
+    def __init__(self):
+        super(StubModel, self).__init__()
+        self.config = SimpleNamespace(get_text_config=lambda: SimpleNamespace(vocab_size=32))
+        self.accepted = 0
+        self.drafted: List[bool] = []
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return x
+
+    def generate(self, input_ids: torch.Tensor, assistant_model=None, **kwargs) -> torch.Tensor:
+        self.drafted.append(assistant_model is not None)
+        if assistant_model is None:
+            passes = NEW_TOKENS
+        else:
+            for _ in range(10):
+                assistant_model(input_ids)
+            passes = NEW_TOKENS - self.accepted
+        for _ in range(passes):
+            self(input_ids)
+        return torch.zeros(input_ids.shape[0], input_ids.shape[1] + NEW_TOKENS, dtype=torch.long)
+
+def decoder(target: StubModel) -> SpeculativeDecoder:
+    return SpeculativeDecoder("test", target, StubModel(), min_acceptance=0.3, warmup=3, probe_every=5)
+
+def generate(speculative: SpeculativeDecoder, target: StubModel, times: int, batch_size: int = 1):
+    for _ in range(times):
+        speculative.generate(target, {"input_ids": torch.ones(batch_size, 4, dtype=torch.long)})
+
+def test_low_acceptance_falls_back_to_plain_decoding_with_probes():
+    target = StubModel()
+    speculative = decoder(target)
+    target.accepted = 1
+    generate(speculative, target, 3)
+    assert target.drafted == [True] * 3
+    assert speculative.acceptance == pytest.approx(0.1) and not speculative.enabled
+
+    # every 5th request still drafts
+    generate(speculative, target, 10)
+    assert target.drafted[3:] == [False] * 4 + [True] + [False] * 4 + [True]
+    assert not speculative.enabled
+
+def test_drafting_resumes_once_acceptance_recovers():
+    target = StubModel()
+    speculative = decoder(target)
+    target.accepted = 1
+    generate(speculative, target, 3)
+
+    target.accepted = 9
+    # the moving average gets past 0.3 on the 2nd probe
+    generate(speculative, target, 10)
+    assert speculative.enabled and speculative.acceptance > 0.3
+    generate(speculative, target, 2)
+    assert target.drafted[-2:] == [True, True]
+
+def test_warmup_keeps_drafting_and_batches_are_never_drafted():
+    target = StubModel()
+    speculative = decoder(target)
+    target.accepted = 0
+    generate(speculative, target, 2)
+    assert target.drafted == [True, True] and speculative.enabled
+
+    generate(speculative, target, 1, batch_size=2)
+    assert target.drafted[-1] is False
@@ -0,0 +1,62 @@
+from typing import Iterator
+
+import pytest
+from fastapi import APIRouter, FastAPI, File, UploadFile
+from fastapi.testclient import TestClient
+
+from src.app.api.api_router import TimerRoute
+from src.app.core.uploads import body_limit, read_upload
+from src.app.exceptions.exception import ChatbotException
+from src.app.exceptions.exception_handlers import ChatbotExceptionHandler
+
+LIMIT = 64 * 1024
+
+@pytest.fixture
+def client():
+    """An app with one upload endpoint limited to `LIMIT` bytes of body; `client.received` lists the sizes it read."""
+    router = APIRouter(route_class=TimerRoute)
+    received = []
+
+    @router.post("/upload")
+    @body_limit(LIMIT)
+    async def upload(file: UploadFile = File(...)):
+        received.append(len(await read_upload(file, LIMIT)))
+        return {}
+
+    app = FastAPI()
+    app.add_exception_handler(ChatbotException, ChatbotExceptionHandler())
+    app.include_router(router)
+    client = TestClient(app)
+    client.received = received
+    return client
+
+def multipart(size: int) -> bytes:
+    return (
+        b"--boundary\r\n"
+        b'Content-Disposition: form-data; name="file"; filename="image.png"\r\n'
+        b"Content-Type: application/octet-stream\r\n\r\n"
+        + b"x" * size +
+        b"\r\n--boundary--\r\n"
+    )
+
+HEADERS = {"Content-Type": "multipart/form-data; boundary=boundary"}
+
+def chunks(body: bytes, size: int = 4096) -> Iterator[bytes]:
+    for start in range(0, len(body), size):
+        yield body[start:start + size]
+
+def test_body_within_the_limit_is_read(client):
+    response = client.post("/upload", content=multipart(LIMIT // 2), headers=HEADERS)
+    assert response.status_code == 200
+    assert client.received == [LIMIT // 2]
+
+def test_declared_length_past_the_limit_is_refused(client):
+    response = client.post("/upload", content=multipart(2 * LIMIT), headers=HEADERS)
+    assert response.status_code == 413
+    assert not client.received
+
+def test_chunked_body_is_refused_once_past_the_limit(client):
+    # no Content-Length: the body is counted as it arrives
+    response = client.post("/upload", content=chunks(multipart(2 * LIMIT)), headers=HEADERS)
+    assert response.status_code == 413
+    assert not client.received